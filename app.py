@@ -1,20 +1,49 @@
 # app.py
+import io
 import os
 import json
 import re
 import base64
+import binascii
 import logging
 import uuid
-from datetime import datetime
+import time
+import random
+import hashlib
+import socket
+import sqlite3
+import tempfile
+import threading
+import contextvars
+import multiprocessing
+from contextlib import contextmanager
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from functools import wraps
+from urllib.parse import urlencode
 
-from flask import Flask, request, jsonify, redirect, make_response
+from flask import Flask, Response, request, jsonify, redirect, make_response, has_request_context, stream_with_context
 from flask_cors import CORS, cross_origin
+from werkzeug.exceptions import RequestEntityTooLarge
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import jwt
 import psycopg2
-from psycopg2 import OperationalError
+from psycopg2 import OperationalError, InterfaceError, sql
+from psycopg2.extensions import connection as PgConnection
+from psycopg2.extras import Json
+from psycopg2.pool import ThreadedConnectionPool
+from PIL import Image, ImageOps
 from dotenv import load_dotenv
 
+import lab_values
+import pdf_text
+import report_chunks
+import triage
+
 # --- Load .env (optional locally; Render uses Environment tab) ---
 load_dotenv()
 
@@ -37,9 +66,159 @@ SUPABASE_URL = os.getenv("SUPABASE_URL", "https://YOUR-PROJECT.supabase.co")
 SUPABASE_ANON_KEY = os.getenv("SUPABASE_ANON_KEY", "")
 SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY", "")
 
+# Upstream endpoints (overridable so bench/ can point the app at local stand-ins; OpenAI reads OPENAI_BASE_URL itself)
+GOOGLE_PLACES_URL = os.getenv("GOOGLE_PLACES_URL", "https://maps.googleapis.com/maps/api/place/nearbysearch/json")
+GOOGLE_VISION_URL = os.getenv("GOOGLE_VISION_URL", "https://vision.googleapis.com/v1/images:annotate")
+GOOGLE_VISION_FILES_URL = os.getenv("GOOGLE_VISION_FILES_URL", "https://vision.googleapis.com/v1/files:annotate")
+
+# AI response cache: "memory" (per-process LRU) or "sqlite" (LRU + shared file)
+AI_CACHE_BACKEND = os.getenv("AI_CACHE_BACKEND", "memory").lower()
+AI_CACHE_TTL = int(os.getenv("AI_CACHE_TTL", "3600"))
+AI_CACHE_MAX_ENTRIES = int(os.getenv("AI_CACHE_MAX_ENTRIES", "512"))
+AI_CACHE_SQLITE_PATH = os.getenv("AI_CACHE_SQLITE_PATH", "/tmp/askdoc-cache.sqlite3")
+# expired rows in the sqlite file are swept by a write at most this often (seconds)
+AI_CACHE_PRUNE_INTERVAL = float(os.getenv("AI_CACHE_PRUNE_INTERVAL", "60"))
+
+# Singleflight: concurrent identical OpenAI/Places calls share one upstream call. With the
+# sqlite AI cache, a short lease in the same file also coalesces OpenAI calls across workers.
+SINGLEFLIGHT_SHARED = os.getenv("SINGLEFLIGHT_SHARED", "1") == "1"
+SINGLEFLIGHT_LEASE_TTL = float(os.getenv("SINGLEFLIGHT_LEASE_TTL", "60"))
+SINGLEFLIGHT_POLL_INTERVAL = float(os.getenv("SINGLEFLIGHT_POLL_INTERVAL", "0.1"))
+
+# Idempotency-Key on POST /analyze and POST /api/history: replies are kept this long and
+# replayed to repeats; repeats that arrive while the first is running wait for it
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "86400"))
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "10000"))
+
+# GET /api/history replies cached per user (and per caller JWT and query), dropped on
+# save/delete; with the sqlite AI cache the drop is seen by every worker on the host.
+# With more than one worker and no shared tier the cache is off: a save on one worker
+# would leave the others serving the old page (and 304s) until the TTL.
+HISTORY_CACHE_TTL = int(os.getenv("HISTORY_CACHE_TTL", "60"))
+HISTORY_CACHE_MAX_USERS = int(os.getenv("HISTORY_CACHE_MAX_USERS", "1000"))
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+
+# History write-behind: with HISTORY_WRITE_MODE=behind (or `Prefer: respond-async`) POST
+# /api/history appends the row to a local SQLite queue and returns 202; a background thread
+# flushes it to Supabase in multi-row inserts
+HISTORY_WRITE_MODE = os.getenv("HISTORY_WRITE_MODE", "sync").lower()
+HISTORY_QUEUE_PATH = os.getenv("HISTORY_QUEUE_PATH", "/tmp/askdoc-history-queue.sqlite3")
+HISTORY_QUEUE_MAX = int(os.getenv("HISTORY_QUEUE_MAX", "5000"))
+HISTORY_FLUSH_BATCH = int(os.getenv("HISTORY_FLUSH_BATCH", "100"))
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", "0.5"))
+HISTORY_FLUSH_MAX_ATTEMPTS = int(os.getenv("HISTORY_FLUSH_MAX_ATTEMPTS", "8"))
+# dead-lettered rows (their JWT is dropped when they die) are deleted this long after enqueue
+HISTORY_DEAD_RETENTION = int(os.getenv("HISTORY_DEAD_RETENTION", "604800"))
+
+# Lab report job queue. Jobs run in the worker that accepted them; with AI_CACHE_BACKEND=sqlite
+# their state is published to the shared file so GET /jobs/<id> works from any worker on the host
+LAB_JOB_WORKERS = int(os.getenv("LAB_JOB_WORKERS", "4"))
+LAB_JOB_QUEUE_MAX = int(os.getenv("LAB_JOB_QUEUE_MAX", "32"))
+LAB_JOB_MAX_STORED = int(os.getenv("LAB_JOB_MAX_STORED", "1000"))
+LAB_JOB_TTL = int(os.getenv("LAB_JOB_TTL", "1800"))
+LAB_JOB_MAX_WAIT = float(os.getenv("LAB_JOB_MAX_WAIT", "25"))
+
+# Server-side PDF lab reports: text layer extracted per page range in a process pool,
+# Vision OCR only for pages without one
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", "2"))
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "4"))
+PDF_MAX_PAGES = int(os.getenv("PDF_MAX_PAGES", "50"))
+PDF_MAX_CHARS = int(os.getenv("PDF_MAX_CHARS", "60000"))
+# Lab reports: send the LLM the locally parsed (analyte, value, unit, range, flag) table
+# instead of the raw OCR text, when enough of the report parsed
+LAB_VALUES_ENABLED = os.getenv("LAB_VALUES_ENABLED", "1") == "1"
+LAB_VALUES_MIN_ROWS = int(os.getenv("LAB_VALUES_MIN_ROWS", "3"))
+LAB_VALUES_MIN_COVERAGE = float(os.getenv("LAB_VALUES_MIN_COVERAGE", "0.8"))  # parsed share of result-looking lines
+# Oversized lab reports: past LAB_CHUNK_THRESHOLD_TOKENS the report is split into section-aligned
+# chunks of about LAB_CHUNK_TOKENS (grown to keep at most LAB_CHUNK_MAX), each condensed locally by the
+# lab value parser when it understands the chunk and by its own call otherwise, LAB_CHUNK_WORKERS at a
+# time; one short reduce call then writes the usual analysis
+LAB_CHUNKING_ENABLED = os.getenv("LAB_CHUNKING_ENABLED", "0") == "1"
+LAB_CHUNK_THRESHOLD_TOKENS = int(os.getenv("LAB_CHUNK_THRESHOLD_TOKENS", "12000"))
+LAB_CHUNK_TOKENS = int(os.getenv("LAB_CHUNK_TOKENS", "3000"))
+LAB_CHUNK_MAX = int(os.getenv("LAB_CHUNK_MAX", "12"))
+LAB_CHUNK_WORKERS = int(os.getenv("LAB_CHUNK_WORKERS", "4"))
+LAB_CHUNK_SUMMARY_TOKENS = int(os.getenv("LAB_CHUNK_SUMMARY_TOKENS", "300"))  # max_tokens of each map call
+PDF_MIN_PAGE_CHARS = int(os.getenv("PDF_MIN_PAGE_CHARS", "20"))
+
+# Binary uploads (multipart/form-data or a raw image/* or application/pdf body);
+# bodies above UPLOAD_SPOOL_BYTES are spooled to disk while they are read
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(15 * 1024 * 1024)))
+UPLOAD_SPOOL_BYTES = int(os.getenv("UPLOAD_SPOOL_BYTES", str(512 * 1024)))
+# JSON clients still send base64, which is 4/3 the size of the file
+app.config["MAX_CONTENT_LENGTH"] = UPLOAD_MAX_BYTES * 4 // 3 + 1024 * 1024
+
+# Vision image preprocessing: decode once, apply EXIF orientation, cap the longest edge
+# (labels need far fewer pixels than OCR of a printed page) and re-encode
+IMAGE_PREPROCESS = os.getenv("IMAGE_PREPROCESS", "1") == "1"
+VISION_LABEL_MAX_EDGE = int(os.getenv("VISION_LABEL_MAX_EDGE", "1024"))
+VISION_OCR_MAX_EDGE = int(os.getenv("VISION_OCR_MAX_EDGE", "2048"))
+VISION_IMAGE_FORMAT = os.getenv("VISION_IMAGE_FORMAT", "JPEG").upper()  # JPEG or WEBP
+VISION_IMAGE_QUALITY = int(os.getenv("VISION_IMAGE_QUALITY", "85"))
+
+# Photo dedupe cache: Vision results and analyses per image, found by exact SHA-256 or by a
+# dHash (IMAGE_HASH_SIZE^2 bits) within IMAGE_HASH_MAX_DISTANCE bits; -1 disables fuzzy matching
+IMAGE_CACHE_MAX_ENTRIES = int(os.getenv("IMAGE_CACHE_MAX_ENTRIES", "256"))
+IMAGE_CACHE_TTL = int(os.getenv("IMAGE_CACHE_TTL", "1800"))
+IMAGE_HASH_SIZE = int(os.getenv("IMAGE_HASH_SIZE", "16"))
+IMAGE_HASH_MAX_DISTANCE = int(os.getenv("IMAGE_HASH_MAX_DISTANCE", "10"))
+
+# Outbound HTTP pools: one keep-alive session per upstream, sized for the gunicorn threads
+# of this process plus the background pool (both read from the same env as gunicorn.conf.py)
+GUNICORN_THREADS = int(os.getenv("GUNICORN_THREADS", "1"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+
+# History storage: "rest" (Supabase PostgREST) or "postgres" (pooled psycopg2 on DATABASE_URL,
+# RLS emulated per transaction from the caller's verified Supabase JWT)
+HISTORY_BACKEND = os.getenv("HISTORY_BACKEND", "rest").lower()
+DATABASE_SSLMODE = os.getenv("DATABASE_SSLMODE", "require")
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", str(max(4, GUNICORN_THREADS + 2))))
+# psycopg2 closes connections returned above minconn, losing their prepared statements; keep them all
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", str(DB_POOL_MAX)))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+# named prepared statements need session pooling; turn off behind a transaction-mode pgbouncer
+DB_PREPARED_STATEMENTS = os.getenv("DB_PREPARED_STATEMENTS", "1") == "1"
+DB_RLS_ROLE = os.getenv("DB_RLS_ROLE", "authenticated")  # empty: don't switch roles
+SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET", "")
+SUPABASE_JWT_AUDIENCE = os.getenv("SUPABASE_JWT_AUDIENCE", "authenticated")
+
+# Deterministic red-flag screen (triage.py) on symptoms and OCR text; a hit forces an
+# emergency urgency/immediate_action that the LLM cannot downgrade
+TRIAGE_ENABLED = os.getenv("TRIAGE_ENABLED", "1") == "1"
+
+# Start the Places lookup alongside the OpenAI call (guessing the specialty from the input)
+SPECULATIVE_DOCTORS = os.getenv("SPECULATIVE_DOCTORS", "1") == "1"
+BACKGROUND_WORKERS = int(os.getenv("BACKGROUND_WORKERS", "8"))
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", str(max(10, GUNICORN_THREADS + BACKGROUND_WORKERS))))
+
+# Places results cache, keyed on specialty + geohash tile (precision 6 is ~1.2 x 0.6 km)
+DOCTORS_CACHE_TTL = int(os.getenv("DOCTORS_CACHE_TTL", "3600"))
+DOCTORS_CACHE_STALE_TTL = int(os.getenv("DOCTORS_CACHE_STALE_TTL", "21600"))
+DOCTORS_CACHE_MAX_ENTRIES = int(os.getenv("DOCTORS_CACHE_MAX_ENTRIES", "2048"))
+DOCTORS_GEOHASH_PRECISION = int(os.getenv("DOCTORS_GEOHASH_PRECISION", "6"))
+
+# OpenAI resilience: transient failures (connection errors, 408/409/429/5xx) are retried up to
+# OPENAI_MAX_RETRIES times with full-jitter exponential backoff, or after the server's Retry-After
+# when it's no longer than OPENAI_BACKOFF_MAX. Retries are capped at OPENAI_RETRY_BUDGET_RATIO of
+# the calls in the breaker window (plus OPENAI_RETRY_BUDGET_MIN). The breaker opens when at least
+# OPENAI_BREAKER_MIN_CALLS attempts in OPENAI_BREAKER_WINDOW seconds failed at
+# OPENAI_BREAKER_ERROR_RATE, fails calls fast for OPENAI_BREAKER_COOLDOWN seconds, then lets one
+# probe through.
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+OPENAI_BACKOFF_BASE = float(os.getenv("OPENAI_BACKOFF_BASE", "0.5"))
+OPENAI_BACKOFF_MAX = float(os.getenv("OPENAI_BACKOFF_MAX", "8"))
+OPENAI_RETRY_BUDGET_RATIO = float(os.getenv("OPENAI_RETRY_BUDGET_RATIO", "0.2"))
+OPENAI_RETRY_BUDGET_MIN = int(os.getenv("OPENAI_RETRY_BUDGET_MIN", "3"))
+OPENAI_BREAKER_WINDOW = float(os.getenv("OPENAI_BREAKER_WINDOW", "30"))
+OPENAI_BREAKER_MIN_CALLS = int(os.getenv("OPENAI_BREAKER_MIN_CALLS", "10"))
+OPENAI_BREAKER_ERROR_RATE = float(os.getenv("OPENAI_BREAKER_ERROR_RATE", "0.5"))
+OPENAI_BREAKER_COOLDOWN = float(os.getenv("OPENAI_BREAKER_COOLDOWN", "10"))
+
 # --- OpenAI v1 client ---
-from openai import OpenAI
-client = OpenAI(api_key=OPENAI_API_KEY)
+# the SDK's own retries are off; openai_call() retries with a budget and a circuit breaker
+from openai import OpenAI, APIConnectionError, APIStatusError
+client = OpenAI(api_key=OPENAI_API_KEY, max_retries=0, timeout=OPENAI_TIMEOUT)
 
 # --- Small sanity checks (log-only) ---
 if not API_AUTH_TOKEN:
@@ -51,6 +230,390 @@ if not SUPABASE_ANON_KEY:
 if not SUPABASE_SERVICE_ROLE_KEY:
     logger.warning("SUPABASE_SERVICE_ROLE_KEY missing. Delete account may fail.")
 
+# --- Metrics (per process; /metrics in Prometheus text format, /debug/stats as JSON) ---
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+def bump(name, n=1):
+    with _stats_lock:
+        _stats[name] += n
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Histogram:
+    def __init__(self, name, help_text, label, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = buckets
+        self._series = {}  # label value -> [bucket counts..., sum, count]
+
+    def observe(self, label_value, value):
+        with _stats_lock:
+            series = self._series.setdefault(label_value, [0] * len(self.buckets) + [0.0, 0])
+            for i, upper in enumerate(self.buckets):
+                if value <= upper:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with _stats_lock:
+            items = sorted((k, list(v)) for k, v in self._series.items())
+        for label_value, series in items:
+            lbl = f'{self.label}="{label_value}"'
+            for upper, count in zip(self.buckets, series):
+                lines.append(f'{self.name}_bucket{{{lbl},le="{upper}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{lbl},le="+Inf"}} {series[-1]}')
+            lines.append(f"{self.name}_sum{{{lbl}}} {series[-2]:.6f}")
+            lines.append(f"{self.name}_count{{{lbl}}} {series[-1]}")
+        return lines
+
+stage_seconds = Histogram("askdoc_stage_duration_seconds", "Time spent in a hot-path stage.", "stage")
+upstream_seconds = Histogram("askdoc_upstream_duration_seconds", "Outbound call latency per upstream.", "upstream")
+request_seconds = Histogram("askdoc_http_request_duration_seconds", "Request handling time per endpoint.", "endpoint")
+history_queue_seconds = Histogram("askdoc_history_queue_seconds", "Enqueue-to-flush time of write-behind history rows.", "outcome")
+openai_seconds = Histogram("askdoc_openai_duration_seconds", "OpenAI completion time per prompt type and prompt-cache outcome.", "route")
+_upstream_inflight = Counter()
+_openai_tokens = Counter()  # (prompt_type, kind) -> tokens
+
+# stage -> ms for the current request, rendered as the Server-Timing header
+_server_timing = contextvars.ContextVar("server_timing", default=None)
+
+def _record_server_timing(name, elapsed):
+    timings = _server_timing.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + elapsed * 1000
+
+def server_timing_header(timings):
+    return ", ".join(f"{name};dur={ms:.1f}" for name, ms in timings.items())
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_seconds.observe(name, elapsed)
+        _record_server_timing(name, elapsed)
+
+def timed(name):
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+@contextmanager
+def upstream_call(upstream):
+    with _stats_lock:
+        _upstream_inflight[upstream] += 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        upstream_seconds.observe(upstream, time.perf_counter() - start)
+        with _stats_lock:
+            _upstream_inflight[upstream] -= 1
+
+def record_openai_usage(usage, prompt_type, elapsed=None):
+    """Token counts per prompt_type, including the prompt tokens OpenAI served
+    from its prompt cache; with `elapsed`, also the call's latency split by
+    whether the cache was hit."""
+    if usage is None:
+        return
+    cached = getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", 0) or 0
+    with _stats_lock:
+        _openai_tokens[(prompt_type, "prompt")] += getattr(usage, "prompt_tokens", 0) or 0
+        _openai_tokens[(prompt_type, "cached")] += cached
+        _openai_tokens[(prompt_type, "completion")] += getattr(usage, "completion_tokens", 0) or 0
+    if elapsed is not None:
+        openai_seconds.observe(f"{prompt_type}/{'hit' if cached else 'miss'}", elapsed)
+
+# --- OpenAI resilience: retries, retry budget, circuit breaker ---
+class OpenAIUnavailable(Exception):
+    """The OpenAI circuit breaker is open; calls fail fast until it lets a probe through."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"OpenAI circuit open, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+class RollingCounts:
+    """Named counts over the last `window` seconds, in one-second buckets.
+    Not locked; the owner holds its own lock around every call."""
+
+    def __init__(self, window):
+        self.window = max(1, int(window))
+        self.buckets = {}  # int(second) -> Counter
+
+    def add(self, name, n=1):
+        self.buckets.setdefault(int(time.monotonic()), Counter())[name] += n
+
+    def totals(self):
+        cutoff = int(time.monotonic()) - self.window
+        for second in [s for s in self.buckets if s <= cutoff]:
+            del self.buckets[second]
+        totals = Counter()
+        for counts in self.buckets.values():
+            totals.update(counts)
+        return totals
+
+    def clear(self):
+        self.buckets.clear()
+
+class RetryBudget:
+    """Retries may add at most `ratio` of the first attempts seen in the window
+    (plus `minimum` so a quiet process can still retry), so an outage can't
+    multiply the load on OpenAI by the retry count."""
+
+    def __init__(self, ratio, minimum, window):
+        self.ratio = ratio
+        self.minimum = minimum
+        self.counts = RollingCounts(window)
+        self._lock = threading.Lock()
+
+    def record_request(self):
+        with self._lock:
+            self.counts.add("requests")
+
+    def spend(self):
+        with self._lock:
+            totals = self.counts.totals()
+            if totals["retries"] >= self.minimum + self.ratio * totals["requests"]:
+                allowed = False
+            else:
+                self.counts.add("retries")
+                allowed = True
+        if not allowed:
+            bump("openai_retry_budget_exhausted")
+        return allowed
+
+    def stats(self):
+        with self._lock:
+            totals = self.counts.totals()
+        return {"requests": totals["requests"], "retries": totals["retries"],
+                "allowed": round(self.minimum + self.ratio * totals["requests"], 1)}
+
+class CircuitBreaker:
+    """closed -> open when at least `min_calls` attempts in the window failed at
+    `error_rate` or more; open -> half_open after `cooldown`, letting a single
+    probe through; the probe's outcome closes or re-opens it."""
+
+    STATES = ("closed", "half_open", "open")
+
+    def __init__(self, name, window, min_calls, error_rate, cooldown):
+        self.name = name
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self.counts = RollingCounts(window)
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.probing = False
+        self._lock = threading.Lock()
+
+    def _open(self):
+        self.state = "open"
+        self.opened_at = time.monotonic()
+        self.probing = False
+        self.counts.clear()
+        bump(f"{self.name}_opened")
+        logger.warning(f"{self.name} opened; failing fast for {self.cooldown:.0f}s")
+
+    def allow(self):
+        """Whether an attempt may go out now. An allowed attempt must be
+        followed by record()."""
+        with self._lock:
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < self.cooldown:
+                    return False
+                self.state = "half_open"
+            if self.state == "half_open":
+                if self.probing:
+                    return False
+                self.probing = True
+            return True
+
+    def record(self, ok):
+        with self._lock:
+            if self.state == "half_open":
+                if ok:
+                    self.state = "closed"
+                    self.probing = False
+                    self.counts.clear()
+                    logger.info(f"{self.name} closed")
+                else:
+                    self._open()
+                return
+            if self.state == "open":
+                return  # an attempt that started before the breaker opened
+            self.counts.add("ok" if ok else "failed")
+            totals = self.counts.totals()
+            calls = totals["ok"] + totals["failed"]
+            if calls >= self.min_calls and totals["failed"] / calls >= self.error_rate:
+                self._open()
+
+    def abandon(self):
+        """An allowed attempt that ended without an outcome (cancelled)."""
+        with self._lock:
+            self.probing = False
+
+    def is_open(self):
+        return self.state == "open"
+
+    def failing_fast(self):
+        """Open, or half-open with the probe out: new calls are being rejected."""
+        return self.state != "closed"
+
+    def retry_after(self):
+        with self._lock:
+            if self.state != "open":
+                return 0.0
+            return max(0.0, self.cooldown - (time.monotonic() - self.opened_at))
+
+    def stats(self):
+        with self._lock:
+            totals = self.counts.totals()
+            state = self.state
+        calls = totals["ok"] + totals["failed"]
+        return {"state": state, "calls": calls, "error_rate": round(totals["failed"] / calls, 3) if calls else 0.0}
+
+openai_breaker = CircuitBreaker("openai_breaker", OPENAI_BREAKER_WINDOW, OPENAI_BREAKER_MIN_CALLS,
+                                OPENAI_BREAKER_ERROR_RATE, OPENAI_BREAKER_COOLDOWN)
+openai_retry_budget = RetryBudget(OPENAI_RETRY_BUDGET_RATIO, OPENAI_RETRY_BUDGET_MIN, OPENAI_BREAKER_WINDOW)
+
+def openai_retryable(error):
+    """Transient failures worth another attempt (the statuses the SDK itself retries):
+    connection errors and timeouts, 408, 409, 429 and 5xx."""
+    if isinstance(error, APIConnectionError):
+        return True
+    if isinstance(error, APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return False
+
+def _retry_after_seconds(error):
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+    except (TypeError, ValueError):
+        return None
+
+def openai_retry_delay(error, attempt):
+    """Seconds to wait before retry `attempt + 1`, or None to give up: full-jitter
+    exponential backoff, or the server's Retry-After (plus a little jitter) when
+    it sent one and it is within OPENAI_BACKOFF_MAX."""
+    if attempt >= OPENAI_MAX_RETRIES or not openai_retryable(error):
+        return None
+    retry_after = _retry_after_seconds(error)
+    if retry_after is not None:
+        if retry_after > OPENAI_BACKOFF_MAX:
+            bump("openai_retry_after_too_long")
+            return None
+        return max(0.0, retry_after) + random.uniform(0, OPENAI_BACKOFF_BASE)
+    return random.uniform(0, min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * 2 ** attempt))
+
+def openai_attempt_failed(error, attempt):
+    """Record a failed attempt; returns the delay before retrying, or None to give up."""
+    openai_breaker.record(not openai_retryable(error))  # a 400 says nothing about upstream health
+    delay = openai_retry_delay(error, attempt)
+    if delay is None or openai_breaker.is_open() or not openai_retry_budget.spend():
+        return None
+    bump("openai_retries")
+    return delay
+
+def openai_call(create, **kwargs):
+    """create(**kwargs) (an OpenAI SDK method) behind the breaker, retried with
+    backoff. Raises OpenAIUnavailable when the breaker is open, or the last error."""
+    openai_retry_budget.record_request()
+    attempt = 0
+    while True:
+        if not openai_breaker.allow():
+            bump("openai_breaker_rejected")
+            raise OpenAIUnavailable(openai_breaker.retry_after())
+        try:
+            result = create(**kwargs)
+        except Exception as e:
+            delay = openai_attempt_failed(e, attempt)
+            if delay is None:
+                raise
+            logger.warning(f"OpenAI attempt {attempt + 1} failed ({e}); retrying in {delay:.2f}s")
+            time.sleep(delay)
+            attempt += 1
+            continue
+        openai_breaker.record(True)
+        return result
+
+def ai_failure_status():
+    """HTTP status for a failed AI call: 503 while the breaker rejects calls (with
+    a Retry-After added on the way out), 500 otherwise."""
+    return 503 if openai_breaker.failing_fast() else 500
+
+# --- Outbound HTTP sessions ---
+UPSTREAMS = ("google_places", "google_vision", "supabase")
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+
+def http_session(upstream):
+    """Shared keep-alive session for one upstream. Idempotent verbs are retried
+    on connection errors and 502/503/504; POSTs are never retried here."""
+    session = _http_sessions.get(upstream)
+    if session is not None:
+        return session
+    with _http_sessions_lock:
+        session = _http_sessions.get(upstream)
+        if session is None:
+            retry = Retry(
+                total=HTTP_RETRIES,
+                backoff_factor=0.3,
+                status_forcelist=(502, 503, 504),
+                allowed_methods=frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}),
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=retry)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_sessions[upstream] = session
+    return session
+
+def http_pool_stats():
+    stats = {}
+    for upstream, session in list(_http_sessions.items()):
+        adapter = session.get_adapter("https://")
+        pools = adapter.poolmanager.pools
+        hosts = {}
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            idle_slots = pool.pool.qsize() if pool.pool is not None else 0
+            hosts[f"{pool.scheme}://{pool.host}"] = {
+                "maxsize": HTTP_POOL_MAXSIZE,
+                "in_use": HTTP_POOL_MAXSIZE - idle_slots,
+                "connections_opened": pool.num_connections,
+                "requests": pool.num_requests,
+            }
+        stats[upstream] = hosts
+    return stats
+
+# --- Background work (prefetches, cache refreshes) ---
+_background_pool = ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS, thread_name_prefix="askdoc-bg")
+
 # --- Health (plain text & JSON) ---
 @app.route("/")
 def root():
@@ -60,6 +623,23 @@ def root():
 def health():
     return jsonify({"status": "ok", "timestamp": datetime.utcnow().isoformat()})
 
+@app.before_request
+def _start_request_timer():
+    request.environ["askdoc.started"] = time.perf_counter()
+    _server_timing.set({})
+
+@app.after_request
+def _finish_request_timer(response):
+    started = request.environ.get("askdoc.started")
+    if started is not None:
+        request_seconds.observe(request.endpoint or "unknown", time.perf_counter() - started)
+    timings = _server_timing.get()
+    if timings:
+        response.headers["Server-Timing"] = server_timing_header(timings)
+    if response.status_code == 503 and "Retry-After" not in response.headers and openai_breaker.failing_fast():
+        response.headers["Retry-After"] = str(max(1, int(openai_breaker.retry_after() + 0.5)))
+    return response
+
 # --- Auth middleware ---
 def token_required(f):
     @wraps(f)
@@ -75,17 +655,156 @@ def token_required(f):
         return f(current_user={"id": "auth_user_id"}, *args, **kwargs)
     return decorated
 
-# --- Optional DB connection (unused but kept for parity) ---
+# --- Postgres data access (HISTORY_BACKEND=postgres) ---
+class PooledConnection(PgConnection):
+    """psycopg2 connection that remembers what has been PREPAREd on its session."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+# ThreadedConnectionPool raises when empty; the semaphore makes callers queue instead
+_db_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+
+def db_pool():
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is None:
+            _db_pool = ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DATABASE_URL, sslmode=DATABASE_SSLMODE,
+                                              connection_factory=PooledConnection)
+        return _db_pool
+
 def get_db_connection():
+    """A pooled connection (hand it back with release_db_connection), or None."""
     if not DATABASE_URL:
         return None
+    if not _db_slots.acquire(timeout=DB_POOL_TIMEOUT):
+        logger.error("Database pool exhausted.")
+        return None
     try:
-        return psycopg2.connect(DATABASE_URL, sslmode="require")
-    except OperationalError as e:
+        return db_pool().getconn()
+    except Exception as e:
+        _db_slots.release()
         logger.error(f"Database connection failed: {e}")
         return None
 
+def release_db_connection(conn, broken=False):
+    try:
+        db_pool().putconn(conn, close=broken or conn.closed != 0)
+    finally:
+        _db_slots.release()
+
+def db_pool_stats():
+    if _db_pool is None:
+        return {"backend": HISTORY_BACKEND, "open": False}
+    return {"backend": HISTORY_BACKEND, "open": True, "max": DB_POOL_MAX,
+            "in_use": len(_db_pool._used), "idle": len(_db_pool._pool)}
+
+def verify_supabase_jwt(token, user_id=None):
+    """Claims of a Supabase access token, checked against SUPABASE_JWT_SECRET (and
+    against `user_id` when given). Raises PermissionError."""
+    if not SUPABASE_JWT_SECRET:
+        raise PermissionError("SUPABASE_JWT_SECRET is not configured")
+    try:
+        claims = jwt.decode(token, SUPABASE_JWT_SECRET, algorithms=["HS256"], audience=SUPABASE_JWT_AUDIENCE)
+    except jwt.PyJWTError as e:
+        raise PermissionError(f"Invalid Supabase auth token: {e}")
+    if user_id and claims.get("sub") != user_id:
+        raise PermissionError("Supabase auth token does not belong to this user")
+    return claims
+
+@contextmanager
+def db_transaction(claims=None):
+    """(connection, cursor) inside one transaction on a pooled connection.
+
+    With `claims` the transaction runs the way PostgREST runs a request: as
+    DB_RLS_ROLE, with request.jwt.claims (and the older request.jwt.claim.sub)
+    set locally, so RLS policies built on auth.uid() apply unchanged.
+    """
+    conn = get_db_connection()
+    if conn is None:
+        raise RuntimeError("Database unavailable")
+    broken = False
+    try:
+        with upstream_call("postgres"):
+            cur = conn.cursor()
+            if claims is not None:
+                if DB_RLS_ROLE:
+                    cur.execute(sql.SQL("SET LOCAL ROLE {}").format(sql.Identifier(DB_RLS_ROLE)))
+                cur.execute("SELECT set_config('request.jwt.claims', %s, true), set_config('request.jwt.claim.sub', %s, true)",
+                            (json.dumps(claims), str(claims.get("sub", ""))))
+            yield conn, cur
+            conn.commit()
+    except (OperationalError, InterfaceError):
+        broken = True
+        raise
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        release_db_connection(conn, broken)
+
+def db_execute(conn, cur, name, statement, params=(), many=False):
+    """Run `statement` (written with $1..$n placeholders) as a named prepared
+    statement, PREPAREd once per pooled session; plain execution when disabled."""
+    if not DB_PREPARED_STATEMENTS:
+        statement = re.sub(r"\$(\d+)", "%s", statement)
+        return cur.executemany(statement, params) if many else cur.execute(statement, params)
+    if name not in conn.prepared:
+        cur.execute(f"PREPARE {name} AS {statement}")
+        conn.prepared.add(name)
+    arity = len(params[0] if many else params)
+    execute = f"EXECUTE {name} ({', '.join(['%s'] * arity)})" if arity else f"EXECUTE {name}"
+    return cur.executemany(execute, params) if many else cur.execute(execute, params)
+
+def _db_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    return value
+
+def db_history_page(claims, user_id, columns, limit=None, before=None):
+    """History rows for one user, newest first. Bounded pages use a prepared
+    statement; an unbounded read streams through a server-side cursor."""
+    columns = list(columns)
+    select = ", ".join(f'"{c}"' for c in columns)  # names come from HISTORY_COLUMNS
+    where, params = ["user_id = $1"], [user_id]
+    if before is not None:
+        where.append("(timestamp, id) < ($2, $3)")
+        params += list(before)
+    statement = f"SELECT {select} FROM history WHERE {' AND '.join(where)} ORDER BY timestamp DESC, id DESC"
+    with db_transaction(claims) as (conn, cur):
+        if limit is None:
+            with conn.cursor(name=f"history_{uuid.uuid4().hex[:12]}") as scan:
+                scan.itersize = 500
+                scan.execute(re.sub(r"\$(\d+)", "%s", statement), params)
+                return [{c: _db_value(v) for c, v in zip(columns, row)} for row in scan]
+        params.append(limit)
+        statement += f" LIMIT ${len(params)}"
+        name = "history_page_" + hashlib.sha1(statement.encode("utf-8")).hexdigest()[:12]
+        db_execute(conn, cur, name, statement, params)
+        return [{c: _db_value(v) for c, v in zip(columns, row)} for row in cur.fetchall()]
+
+def db_insert_history(claims, rows):
+    """Insert history rows in one transaction; existing ids are skipped (idempotent replays)."""
+    columns = HISTORY_COLUMNS
+    statement = (f"INSERT INTO history ({', '.join(chr(34) + c + chr(34) for c in columns)}) "
+                 f"VALUES ({', '.join(f'${i}' for i in range(1, len(columns) + 1))}) ON CONFLICT (id) DO NOTHING")
+    params = [[Json(r.get(c)) if isinstance(r.get(c), (list, dict)) else r.get(c) for c in columns] for r in rows]
+    with db_transaction(claims) as (conn, cur):
+        db_execute(conn, cur, "history_insert", statement, params, many=True)
+
+def db_delete_user_data(user_id):
+    """Account deletion: the user's rows in every app table, in one transaction."""
+    with db_transaction() as (conn, cur):
+        for table in ("profiles", "history", "medications"):
+            db_execute(conn, cur, f"delete_{table}", f"DELETE FROM {table} WHERE user_id = $1", [user_id])
+
 # --- Helpers ---
+@timed("profile_context")
 def build_profile_context(profile_json):
     try:
         profile = json.loads(profile_json) if isinstance(profile_json, str) else (profile_json or {})
@@ -125,85 +844,498 @@ def build_profile_context(profile_json):
         return "**User's Health Profile Context:** No specific health profile provided by the user."
     return "\n".join(lines)
 
-def generate_openai_response(user_input_text, language, profile_context, prompt_type="symptoms"):
-    health_metric_context = """
-    Normal Ranges for reference (use only if explicitly mentioned, otherwise ignore):
-    - Blood Sugar (Fasting): 70-100 mg/dL (or 3.9-5.6 mmol/L). Below 70 mg/dL is Hypoglycemia (low). Above 125 mg/dL is Hyperglycemia (high).
-    - Blood Pressure: Systolic < 120 mmHg, Diastolic < 80 mmHg.
-    - Temperature: Oral ~98.6°F (37°C). Fever generally >100.4°F (38°C).
-    """
+# --- AI response cache ---
+class TTLCache:
+    """Thread-safe in-process LRU with a per-entry TTL."""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at <= time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (value, time.time() + (self.ttl if ttl is None else ttl))
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+class SqliteCache:
+    """Shared key/value store with TTL. A local stand-in for Redis/Memcached
+    that every gunicorn worker on the host can read and write."""
+
+    def __init__(self, path, ttl, prune_interval=60):
+        self.path = path
+        self.ttl = ttl
+        self.prune_interval = prune_interval
+        self._next_prune = 0.0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_expires_at ON cache (expires_at)")
+        self._conn.commit()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM cache WHERE key = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, now + (self.ttl if ttl is None else ttl)),
+            )
+            # reads skip expired rows anyway; sweeping them on every write only adds lock time
+            if now >= self._next_prune:
+                self._conn.execute("DELETE FROM cache WHERE expires_at <= ?", (now,))
+                self._next_prune = now + self.prune_interval
+            self._conn.commit()
+
+    def prune(self):
+        """Delete every expired row now; returns how many went."""
+        now = time.time()
+        with self._lock:
+            cur = self._conn.execute("DELETE FROM cache WHERE expires_at <= ?", (now,))
+            self._conn.commit()
+            self._next_prune = now + self.prune_interval
+            return cur.rowcount
+
+    def add(self, key, value, ttl=None):
+        """Set `key` only if it is absent or expired; True if this call set it."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("DELETE FROM cache WHERE key = ? AND expires_at <= ?", (key, now))
+            cur = self._conn.execute(
+                "INSERT OR IGNORE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, now + (self.ttl if ttl is None else ttl)),
+            )
+            self._conn.commit()
+            return cur.rowcount == 1
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            self._conn.commit()
+
+class ResponseCache:
+    """In-process LRU in front of an optional shared backend."""
+
+    def __init__(self, local, shared=None, name="cache", ttl=None):
+        self.local = local
+        self.shared = shared
+        self.name = name
+        self.ttl = ttl  # for the shared backend; None uses its default
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is None and self.shared is not None:
+            try:
+                value = self.shared.get(key)
+            except Exception as e:
+                logger.warning(f"Shared {self.name} read failed: {e}")
+                value = None
+            if value is not None:
+                self.local.set(key, value)
+        bump(f"{self.name}_hits" if value is not None else f"{self.name}_misses")
+        return value
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        if self.shared is not None:
+            try:
+                self.shared.set(key, value, ttl=self.ttl)
+            except Exception as e:
+                logger.warning(f"Shared {self.name} write failed: {e}")
+
+def _build_ai_cache():
+    shared = None
+    if AI_CACHE_BACKEND == "sqlite":
+        try:
+            shared = SqliteCache(AI_CACHE_SQLITE_PATH, AI_CACHE_TTL, AI_CACHE_PRUNE_INTERVAL)
+        except Exception as e:
+            logger.warning(f"SQLite AI cache unavailable ({e}); using in-process cache only.")
+    return ResponseCache(TTLCache(AI_CACHE_MAX_ENTRIES, AI_CACHE_TTL), shared, name="ai_cache")
+
+ai_cache = _build_ai_cache()
+
+class SingleFlight:
+    """Collapse concurrent calls with the same key: the first caller runs `fn`,
+    later ones wait for its result (or its exception) instead of repeating it."""
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {"done": threading.Event(), "result": None, "error": None}
+        if not leader:
+            bump(f"{self.name}_coalesced")
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+        try:
+            call["result"] = fn()
+            return call["result"]
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call["done"].set()
+
+    def __len__(self):
+        return len(self._calls)
+
+openai_flight = SingleFlight("openai_singleflight")
+doctors_flight = SingleFlight("doctors_singleflight")
+
+def shared_flight(key, fn, name="openai_singleflight"):
+    """Cross-worker singleflight over the sqlite AI cache: whoever takes the lease
+    runs `fn` (which stores its result under `key`); the others poll for that
+    result until the lease is released or expires, then run `fn` themselves."""
+    store = ai_cache.shared
+    if store is None or not SINGLEFLIGHT_SHARED:
+        return fn()
+    lease = "lease:" + key
+    deadline = time.time() + SINGLEFLIGHT_LEASE_TTL
+    try:
+        while not store.add(lease, str(os.getpid()), ttl=SINGLEFLIGHT_LEASE_TTL):
+            time.sleep(SINGLEFLIGHT_POLL_INTERVAL)
+            value = store.get(key)
+            if value is not None:
+                bump(f"{name}_coalesced_shared")
+                return value
+            if time.time() >= deadline:
+                return fn()
+    except Exception as e:
+        logger.warning(f"Singleflight lease unavailable ({e}); calling upstream directly.")
+        return fn()
+    try:
+        return fn()
+    finally:
+        try:
+            store.delete(lease)
+        except Exception as e:
+            logger.warning(f"Singleflight lease release failed: {e}")
+
+# --- Idempotency-Key ---
+# Completed replies live in their own LRU and, with the sqlite backend, in the shared file
+# so a retry that lands on another worker is replayed too.
+idempotency_cache = ResponseCache(TTLCache(IDEMPOTENCY_MAX_ENTRIES, IDEMPOTENCY_TTL), ai_cache.shared,
+                                  name="idempotency", ttl=IDEMPOTENCY_TTL)
+idempotency_flight = SingleFlight("idempotency")
+
+def idempotent(f):
+    """Honour `Idempotency-Key` on a POST route: the first request runs, its reply
+    (anything but a 5xx) is stored and replayed for repeats of the same key, and
+    repeats that arrive while it runs wait for it. Reusing a key with a different
+    body is a 422. Streamed (SSE) replies are not stored."""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        key = request.headers.get("Idempotency-Key", "").strip()
+        if not key or "text/event-stream" in request.headers.get("Accept", ""):
+            return f(*args, **kwargs)
+        if len(key) > 255:
+            return jsonify({"error": "Idempotency-Key too long"}), 400
+        # keys are scoped to the endpoint and the caller's credentials
+        scope = "\n".join((request.path, request.headers.get("Authorization", ""),
+                           request.headers.get("X-Supabase-Auth", ""), key))
+        store_key = "idem:" + hashlib.sha256(scope.encode("utf-8")).hexdigest()
+        fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+        ran = []
+
+        def run():
+            stored = idempotency_cache.get(store_key)
+            if stored is not None:
+                return stored
+            ran.append(True)
+            resp = make_response(f(*args, **kwargs))
+            record = json.dumps({
+                "status": resp.status_code,
+                "body": resp.get_data(as_text=True),
+                "mimetype": resp.mimetype,
+                "fingerprint": fingerprint,
+            })
+            if resp.status_code < 500:
+                idempotency_cache.set(store_key, record)
+            return record
+
+        stored = idempotency_cache.get(store_key)
+        if stored is None:
+            stored = idempotency_flight.do(store_key, lambda: shared_flight(store_key, run, name="idempotency"))
+        record = json.loads(stored)
+        if record["fingerprint"] != fingerprint:
+            return jsonify({"error": "Idempotency-Key was already used with a different request body"}), 422
+        resp = Response(record["body"], status=record["status"], mimetype=record["mimetype"])
+        if not ran:
+            bump("idempotency_replays")
+            resp.headers["Idempotent-Replayed"] = "true"
+        return resp
+    return decorated
+
+def _normalize_for_key(value):
+    return " ".join(str(value or "").split()).lower()
+
+def ai_cache_key(prompt_type, language, profile_context, user_input_text):
+    material = json.dumps(
+        [PROMPT_ID, prompt_type, _normalize_for_key(language), _normalize_for_key(profile_context), _normalize_for_key(user_input_text)],
+        ensure_ascii=False,
+    )
+    return "ai:" + hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+def cache_bypassed():
+    """Per-request opt-out: `X-Cache-Bypass: 1` or `Cache-Control: no-cache`."""
+    if not has_request_context():
+        return False
+    if request.headers.get("X-Cache-Bypass", "").lower() in ("1", "true", "yes"):
+        return True
+    return "no-cache" in request.headers.get("Cache-Control", "").lower()
+
+@timed("openai")
+def generate_openai_response(user_input_text, language, profile_context, prompt_type="symptoms", use_cache=None):
+    if use_cache is None:
+        use_cache = not cache_bypassed()
+    cache_key = ai_cache_key(prompt_type, language, profile_context, user_input_text)
+    if use_cache and AI_CACHE_TTL > 0:
+        cached = ai_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    def call():
+        reply = _call_openai_analysis(user_input_text, language, profile_context, prompt_type)
+        if reply and AI_CACHE_TTL > 0:
+            ai_cache.set(cache_key, reply)
+        return reply
+
+    if not use_cache:
+        return call()  # a bypass asks for a fresh answer, so it doesn't join another caller's
+    return openai_flight.do(cache_key, lambda: shared_flight(cache_key, call))
+
+# --- Analysis prompt ---
+# The system message is the same for every request and is built once here:
+# persona, rules, reference ranges and the response schema. The per-request
+# profile and input go last, in the user message, so OpenAI's prompt cache
+# can reuse the prefix (it caches exact prefixes of 1024+ tokens). Bump
+# PROMPT_VERSION when editing anything below; it's part of the AI cache key.
+PROMPT_VERSION = "3"
+
+DISCLAIMER = (
+    "Disclaimer: I am a virtual AI assistant and not a medical doctor. This information is for educational purposes "
+    "only and is not a substitute for professional medical advice. Always consult a qualified healthcare provider "
+    "for diagnosis and treatment."
+)
+
+# (key, what goes in it), in the order the model should write them
+ANALYSIS_SCHEMA = (
+    ("detected_condition", "the most likely condition or finding, in plain words; say 'unclear' if it is"),
+    ("medical_analysis", "what the input suggests and why, explaining any values as low/normal/high"),
+    ("why_happening_explanation", "possible reasons this may be happening, tied to the user's profile where relevant"),
+    ("immediate_action", "what the user could consider doing now, and when to seek care"),
+    ("nurse_tips", "practical self-care tips a nurse might share"),
+    ("remedies", "gentle home remedies or lifestyle suggestions"),
+    ("medications", "array of {name, dose, time}; generic OTC options only, or an empty array"),
+    ("urgency", "one of Low, Moderate, High, Emergency"),
+    ("suggested_doctor", "the kind of clinician to see, e.g. 'General Practitioner' or 'Endocrinologist'"),
+    ("nursing_explanation", "a short, reassuring explanation in a nurse's voice"),
+    ("personal_notes", "notes specific to the user's conditions, allergies, medications, age or lifestyle"),
+    ("relevant_information", "other context worth knowing, such as related conditions or tests to ask about"),
+    ("hipaa_disclaimer", "the exact disclaimer above"),
+    ("citations", "array of {title, url} from reputable public health sources"),
+    ("history_summary", "up to 3 short bullets summarising this analysis for the user's history"),
+)
+
+def _reference_ranges():
+    lines = [
+        "- Blood Sugar (Fasting): 70-100 mg/dL (or 3.9-5.6 mmol/L). Below 70 mg/dL is Hypoglycemia (low). Above 125 mg/dL is Hyperglycemia (high).",
+        "- Blood Pressure: Systolic < 120 mmHg, Diastolic < 80 mmHg.",
+        "- Temperature: Oral ~98.6°F (37°C). Fever generally >100.4°F (38°C).",
+    ]
+    for synonyms, ranges in lab_values.ANALYTES.values():
+        shown = "; ".join(f"{low_high} {unit}".strip() for unit, low_high in ranges.items())
+        lines.append(f"- {synonyms[0]}: {shown}")
+    return "\n".join(lines)
+
+ANALYSIS_SYSTEM_PROMPT = f"""You are a careful, empathetic health educator. Do NOT diagnose or prescribe. \
+Frame all outputs as suggestions for self-care and information the user may discuss with a clinician. \
+Use language like 'may', 'could', 'consider', 'it might help to'. \
+Avoid imperatives such as 'take', 'start', 'stop', 'must'. \
+Do not name prescription-only drugs. OTC mentions must be generic and followed by \
+'ask a pharmacist or clinician if appropriate for you'. \
+Incorporate the user's profile (conditions, allergies, current medications, age, lifestyle) to tailor gentle suggestions, \
+including potential reasons something may be happening. \
+Be concise but a bit more elaborative than bullet points—2–4 short sentences per section is fine. \
+Return exactly the requested JSON keys.
 
-    system_prompt = f"""
 You are a highly knowledgeable, empathetic, and responsible virtual health assistant. Your role is to act as a compassionate nurse or health educator.
 Always speak simply for a layperson. Start with this disclaimer:
 
-Disclaimer: I am a virtual AI assistant and not a medical doctor. This information is for educational purposes only and is not a substitute for professional medical advice. Always consult a qualified healthcare provider for diagnosis and treatment.
+{DISCLAIMER}
 
-{health_metric_context}
-
---- User's Health Profile ---
-{profile_context}
+--- Reference Ranges ---
+Typical adult ranges for reference (use only for values the user actually gives, otherwise ignore; a range printed on the user's report takes precedence):
+{_reference_ranges()}
 
 --- Task Instructions ---
+The user message holds the user's health profile followed by their input: symptoms, a description of a photo, \
+lab report text, a table of lab results already parsed and flagged against reference ranges, or the findings \
+of a long lab report condensed part by part.
 Provide a structured analysis tailored to the user's profile. Be explicit when values are low/normal/high.
 Return a single JSON object with keys:
-1) detected_condition
-2) medical_analysis
-3) why_happening_explanation
-4) immediate_action
-5) nurse_tips
-6) remedies
-7) medications  # array of {{name, dose, time}}
-8) urgency
-9) suggested_doctor
-10) nursing_explanation
-11) personal_notes
-12) relevant_information
-13) hipaa_disclaimer (exact disclaimer above)
-14) citations  # array of {{title, url}}
-15) history_summary # up to 3 bullets
-"""
-
-    if prompt_type == "symptoms":
-        user_content = f'Symptoms: "{user_input_text}"'
-    elif prompt_type == "photo_analysis":
-        user_content = f'Image shows: "{user_input_text}"'
-    elif prompt_type == "lab_report":
-        user_content = f'Lab Report Text: "{user_input_text}"'
-    else:
-        user_content = f'Input: "{user_input_text}"'
-
-    full_user_message = system_prompt + f"\n--- User's Input ---\n{user_content}"
-
+""" + "\n".join(f"{i}) {key}: {desc}" for i, (key, desc) in enumerate(ANALYSIS_SCHEMA, 1))
+
+PROMPT_ID = f"analysis-v{PROMPT_VERSION}-{hashlib.sha256(ANALYSIS_SYSTEM_PROMPT.encode('utf-8')).hexdigest()[:10]}"
+
+# prompt_type -> how the input is labelled in the user message
+INPUT_LABELS = {
+    "symptoms": 'Symptoms: "{}"',
+    "photo_analysis": 'Image shows: "{}"',
+    "lab_report": 'Lab Report Text: "{}"',
+    "lab_values": "Lab Results (parsed from the report; flags computed from the reference ranges):\n{}",
+    "lab_findings": "Lab Report Findings (a long report, condensed part by part; values copied from the report):\n{}",
+}
+
+def build_analysis_messages(user_input_text, language, profile_context, prompt_type="symptoms"):
+    label = INPUT_LABELS.get(prompt_type, 'Input: "{}"')
+    return [
+        {"role": "system", "content": ANALYSIS_SYSTEM_PROMPT},
+        {"role": "user", "content": f"--- User's Health Profile ---\n{profile_context}\n\n--- User's Input ---\n{label.format(user_input_text)}"},
+    ]
+
+def _call_openai_analysis(user_input_text, language, profile_context, prompt_type="symptoms"):
     try:
-        resp = client.chat.completions.create(
-    model="gpt-4o-mini",
-            temperature=0.4,
-            response_format={"type": "json_object"},
-            messages=[
-                 {
-        "role": "system",
-        "content": (
-            "You are a careful, empathetic health educator. Do NOT diagnose or prescribe. "
-            "Frame all outputs as suggestions for self-care and information the user may discuss with a clinician. "
-            "Use language like 'may', 'could', 'consider', 'it might help to'. "
-            "Avoid imperatives such as 'take', 'start', 'stop', 'must'. "
-            "Do not name prescription-only drugs. OTC mentions must be generic and followed by "
-            "'ask a pharmacist or clinician if appropriate for you'. "
-            "Incorporate the user's profile (conditions, allergies, current medications, age, lifestyle) to tailor gentle suggestions, "
-            "including potential reasons something may be happening. "
-            "Be concise but a bit more elaborative than bullet points—2–4 short sentences per section is fine. "
-            "Return exactly the requested JSON keys."
-        ),
-    },
-    {"role": "user", "content": full_user_message},
-            ],
-        )
+        start = time.perf_counter()
+        with upstream_call("openai"):
+            resp = openai_call(
+                client.chat.completions.create,
+                model="gpt-4o-mini",
+                temperature=0.4,
+                response_format={"type": "json_object"},
+                messages=build_analysis_messages(user_input_text, language, profile_context, prompt_type),
+                extra_body={"prompt_cache_key": PROMPT_ID},
+            )
+        record_openai_usage(resp.usage, prompt_type, time.perf_counter() - start)
         return resp.choices[0].message.content
+    except OpenAIUnavailable:
+        return None  # counted as openai_breaker_rejected
     except Exception as e:
         logger.error(f"OpenAI error in generate_openai_response: {e}")
         return None
 
+def stream_openai_response(user_input_text, language, profile_context, prompt_type="symptoms"):
+    """Yield content deltas of the analysis completion as they arrive.
+    Raises on upstream errors; callers turn that into an SSE error event. Only
+    opening the stream is retried; once deltas flow, a failure ends it."""
+    start = time.perf_counter()
+    with upstream_call("openai"):
+        stream = openai_call(
+            client.chat.completions.create,
+            model="gpt-4o-mini",
+            temperature=0.4,
+            response_format={"type": "json_object"},
+            messages=build_analysis_messages(user_input_text, language, profile_context, prompt_type),
+            stream=True,
+            stream_options={"include_usage": True},
+            extra_body={"prompt_cache_key": PROMPT_ID},
+        )
+        for chunk in stream:
+            if getattr(chunk, "usage", None) is not None:
+                record_openai_usage(chunk.usage, prompt_type, time.perf_counter() - start)
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+
+class JsonFieldStream:
+    """Incrementally scans a streamed JSON object and reports each top-level
+    member as soon as its value is complete."""
+
+    def __init__(self):
+        self.buf = ""
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.member_start = None
+
+    def feed(self, text):
+        self.buf += text
+        fields = []
+        while self.pos < len(self.buf):
+            ch = self.buf[self.pos]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = True
+            elif ch in "{[":
+                self.depth += 1
+                if self.depth == 1 and ch == "{":
+                    self.member_start = self.pos + 1
+            elif ch in "}]":
+                if self.depth == 1:
+                    fields.extend(self._close_member())
+                    self.member_start = None
+                self.depth -= 1
+            elif ch == "," and self.depth == 1:
+                fields.extend(self._close_member())
+                self.member_start = self.pos + 1
+            self.pos += 1
+        return fields
+
+    def _close_member(self):
+        if self.member_start is None:
+            return []
+        segment = self.buf[self.member_start:self.pos]
+        if not segment.strip():
+            return []
+        try:
+            return list(json.loads("{" + segment + "}").items())
+        except ValueError:
+            return []
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@timed("parse_json")
 def parse_openai_json(reply: str) -> dict:
     try:
         match = re.search(r"```json\s*(\{.*?\})\s*```", reply, re.DOTALL)
@@ -279,108 +1411,651 @@ def parse_openai_json(reply: str) -> dict:
         }
 
 # --- Google helpers ---
-def get_nearby_doctors(specialty, location):
-    if not GOOGLE_API_KEY:
-        logger.error("GOOGLE_API_KEY not set.")
-        return []
+_GEOHASH_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+def geohash_encode(lat, lng, precision=DOCTORS_GEOHASH_PRECISION):
+    lat_lo, lat_hi, lng_lo, lng_hi = -90.0, 90.0, -180.0, 180.0
+    chars, bits, ch, even = [], 0, 0, True
+    while len(chars) < precision:
+        if even:
+            mid = (lng_lo + lng_hi) / 2
+            ch = (ch << 1) | (lng >= mid)
+            lng_lo, lng_hi = (mid, lng_hi) if lng >= mid else (lng_lo, mid)
+        else:
+            mid = (lat_lo + lat_hi) / 2
+            ch = (ch << 1) | (lat >= mid)
+            lat_lo, lat_hi = (mid, lat_hi) if lat >= mid else (lat_lo, mid)
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(_GEOHASH_BASE32[ch])
+            bits, ch = 0, 0
+    return "".join(chars)
+
+def geohash_center(geohash):
+    lat_lo, lat_hi, lng_lo, lng_hi = -90.0, 90.0, -180.0, 180.0
+    even = True
+    for c in geohash:
+        idx = _GEOHASH_BASE32.index(c)
+        for shift in range(4, -1, -1):
+            bit = (idx >> shift) & 1
+            if even:
+                mid = (lng_lo + lng_hi) / 2
+                lng_lo, lng_hi = (mid, lng_hi) if bit else (lng_lo, mid)
+            else:
+                mid = (lat_lo + lat_hi) / 2
+                lat_lo, lat_hi = (mid, lat_hi) if bit else (lat_lo, mid)
+            even = not even
+    return (lat_lo + lat_hi) / 2, (lng_lo + lng_hi) / 2
+
+def _parse_location(location):
     try:
         if isinstance(location, dict):
             lat, lng = location.get("lat"), location.get("lng")
             if lat is None or lng is None:
-                return []
-            location_str = f"{lat},{lng}"
-        elif isinstance(location, str) and "," in location:
-            location_str = location
-        else:
-            return []
+                return None
+            return float(lat), float(lng)
+        if isinstance(location, str) and "," in location:
+            lat, lng = location.split(",", 1)
+            return float(lat), float(lng)
+    except (TypeError, ValueError):
+        return None
+    return None
 
-        url = "https://maps.googleapis.com/maps/api/place/nearbysearch/json"
-        params = {
-            "keyword": f"{specialty} doctor",
-            "location": location_str,
-            "radius": 10000,
-            "type": "doctor",
-            "key": GOOGLE_API_KEY,
-            "rankby": "prominence",
-        }
-        r = requests.get(url, params=params, timeout=20)
-        r.raise_for_status()
-        results = r.json().get("results", [])
-        filtered = [p for p in results if p.get("rating") is not None]
-        sorted_results = sorted(
-            filtered,
-            key=lambda x: (
-                x.get("rating", 0),
-                x.get("opening_hours", {}).get("open_now", False) if isinstance(x.get("opening_hours"), dict) else False,
-            ),
-            reverse=True,
-        )
-        out = []
-        for place in sorted_results[:5]:
-            name = place.get("name", "")
-            vicinity = place.get("vicinity", "")
-            q = requests.utils.quote(f"{name}, {vicinity}")
-            maps_link = f"https://www.google.com/maps/search/?api=1&query={q}&query_place_id={place.get('place_id')}"
-            out.append(
-                {
-                    "name": name,
-                    "address": vicinity,
-                    "rating": place.get("rating"),
-                    "open_now": place.get("opening_hours", {}).get("open_now", False),
-                    "phone": place.get("international_phone_number"),  # often not present in Nearby Search
-                    "maps_link": maps_link,
-                }
-            )
-        return out
-    except Exception as e:
-        logger.error(f"Places API error: {e}")
-        return []
+# key -> (doctors, fetched_at); entries live for the fresh window plus the stale-while-revalidate window
+doctors_cache = TTLCache(DOCTORS_CACHE_MAX_ENTRIES, DOCTORS_CACHE_TTL + DOCTORS_CACHE_STALE_TTL)
+_doctors_refreshing = set()
+_doctors_refreshing_lock = threading.Lock()
 
-def get_image_labels(base64_image):
-    if not GOOGLE_VISION_API_KEY:
-        logger.error("GOOGLE_VISION_API_KEY not set.")
+def doctors_lookup_plan(specialty, location):
+    """(cache key, query specialty, tile-centre "lat,lng") for a lookup, or None if the location is unusable."""
+    coords = _parse_location(location)
+    if coords is None:
+        return None
+    # nearby users share a tile; the query is issued from the tile centre so the cached list is the same for all of them
+    query_specialty = canonical_specialty(specialty) or _normalize_for_key(specialty) or "general"
+    tile = geohash_encode(*coords)
+    location_str = "{:.6f},{:.6f}".format(*geohash_center(tile))
+    return f"{query_specialty}:{tile}", query_specialty, location_str
+
+def doctors_for_cache(doctors):
+    """Places results as cached: `open_now` is only true at fetch time and a cached list is
+    served for up to DOCTORS_CACHE_TTL + DOCTORS_CACHE_STALE_TTL, so it is dropped."""
+    return [{k: v for k, v in d.items() if k != "open_now"} for d in doctors]
+
+def cached_doctors(key, query_specialty, location_str):
+    entry = doctors_cache.get(key)
+    if entry is None:
+        bump("doctors_cache_misses")
+        return None
+    doctors, fetched_at = entry
+    if time.time() - fetched_at < DOCTORS_CACHE_TTL:
+        bump("doctors_cache_hits")
+    else:
+        bump("doctors_cache_stale_hits")
+        _schedule_doctors_refresh(key, query_specialty, location_str)
+    return doctors
+
+@timed("places")
+def get_nearby_doctors(specialty, location):
+    if not GOOGLE_API_KEY:
+        logger.error("GOOGLE_API_KEY not set.")
         return []
+    plan = doctors_lookup_plan(specialty, location)
+    if plan is None:
+        return []
+    key, query_specialty, location_str = plan
+    doctors = cached_doctors(key, query_specialty, location_str)
+    if doctors is not None:
+        return doctors
+
+    def fetch():
+        doctors = _fetch_nearby_doctors(query_specialty, location_str)
+        doctors_cache.set(key, (doctors_for_cache(doctors), time.time()))
+        return doctors
+
     try:
-        url = f"https://vision.googleapis.com/v1/images:annotate?key={GOOGLE_VISION_API_KEY}"
-        body = {
-            "requests": [
-                {"image": {"content": base64_image}, "features": [{"type": "LABEL_DETECTION", "maxResults": 10}]}
-            ]
-        }
-        res = requests.post(url, json=body, timeout=30)
-        res.raise_for_status()
-        labels = [
-            l["description"]
-            for l in res.json().get("responses", [{}])[0].get("labelAnnotations", [])  # type: ignore[index]
-        ]
-        return labels
+        return doctors_flight.do(key, fetch)
     except Exception as e:
-        logger.error(f"Vision label error: {e}")
+        logger.error(f"Places API error: {e}")
         return []
 
-def get_image_text(base64_image):
+def _schedule_doctors_refresh(key, specialty, location_str):
+    with _doctors_refreshing_lock:
+        if key in _doctors_refreshing:
+            return
+        _doctors_refreshing.add(key)
+
+    def refresh():
+        try:
+            doctors_cache.set(key, (doctors_for_cache(_fetch_nearby_doctors(specialty, location_str)), time.time()))
+        except Exception as e:
+            logger.warning(f"Places background refresh failed for {key}: {e}")
+        finally:
+            with _doctors_refreshing_lock:
+                _doctors_refreshing.discard(key)
+
+    _background_pool.submit(refresh)
+
+def places_request(specialty, location_str):
+    url = GOOGLE_PLACES_URL
+    params = {
+        "keyword": f"{specialty} doctor",
+        "location": location_str,
+        "radius": 10000,
+        "type": "doctor",
+        "key": GOOGLE_API_KEY,
+        "rankby": "prominence",
+    }
+    return url, params
+
+def places_response_to_doctors(payload):
+    results = payload.get("results", [])
+    filtered = [p for p in results if p.get("rating") is not None]
+    # by rating only (Places prominence breaks ties): the list is cached, open_now is not
+    sorted_results = sorted(filtered, key=lambda x: x.get("rating", 0), reverse=True)
+    out = []
+    for place in sorted_results[:5]:
+        name = place.get("name", "")
+        vicinity = place.get("vicinity", "")
+        q = requests.utils.quote(f"{name}, {vicinity}")
+        maps_link = f"https://www.google.com/maps/search/?api=1&query={q}&query_place_id={place.get('place_id')}"
+        out.append(
+            {
+                "name": name,
+                "address": vicinity,
+                "rating": place.get("rating"),
+                "open_now": place.get("opening_hours", {}).get("open_now", False),
+                "phone": place.get("international_phone_number"),  # often not present in Nearby Search
+                "maps_link": maps_link,
+            }
+        )
+    return out
+
+def _fetch_nearby_doctors(specialty, location_str):
+    url, params = places_request(specialty, location_str)
+    with upstream_call("google_places"):
+        r = http_session("google_places").get(url, params=params, timeout=20)
+    r.raise_for_status()
+    return places_response_to_doctors(r.json())
+
+def vision_image_content(image):
+    """Vision wants base64 in the JSON body; uploads arrive as bytes and are encoded here, once."""
+    return image if isinstance(image, str) else base64.b64encode(image).decode("ascii")
+
+def _encode_image(img):
+    buf = io.BytesIO()
+    if VISION_IMAGE_FORMAT == "WEBP":
+        img.save(buf, "WEBP", quality=VISION_IMAGE_QUALITY, method=4)
+    else:
+        img.save(buf, "JPEG", quality=VISION_IMAGE_QUALITY, optimize=True)
+    return buf.getvalue()
+
+@timed("image_preprocess")
+def preprocess_image(raw, max_edges):
+    """Decode `raw` once and return one re-encoded image per entry in `max_edges`,
+    upright and with its longest side capped. An entry keeps the original bytes
+    when re-encoding would not make it smaller, or when the image can't be decoded."""
+    try:
+        img = Image.open(io.BytesIO(raw))
+        original_edge = max(img.size)
+        upright = img.getexif().get(0x0112, 1) == 1
+        if img.format == "JPEG":
+            img.draft("RGB", (max(max_edges),) * 2)  # let libjpeg decode at a reduced scale
+        img = ImageOps.exif_transpose(img)
+        if img.mode in ("RGBA", "LA", "P"):
+            img = img.convert("RGBA")
+            background = Image.new("RGB", img.size, "white")
+            background.paste(img, mask=img.getchannel("A"))
+            img = background
+        elif img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+    except Exception as e:
+        logger.warning(f"Image preprocessing skipped: {e}")
+        return [raw for _ in max_edges]
+
+    by_edge = {}
+    # largest first, each size scaled down from the previous one rather than the full decode
+    for edge in sorted({min(e, max(img.size)) for e in max_edges}, reverse=True):
+        if max(img.size) > edge:
+            img = img.copy()
+            img.thumbnail((edge, edge), Image.LANCZOS)
+        encoded = _encode_image(img)
+        if len(encoded) >= len(raw) and upright and original_edge <= edge:
+            encoded = raw
+        by_edge[edge] = encoded
+    out = [by_edge[min(e, max(by_edge))] for e in max_edges]
+    bump("vision_image_bytes_in", len(raw))
+    bump("vision_image_bytes_out", sum(len(b) for b in by_edge.values()))
+    return out
+
+def vision_annotate_request(image, labels=True, text=True, document=False):
+    """(url, body) for one images:annotate call, or None when no feature is requested.
+
+    `image` is raw bytes or base64. With IMAGE_PREPROCESS, labels and OCR each
+    get their own downscaled copy (two entries in the same batch call) when
+    their edge limits differ.
+    """
+    label_feature = {"type": "LABEL_DETECTION", "maxResults": 10}
+    text_feature = {"type": "DOCUMENT_TEXT_DETECTION" if document else "TEXT_DETECTION"}
+    wanted = [(f, edge) for f, edge, on in ((label_feature, VISION_LABEL_MAX_EDGE, labels),
+                                            (text_feature, VISION_OCR_MAX_EDGE, text)) if on]
+    if not wanted:
+        return None
+    url = f"{GOOGLE_VISION_URL}?key={GOOGLE_VISION_API_KEY}"
+    if not IMAGE_PREPROCESS:
+        return url, {"requests": [{"image": {"content": vision_image_content(image)}, "features": [f for f, _ in wanted]}]}
+
+    raw = image if isinstance(image, bytes) else decode_base64_upload(image)
+    edges = sorted({edge for _, edge in wanted}, reverse=True)
+    entries = {}  # one entry per distinct image; a small photo serves labels and OCR alike
+    for edge, content in zip(edges, preprocess_image(raw, edges)):
+        entry = entries.setdefault(id(content), {"image": {"content": vision_image_content(content)}, "features": []})
+        entry["features"] += [f for f, e in wanted if e == edge]
+    return url, {"requests": list(entries.values())}
+
+def vision_response_to_annotations(payload):
+    labels, text = [], ""
+    for annotations in payload.get("responses", [{}]):
+        if "error" in annotations:
+            logger.error(f"Vision annotate error: {annotations['error']}")
+        labels += [l["description"] for l in annotations.get("labelAnnotations", [])]
+        text = text or annotations.get("fullTextAnnotation", {}).get("text", "")
+    return {"labels": labels, "text": text}
+
+@timed("vision")
+def annotate_image(image, labels=True, text=True, document=False):
+    """One Vision images:annotate round trip for labels and/or OCR.
+    `image` is raw bytes or a base64 string.
+
+    `document=True` swaps TEXT_DETECTION for DOCUMENT_TEXT_DETECTION, which
+    handles dense printed pages (lab reports) better.
+    Returns {"labels": [...], "text": "..."}; empty values on any failure.
+    """
     if not GOOGLE_VISION_API_KEY:
         logger.error("GOOGLE_VISION_API_KEY not set.")
-        return ""
+        return {"labels": [], "text": ""}
+    req = vision_annotate_request(image, labels, text, document)
+    if req is None:
+        return {"labels": [], "text": ""}
     try:
-        url = f"https://vision.googleapis.com/v1/images:annotate?key={GOOGLE_VISION_API_KEY}"
-        body = {
-            "requests": [
-                {"image": {"content": base64_image}, "features": [{"type": "TEXT_DETECTION"}]}
-            ]
-        }
-        res = requests.post(url, json=body, timeout=60)
+        url, body = req
+        with upstream_call("google_vision"):
+            res = http_session("google_vision").post(url, json=body, timeout=60 if text else 30)
         res.raise_for_status()
-        annotations = res.json().get("responses", [{}])[0]
-        return annotations.get("fullTextAnnotation", {}).get("text", "")
+        return vision_response_to_annotations(res.json())
     except Exception as e:
-        logger.error(f"Vision OCR error: {e}")
-        return ""
+        logger.error(f"Vision annotate error: {e}")
+        return {"labels": [], "text": ""}
+
+def get_image_labels(image):
+    return annotate_image(image, labels=True, text=False)["labels"]
+
+def get_image_text(image):
+    return annotate_image(image, labels=False, text=True)["text"]
+
+# --- Photo dedupe cache ---
+@timed("image_fingerprint")
+def image_fingerprint(raw):
+    """(sha256 hex, dHash int or None) for an uploaded image. The dHash is taken
+    on the upright grayscale image shrunk to (IMAGE_HASH_SIZE + 1) x IMAGE_HASH_SIZE,
+    so a re-encoded, resized or EXIF-rotated copy of a photo lands a few bits away."""
+    digest = hashlib.sha256(raw).hexdigest()
+    size = IMAGE_HASH_SIZE
+    try:
+        img = Image.open(io.BytesIO(raw))
+        if img.format == "JPEG":
+            img.draft("L", (size * 8, size * 8))
+        img = ImageOps.exif_transpose(img).convert("L").resize((size + 1, size), Image.BILINEAR)
+    except Exception as e:
+        logger.warning(f"Image fingerprint without dHash: {e}")
+        return digest, None
+    px = img.tobytes()
+    dhash = 0
+    for row in range(size):
+        for col in range(size):
+            i = row * (size + 1) + col
+            dhash = (dhash << 1) | (px[i] > px[i + 1])
+    return digest, dhash
+
+class ImageCache:
+    """In-process LRU of per-image results (one dict of values per image), with a TTL.
+    Lookups try the exact digest first, then the nearest stored dHash within
+    `max_distance` bits."""
+
+    def __init__(self, max_entries, ttl, max_distance):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.bytes = 0  # rough size of the stored values, as JSON
+        self._entries = OrderedDict()  # digest -> {"dhash", "values", "sizes", "bytes", "expires_at"}
+        self._lock = threading.Lock()
+
+    def _find(self, digest, dhash, kind, now):
+        entry = self._entries.get(digest)
+        if entry is not None and entry["expires_at"] > now and kind in entry["values"]:
+            return digest, "exact"
+        if dhash is None or self.max_distance < 0:
+            return None, None
+        best = None
+        for key, entry in self._entries.items():
+            if entry["dhash"] is None or entry["expires_at"] <= now or kind not in entry["values"]:
+                continue
+            distance = (entry["dhash"] ^ dhash).bit_count()
+            if distance <= self.max_distance and (best is None or distance < best[0]):
+                best = (distance, key)
+        return (best[1], "perceptual") if best else (None, None)
+
+    def get(self, fingerprint, kind):
+        digest, dhash = fingerprint
+        with self._lock:
+            key, match = self._find(digest, dhash, kind, time.time())
+            value = None
+            if key is not None:
+                self._entries.move_to_end(key)
+                value = self._entries[key]["values"][kind]
+        bump(f"image_cache_hits_{match}" if match else "image_cache_misses")
+        return value
+
+    def set(self, fingerprint, kind, value):
+        digest, dhash = fingerprint
+        size = len(json.dumps(value, default=str))
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                entry = self._entries[digest] = {"dhash": dhash, "values": {}, "sizes": {}, "bytes": 0}
+            change = size - entry["sizes"].get(kind, 0)  # a rewrite of `kind` replaces its old value
+            entry["bytes"] += change
+            self.bytes += change
+            entry["values"][kind] = value
+            entry["sizes"][kind] = size
+            entry["expires_at"] = time.time() + self.ttl
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_entries:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= evicted["bytes"]
+
+    def __len__(self):
+        return len(self._entries)
+
+image_cache = ImageCache(IMAGE_CACHE_MAX_ENTRIES, IMAGE_CACHE_TTL, IMAGE_HASH_MAX_DISTANCE)
+
+def photo_analysis_kind(profile_context):
+    """Image cache slot for a finished photo analysis; the answer also depends on the profile."""
+    return "analysis:" + hashlib.sha256(profile_context.encode("utf-8")).hexdigest()[:32]
+
+# --- Binary uploads ---
+class UploadError(Exception):
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+def decode_base64_upload(value, what="image"):
+    """Bytes of a base64 upload field (line breaks allowed); UploadError 400 when it isn't base64."""
+    try:
+        return base64.b64decode("".join(str(value).split()), validate=True)
+    except (binascii.Error, ValueError):
+        raise UploadError(f"Invalid {what} data: expected base64", 400)
+
+UPLOAD_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"%PDF-", "application/pdf"),
+)
+
+def sniff_upload_type(head):
+    """Content type from the file's magic bytes; the client's Content-Type is not trusted."""
+    for magic, mime in UPLOAD_SIGNATURES:
+        if head.startswith(magic):
+            return mime
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[4:8] == b"ftyp" and head[8:12] in (b"heic", b"heix", b"heif", b"mif1"):
+        return "image/heic"
+    return None
+
+def _spool_body(stream):
+    spool = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES)
+    size = 0
+    while True:
+        chunk = stream.read(64 * 1024)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > UPLOAD_MAX_BYTES:
+            raise UploadError("Upload too large", 413)
+        spool.write(chunk)
+    spool.seek(0)
+    return spool
+
+def read_analysis_payload(allow_pdf=False):
+    """Request data in the shape the JSON routes use.
+
+    Besides JSON, accepts multipart/form-data (file in "image" or "file", other
+    fields as form values with "profile"/"location" JSON-encoded) and a raw
+    image/* or application/pdf body with fields in the query string. Uploaded
+    bytes land in data["image_bytes"] or data["pdf_bytes"]. Raises UploadError.
+    """
+    mimetype = request.mimetype
+    binary = mimetype.startswith("image/") or mimetype == "application/pdf"
+    if mimetype != "multipart/form-data" and not binary:
+        return request.get_json() or {}
+    if request.content_length and request.content_length > UPLOAD_MAX_BYTES:
+        raise UploadError("Upload too large", 413)
+    try:
+        if binary:
+            fields, stream = request.args, _spool_body(request.stream)
+        else:
+            upload = request.files.get("image") or request.files.get("file")
+            fields, stream = request.form, upload.stream if upload else None
+    except RequestEntityTooLarge:
+        raise UploadError("Upload too large", 413)
+
+    data = {k: fields[k] for k in ("language", "extracted_text") if fields.get(k)}
+    for k in ("profile", "location"):
+        if fields.get(k):
+            try:
+                data[k] = json.loads(fields[k])
+            except ValueError:
+                data[k] = fields[k]  # e.g. location=lat,lng
+    if stream is None:
+        return data
+
+    kind = sniff_upload_type(stream.read(16))
+    stream.seek(0)
+    if kind is None or (kind == "application/pdf" and not allow_pdf):
+        raise UploadError("Unsupported file type", 415)
+    data["pdf_bytes" if kind == "application/pdf" else "image_bytes"] = stream.read()
+    if len(data.get("pdf_bytes") or data["image_bytes"]) > UPLOAD_MAX_BYTES:
+        raise UploadError("Upload too large", 413)
+    bump("uploads_binary")
+    return data
+
+# --- Speculative doctor lookup ---
+# canonical specialty -> (aliases the model uses for it, input keywords that predict it)
+SPECIALTIES = {
+    "cardiologist": (
+        ("cardio", "heart"),
+        ("chest pain", "chest tightness", "palpitation", "heart", "blood pressure", "hypertension", "irregular heartbeat"),
+    ),
+    "dermatologist": (
+        ("dermat", "skin"),
+        ("rash", "skin", "itch", "acne", "eczema", "psoriasis", "mole", "hives", "blister", "lesion"),
+    ),
+    "gastroenterologist": (
+        ("gastro", "digestive", "hepatolog"),
+        ("stomach", "abdominal", "abdomen", "diarrh", "constipat", "vomit", "heartburn", "acid reflux", "bloat", "bowel", "liver"),
+    ),
+    "neurologist": (
+        ("neuro",),
+        ("migraine", "seizure", "numbness", "tingling", "dizz", "vertigo", "tremor", "memory loss", "fainting"),
+    ),
+    "pulmonologist": (
+        ("pulmon", "lung", "respirat"),
+        ("cough", "wheez", "shortness of breath", "short of breath", "asthma", "lung", "sputum"),
+    ),
+    "endocrinologist": (
+        ("endocrin", "diabet", "thyroid"),
+        ("diabet", "blood sugar", "glucose", "thyroid", "insulin", "a1c", "hba1c", "tsh", "cholesterol"),
+    ),
+    "orthopedist": (
+        ("ortho", "bone", "sports medicine"),
+        ("joint pain", "back pain", "knee", "shoulder", "hip pain", "fracture", "sprain", "ankle", "wrist"),
+    ),
+    "ent": (
+        ("ent", "otolaryng", "ear, nose"),
+        ("sore throat", "earache", "ear pain", "ear infection", "sinus", "tonsil", "hearing", "nosebleed", "hoarse"),
+    ),
+    "ophthalmologist": (
+        ("ophthalm", "optometr", "eye"),
+        ("eye", "vision", "blurry", "blurred"),
+    ),
+    "urologist": (
+        ("urolog", "nephrolog", "kidney"),
+        ("urinat", "urine", "kidney stone", "bladder", "prostate", "creatinine"),
+    ),
+    "gynecologist": (
+        ("gynec", "obstet", "ob/gyn", "obgyn", "women"),
+        ("period", "menstrua", "pregnan", "vaginal", "pelvic", "ovar"),
+    ),
+    "psychiatrist": (
+        ("psychiat", "psycholog", "mental health"),
+        ("anxiety", "anxious", "depress", "panic attack", "insomnia", "suicid"),
+    ),
+    "general": (
+        ("general", "family", "primary care", "internal medicine", "internist", "gp", "physician"),
+        (),
+    ),
+}
+
+def _word_prefix_pattern(words):
+    # words match as prefixes ("diabet" -> "diabetes"); short ones like "ent"/"gp" must match whole
+    parts = [re.escape(w) + (r"\b" if len(w) <= 3 else "") for w in words]
+    return re.compile(r"\b(?:" + "|".join(parts) + ")") if parts else None
+
+_SPECIALTY_ALIAS_PATTERNS = {name: _word_prefix_pattern(aliases) for name, (aliases, _) in SPECIALTIES.items()}
+_SPECIALTY_KEYWORD_PATTERNS = {name: _word_prefix_pattern(keywords) for name, (_, keywords) in SPECIALTIES.items()}
+
+def predict_specialty(text):
+    """Cheap keyword vote over the user's input; 'general' when nothing stands out."""
+    lowered = (text or "").lower()
+    best, best_score = "general", 0
+    for name, pattern in _SPECIALTY_KEYWORD_PATTERNS.items():
+        if pattern is None:
+            continue
+        score = len(pattern.findall(lowered))
+        if score > best_score:
+            best, best_score = name, score
+    return best
+
+def canonical_specialty(suggested_doctor):
+    """Map the model's free-text `suggested_doctor` onto a SPECIALTIES key (None if unknown)."""
+    lowered = (suggested_doctor or "").lower()
+    for name, pattern in _SPECIALTY_ALIAS_PATTERNS.items():
+        if pattern.search(lowered):
+            return name
+    return None
+
+def start_doctor_prefetch(text, location):
+    if not (SPECULATIVE_DOCTORS and location):
+        return None
+    specialty = predict_specialty(text)
+    return specialty, _background_pool.submit(get_nearby_doctors, specialty, location)
+
+def resolve_nearby_doctors(prefetch, suggested_doctor, location):
+    """Reuse the speculative lookup if its specialty matches the model's pick,
+    otherwise issue the corrective lookup."""
+    if not location:
+        return []
+    if prefetch is not None:
+        specialty, future = prefetch
+        if canonical_specialty(suggested_doctor) == specialty:
+            bump("doctor_speculation_hits")
+            try:
+                with stage("places_prefetch_wait"):
+                    return future.result(timeout=25)
+            except Exception as e:
+                logger.warning(f"Speculative doctor lookup failed: {e}")
+        else:
+            bump("doctor_speculation_misses")
+            future.cancel()
+    return get_nearby_doctors(suggested_doctor, location)
+
+# --- Red-flag triage ---
+red_flags = triage.RedFlagMatcher()
+lab_red_flags = triage.RedFlagMatcher(triage.LAB_RED_FLAGS)  # lab report text: results the lab marks critical
+
+@timed("triage")
+def red_flag_triage(text, matcher=red_flags):
+    """Emergency block from triage.py for `text`, or None. Microseconds; runs before the LLM."""
+    if not TRIAGE_ENABLED or not text:
+        return None
+    block = matcher.triage(text)
+    bump("triage_checks")
+    if block is not None:
+        bump("triage_flagged")
+        logger.info(f"[TRIAGE] Red flags: {[f['phrase'] for f in block['red_flags']]}")
+    return block
+
+def triage_value(key, value, block):
+    """One field of the LLM analysis with the triage override applied."""
+    if block is None:
+        return value
+    if key == "urgency":
+        return block["urgency"]
+    if key == "immediate_action":
+        return f"{block['immediate_action']}\n\n{value}" if value else block["immediate_action"]
+    return value
+
+def apply_triage(result, block):
+    if block is not None:
+        for key in ("urgency", "immediate_action"):
+            result[key] = triage_value(key, result.get(key), block)
+        result["triage"] = block
+    return result
+
+def triage_fallback(block, error):
+    """What a red-flagged request returns when the LLM analysis fails: the triage
+    block still reaches the user, with the failure noted."""
+    return {"urgency": block["urgency"], "immediate_action": block["immediate_action"], "triage": block,
+            "analysis_error": error, "nearby_doctors": []}
 
 # --- Core routes ---
+def run_symptom_analysis(symptoms, language, profile_context, location, block=None, use_cache=None):
+    """Symptom pipeline shared by /analyze and its background job. Returns (body, status)."""
+    prefetch = start_doctor_prefetch(symptoms, location)
+    ai = generate_openai_response(symptoms, language, profile_context, prompt_type="symptoms", use_cache=use_cache)
+    if not ai:
+        error = "AI analysis failed to generate response from OpenAI"
+        if block is not None:
+            return triage_fallback(block, error), 200
+        return {"error": error}, ai_failure_status()
+
+    result = apply_triage(parse_openai_json(ai), block)
+    result["nearby_doctors"] = resolve_nearby_doctors(prefetch, result.get("suggested_doctor", "general"), location)
+    return result, 200
+
+def submit_symptom_job(symptoms, language, profile_context, location, block):
+    """`Prefer: respond-async` on a red-flagged /analyze: answer with the triage block
+    now and run the LLM analysis as a job (GET /jobs/<id>)."""
+    use_cache = not cache_bypassed()
+    content_hash = hashlib.sha256(json.dumps(["symptoms", symptoms, language, profile_context, location],
+                                             sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    job, _ = lab_jobs.submit(content_hash, lambda: run_symptom_analysis(symptoms, language, profile_context, location, block, use_cache))
+    if job is None:
+        # no room for the job; the triage block is the answer that matters
+        return jsonify(triage_fallback(block, "Analysis queue is full, retry shortly")), 200
+    body = {"urgency": block["urgency"], "immediate_action": block["immediate_action"], "triage": block, "job": job_view(job)}
+    resp = make_response(jsonify(body), 202)
+    resp.headers["Location"] = f"/jobs/{job['id']}"
+    return resp
+
 @app.route("/analyze", methods=["POST"])
 @cross_origin()
 @token_required
+@idempotent
 def analyze_symptoms(current_user=None):
     try:
         data = request.get_json() or {}
@@ -394,19 +2069,90 @@ def analyze_symptoms(current_user=None):
 
         logger.info(f"[ANALYZE] Input: {symptoms}, User ID: {profile_data.get('user_id')}")
         profile_context = build_profile_context(profile_data)
+        block = red_flag_triage(symptoms)
 
-        ai = generate_openai_response(symptoms, language, profile_context, prompt_type="symptoms")
-        if not ai:
-            return jsonify({"error": "AI analysis failed to generate response from OpenAI"}), 500
-
-        result = parse_openai_json(ai)
-        result["nearby_doctors"] = get_nearby_doctors(result.get("suggested_doctor", "general"), location) if location else []
+        if "text/event-stream" in request.headers.get("Accept", ""):
+            return analysis_stream_response(symptoms, language, profile_context, location, block=block)
+        if block is not None and "respond-async" in request.headers.get("Prefer", ""):
+            return submit_symptom_job(symptoms, language, profile_context, location, block)
 
-        return jsonify(result), 200
+        body, status = run_symptom_analysis(symptoms, language, profile_context, location, block)
+        return jsonify(body), status
     except Exception as e:
         logger.exception("Error in /analyze")
         return jsonify({"error": "Failed to analyze symptoms", "details": str(e)}), 500
         
+@app.route("/analyze/stream", methods=["POST"])
+@cross_origin()
+@token_required
+def analyze_symptoms_stream(current_user=None):
+    try:
+        data = request.get_json() or {}
+        symptoms = data.get("symptoms")
+        profile_data = data.get("profile", {})
+        location = data.get("location")
+        language = data.get("language", "English")
+
+        if not symptoms:
+            return jsonify({"error": "Symptoms required"}), 400
+
+        logger.info(f"[ANALYZE/STREAM] Input: {symptoms}, User ID: {profile_data.get('user_id')}")
+        profile_context = build_profile_context(profile_data)
+        return analysis_stream_response(symptoms, language, profile_context, location, block=red_flag_triage(symptoms))
+    except Exception as e:
+        logger.exception("Error in /analyze/stream")
+        return jsonify({"error": "Failed to analyze symptoms", "details": str(e)}), 500
+
+def analysis_stream_response(user_input_text, language, profile_context, location, prompt_type="symptoms", block=None):
+    """SSE variant of the analysis pipeline.
+
+    Events: `start`, `triage` (red-flag block, only when `block` is given),
+    `delta` (raw token text), `field` (one completed top-level key), `result`
+    (full parsed analysis), `nearby_doctors`, `done`; `error` replaces
+    everything after `start`/`triage` if OpenAI fails.
+    """
+    use_cache = not cache_bypassed() and AI_CACHE_TTL > 0
+    cache_key = ai_cache_key(prompt_type, language, profile_context, user_input_text)
+
+    def events():
+        yield sse_event("start", {"prompt_type": prompt_type})
+        if block is not None:
+            yield sse_event("triage", block)
+        prefetch = start_doctor_prefetch(user_input_text, location)
+        cached = ai_cache.get(cache_key) if use_cache else None
+        if cached is not None:
+            result = parse_openai_json(cached)
+            for key, value in result.items():
+                yield sse_event("field", {"key": key, "value": triage_value(key, value, block)})
+        else:
+            scanner = JsonFieldStream()
+            parts = []
+            failed = False
+            try:
+                for delta in stream_openai_response(user_input_text, language, profile_context, prompt_type):
+                    parts.append(delta)
+                    yield sse_event("delta", {"text": delta})
+                    for key, value in scanner.feed(delta):
+                        yield sse_event("field", {"key": key, "value": triage_value(key, value, block)})
+            except Exception as e:
+                logger.error(f"OpenAI error in analysis stream: {e}")
+                failed = True
+            reply = "".join(parts)
+            if failed or not reply:
+                yield sse_event("error", {"error": "AI analysis failed to generate response from OpenAI"})
+                return
+            result = parse_openai_json(reply)
+            if AI_CACHE_TTL > 0:
+                ai_cache.set(cache_key, reply)
+
+        yield sse_event("result", apply_triage(result, block))
+        doctors = resolve_nearby_doctors(prefetch, result.get("suggested_doctor", "general"), location)
+        yield sse_event("nearby_doctors", doctors)
+        yield sse_event("done", {})
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(stream_with_context(events()), mimetype="text/event-stream", headers=headers)
+
 @app.route("/api/doctors", methods=["POST"])
 @cross_origin()
 @token_required
@@ -447,36 +2193,186 @@ def debug_openai():
             "error": str(e)
         }), 500
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    lines = []
+    for histogram in (request_seconds, stage_seconds, upstream_seconds, history_queue_seconds, openai_seconds):
+        lines.extend(histogram.render())
+    with _stats_lock:
+        inflight = dict(_upstream_inflight)
+        tokens = dict(_openai_tokens)
+        counters = dict(_stats)
+
+    lines += ["# HELP askdoc_upstream_inflight Outbound calls currently in flight.", "# TYPE askdoc_upstream_inflight gauge"]
+    lines += [f'askdoc_upstream_inflight{{upstream="{u}"}} {n}' for u, n in sorted(inflight.items())]
+    lines += ["# HELP askdoc_openai_tokens_total OpenAI token usage.", "# TYPE askdoc_openai_tokens_total counter"]
+    lines += [f'askdoc_openai_tokens_total{{prompt_type="{pt}",kind="{kind}"}} {n}' for (pt, kind), n in sorted(tokens.items())]
+    for name, n in sorted(counters.items()):
+        lines += [f"# TYPE askdoc_{name}_total counter", f"askdoc_{name}_total {n}"]
+
+    breaker = openai_breaker.stats()
+    lines += ["# HELP askdoc_openai_breaker_state OpenAI circuit breaker state (1 for the current one).",
+              "# TYPE askdoc_openai_breaker_state gauge"]
+    lines += [f'askdoc_openai_breaker_state{{state="{s}"}} {int(s == breaker["state"])}' for s in CircuitBreaker.STATES]
+    lines += ["# HELP askdoc_openai_breaker_error_rate Failed share of OpenAI attempts in the breaker window.",
+              "# TYPE askdoc_openai_breaker_error_rate gauge", f"askdoc_openai_breaker_error_rate {breaker['error_rate']}"]
+    lines += ["# HELP askdoc_cache_entries Entries held by in-process caches.", "# TYPE askdoc_cache_entries gauge"]
+    lines.append(f'askdoc_cache_entries{{cache="ai"}} {len(ai_cache.local)}')
+    lines.append(f'askdoc_cache_entries{{cache="doctors"}} {len(doctors_cache)}')
+    lines.append(f'askdoc_cache_entries{{cache="image"}} {len(image_cache)}')
+    lines.append(f'askdoc_cache_entries{{cache="history"}} {len(history_cache)}')
+    if _history_queue is not None:
+        queue_stats = _history_queue.stats()
+        lines += ["# HELP askdoc_history_queue_depth History rows waiting to be flushed.", "# TYPE askdoc_history_queue_depth gauge"]
+        lines.append(f"askdoc_history_queue_depth {queue_stats['depth']}")
+        lines += ["# HELP askdoc_history_queue_dead History rows that could not be flushed.", "# TYPE askdoc_history_queue_dead gauge"]
+        lines.append(f"askdoc_history_queue_dead {queue_stats['dead']}")
+    lines += ["# HELP askdoc_image_cache_bytes Approximate size of the photo dedupe cache.", "# TYPE askdoc_image_cache_bytes gauge"]
+    lines.append(f"askdoc_image_cache_bytes {image_cache.bytes}")
+    lines += ["# HELP askdoc_http_pool_in_use Pooled upstream connections checked out.", "# TYPE askdoc_http_pool_in_use gauge"]
+    for upstream, hosts in sorted(http_pool_stats().items()):
+        lines.append(f'askdoc_http_pool_in_use{{upstream="{upstream}"}} {sum(h["in_use"] for h in hosts.values())}')
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+@app.route("/debug/stats", methods=["GET"])
+def debug_stats():
+    with _stats_lock:
+        counters = dict(_stats)
+        tokens = Counter(_openai_tokens)
+    return jsonify({
+        "counters": counters,
+        "ai_cache": {"backend": AI_CACHE_BACKEND, "entries": len(ai_cache.local), "ttl": AI_CACHE_TTL},
+        "doctors_cache": {"entries": len(doctors_cache), "ttl": DOCTORS_CACHE_TTL, "stale_ttl": DOCTORS_CACHE_STALE_TTL},
+        "http_pools": http_pool_stats(),
+        "lab_jobs": {"pending": lab_jobs.pending, "stored": len(lab_jobs.jobs), "workers": LAB_JOB_WORKERS,
+                     "shared": lab_jobs.shared is not None, "worker": worker_tag()},
+        "postgres": db_pool_stats(),
+        "history_queue": dict(history_queue().stats(), mode=HISTORY_WRITE_MODE) if _history_queue is not None else {"mode": HISTORY_WRITE_MODE},
+        "history_cache": {
+            "enabled": HISTORY_CACHE_ENABLED,
+            "users": len(history_cache),
+            "ttl": HISTORY_CACHE_TTL,
+            "hit_rate": _ratio(counters.get("history_cache_hits", 0), counters.get("history_cache_misses", 0)),
+            "not_modified": counters.get("history_not_modified", 0),
+        },
+        "singleflight": {
+            "openai_inflight": len(openai_flight),
+            "doctors_inflight": len(doctors_flight),
+            "openai_coalesced": counters.get("openai_singleflight_coalesced", 0),
+            "openai_coalesced_shared": counters.get("openai_singleflight_coalesced_shared", 0),
+            "doctors_coalesced": counters.get("doctors_singleflight_coalesced", 0),
+        },
+        "image_cache": {
+            "entries": len(image_cache),
+            "approx_bytes": image_cache.bytes,
+            "max_distance": IMAGE_HASH_MAX_DISTANCE,
+            "hit_rate": _ratio(counters.get("image_cache_hits_exact", 0) + counters.get("image_cache_hits_perceptual", 0),
+                               counters.get("image_cache_misses", 0)),
+        },
+        "image_preprocess": {
+            "enabled": IMAGE_PREPROCESS,
+            "bytes_in": counters.get("vision_image_bytes_in", 0),
+            "bytes_out": counters.get("vision_image_bytes_out", 0),
+            "bytes_saved": counters.get("vision_image_bytes_in", 0) - counters.get("vision_image_bytes_out", 0),
+        },
+        "lab_values": {
+            "enabled": LAB_VALUES_ENABLED,
+            "tables": counters.get("lab_values_tables", 0),
+            "raw_fallbacks": counters.get("lab_values_raw_fallbacks", 0),
+            "chars_saved": counters.get("lab_values_chars_saved", 0),
+        },
+        "lab_chunking": {
+            "enabled": LAB_CHUNKING_ENABLED,
+            "threshold_tokens": LAB_CHUNK_THRESHOLD_TOKENS,
+            "exact_token_counts": report_chunks.exact_counts(),
+            "reports": counters.get("lab_chunked_reports", 0),
+            "chunks": counters.get("lab_chunks", 0),
+            "parsed_chunks": counters.get("lab_chunks_parsed", 0),
+            "failed_chunks": counters.get("lab_chunks_failed", 0),
+            "truncated_chunks": counters.get("lab_chunks_truncated", 0),
+        },
+        "prompt": {
+            "id": PROMPT_ID,
+            "prefix_chars": len(ANALYSIS_SYSTEM_PROMPT),
+            "cached_token_ratio": {pt: round(n / tokens[(pt, "prompt")], 3) if tokens[(pt, "prompt")] else 0.0
+                                   for (pt, kind), n in sorted(tokens.items()) if kind == "cached"},
+        },
+        "openai_resilience": {
+            "breaker": dict(openai_breaker.stats(), retry_after=round(openai_breaker.retry_after(), 1),
+                            opened=counters.get("openai_breaker_opened", 0), rejected=counters.get("openai_breaker_rejected", 0)),
+            "retry_budget": openai_retry_budget.stats(),
+            "retries": counters.get("openai_retries", 0),
+            "budget_exhausted": counters.get("openai_retry_budget_exhausted", 0),
+            "max_retries": OPENAI_MAX_RETRIES,
+        },
+        "triage": {
+            "enabled": TRIAGE_ENABLED,
+            "checks": counters.get("triage_checks", 0),
+            "flagged": counters.get("triage_flagged", 0),
+        },
+        "doctor_speculation": {
+            "enabled": SPECULATIVE_DOCTORS,
+            "hit_rate": _ratio(counters.get("doctor_speculation_hits", 0), counters.get("doctor_speculation_misses", 0)),
+        },
+    }), 200
+
+def _ratio(hits, misses):
+    total = hits + misses
+    return round(hits / total, 4) if total else None
+
 @app.route("/photo-analyze", methods=["POST"])
 @cross_origin()
 @token_required
 def analyze_photo(current_user=None):
     try:
-        data = request.get_json() or {}
-        image_base64 = data.get("image_base64")
+        data = read_analysis_payload()
+        image = data.get("image_bytes") or data.get("image_base64")
         profile_data = data.get("profile", {})
         location = data.get("location")
 
-        if not image_base64:
+        if not image:
             return jsonify({"error": "No image provided"}), 400
 
-        labels = get_image_labels(image_base64)
-        text = get_image_text(image_base64)
+        raw = image if isinstance(image, bytes) else decode_base64_upload(image)
+        use_cache = not cache_bypassed()
+        fingerprint = image_fingerprint(raw)
+        profile_context = build_profile_context(profile_data)
+        analysis_kind = photo_analysis_kind(profile_context)
+
+        cached = image_cache.get(fingerprint, analysis_kind) if use_cache else None
+        if cached is not None:
+            parsed = dict(cached)
+            parsed["nearby_doctors"] = resolve_nearby_doctors(None, parsed.get("suggested_doctor", "general"), location)
+            return jsonify(parsed), 200
+
+        annotations = image_cache.get(fingerprint, "vision") if use_cache else None
+        if annotations is None:
+            annotations = annotate_image(raw, labels=True, text=True)
+            if annotations["labels"] or annotations["text"]:
+                image_cache.set(fingerprint, "vision", annotations)
+        labels, text = annotations["labels"], annotations["text"]
 
         desc = f"The image provides visual cues: {', '.join(labels)}." if labels else "The image provides limited visual cues."
         if text:
             desc += f' Additionally, text detected in the image: "{text}"'
+        block = red_flag_triage(text)
 
-        profile_context = build_profile_context(profile_data)
-        ai = generate_openai_response(desc, "English", profile_context, prompt_type="photo_analysis")
+        prefetch = start_doctor_prefetch(desc, location)
+        ai = generate_openai_response(desc, "English", profile_context, prompt_type="photo_analysis", use_cache=use_cache)
         if not ai:
-            return jsonify({"error": "AI analysis failed to generate response from OpenAI"}), 500
+            error = "AI analysis failed to generate response from OpenAI"
+            if block is not None:
+                return jsonify(triage_fallback(block, error)), 200
+            return jsonify({"error": error}), ai_failure_status()
 
-        parsed = parse_openai_json(ai)
-        parsed["nearby_doctors"] = get_nearby_doctors(parsed.get("suggested_doctor", "general"), location) if location else []
+        parsed = apply_triage(parse_openai_json(ai), block)
         parsed["image_labels"] = labels
         parsed["image_description"] = desc
+        image_cache.set(fingerprint, analysis_kind, dict(parsed))
+        parsed["nearby_doctors"] = resolve_nearby_doctors(prefetch, parsed.get("suggested_doctor", "general"), location)
         return jsonify(parsed), 200
+    except UploadError as e:
+        return jsonify({"error": str(e)}), e.status
     except Exception as e:
         logger.exception("Error in /photo-analyze")
         return jsonify({"error": "Failed to analyze image", "details": str(e)}), 500
@@ -514,61 +2410,482 @@ User concerns (optional):
 {concerns}
 """
 
-        resp = client.chat.completions.create(
-            model="gpt-4o-mini",
-            temperature=0.4,
-            response_format={"type": "json_object"},
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "Be conservative and suggestion-only. No diagnosis. No prescriptions. "
-                        "Do not promise outcomes. Keep tone supportive and clear."
-                    ),
-                },
-                {"role": "user", "content": prompt},
-            ],
-        )
+        with stage("openai"), upstream_call("openai"):
+            resp = openai_call(
+                client.chat.completions.create,
+                model="gpt-4o-mini",
+                temperature=0.4,
+                response_format={"type": "json_object"},
+                messages=[
+                    {
+                        "role": "system",
+                        "content": (
+                            "Be conservative and suggestion-only. No diagnosis. No prescriptions. "
+                            "Do not promise outcomes. Keep tone supportive and clear."
+                        ),
+                    },
+                    {"role": "user", "content": prompt},
+                ],
+            )
+        record_openai_usage(resp.usage, "profile_suggestions")
         content = resp.choices[0].message.content
         return jsonify(json.loads(content)), 200
+    except OpenAIUnavailable as e:
+        logger.warning(f"/profile-suggestions failed fast: {e}")
+        return jsonify({"error": "AI service temporarily unavailable, retry shortly"}), 503
     except Exception as e:
         logger.exception("Error in /profile-suggestions")
         return jsonify({"error": "Failed to generate profile suggestions"}), 500
 
-@app.route("/analyze-lab-report", methods=["POST"])
-@cross_origin()
-@token_required
-def analyze_lab_report(current_user=None):
+PDF_SENTINEL = "PDF document uploaded. Extracting text on backend..."
+
+# --- PDF lab reports ---
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+
+def pdf_pool():
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            # spawn: workers import only pdf_text, and forking a threaded server is unsafe
+            _pdf_pool = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _pdf_pool
+
+def ocr_pdf_page(path, index):
+    """Vision DOCUMENT_TEXT_DETECTION for one PDF page that has no text layer."""
+    if not GOOGLE_VISION_API_KEY:
+        return ""
     try:
-        data = request.get_json() or {}
-        image_base64 = data.get("image_base64")
-        extracted_text_frontend = data.get("extracted_text", "")
-        location = data.get("location")
-        profile_data = data.get("profile", {})
-        language = data.get("language", "English")
+        content = base64.b64encode(pdf_text.single_page_pdf(path, index)).decode("ascii")
+        body = {"requests": [{
+            "inputConfig": {"content": content, "mimeType": "application/pdf"},
+            "features": [{"type": "DOCUMENT_TEXT_DETECTION"}],
+            "pages": [1],
+        }]}
+        with stage("vision_pdf_ocr"), upstream_call("google_vision"):
+            res = http_session("google_vision").post(f"{GOOGLE_VISION_FILES_URL}?key={GOOGLE_VISION_API_KEY}", json=body, timeout=60)
+        res.raise_for_status()
+        bump("pdf_pages_ocr")
+        pages = res.json().get("responses", [{}])[0].get("responses", [{}])
+        return pages[0].get("fullTextAnnotation", {}).get("text", "") if pages else ""
+    except Exception as e:
+        logger.error(f"Vision PDF OCR error on page {index + 1}: {e}")
+        return ""
 
-        final_text = ""
-        if extracted_text_frontend and extracted_text_frontend != "PDF document uploaded. Extracting text on backend...":
-            final_text = extracted_text_frontend
-        elif image_base64:
-            final_text = get_image_text(image_base64)
+def iter_pdf_pages(path):
+    """Yield (page index, text) in page order. Page ranges are parsed in the
+    process pool, so the parent never holds the parsed pages themselves."""
+    total = pdf_text.page_count(path)
+    if total > PDF_MAX_PAGES:
+        logger.warning(f"PDF has {total} pages; analysing the first {PDF_MAX_PAGES}.")
+        total = PDF_MAX_PAGES
+    ranges = [(start, min(start + PDF_PAGES_PER_TASK, total)) for start in range(0, total, PDF_PAGES_PER_TASK)]
+    futures = []
+    if len(ranges) > 1 and PDF_WORKERS > 1:
+        pool = pdf_pool()
+        futures = [pool.submit(pdf_text.extract_pages, path, start, stop) for start, stop in ranges]
+        chunks = (f.result() for f in futures)
+    else:
+        chunks = (pdf_text.extract_pages(path, start, stop) for start, stop in ranges)
+    try:
+        index = 0
+        for chunk in chunks:
+            for text in chunk:
+                if len(text.strip()) < PDF_MIN_PAGE_CHARS:
+                    text = ocr_pdf_page(path, index) or text
+                yield index, text
+                index += 1
+    finally:
+        for f in futures:
+            f.cancel()
+
+def pdf_base64_to_text(pdf_base64):
+    return pdf_bytes_to_text(decode_base64_upload(pdf_base64, "PDF"))
+
+@timed("pdf_extract")
+def pdf_bytes_to_text(pdf_bytes):
+    """Write an uploaded PDF to a temp file and stream its pages into one
+    string, stopping once PDF_MAX_CHARS is reached."""
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+        f.write(pdf_bytes)
+        path = f.name
+    try:
+        return pdf_file_to_text(path)
+    finally:
+        os.unlink(path)
+
+def pdf_file_to_text(path):
+    parts, size = [], 0
+    pages = iter_pdf_pages(path)
+    try:
+        for index, text in pages:
+            text = text.strip()
+            if not text:
+                continue
+            parts.append(f"[Page {index + 1}]\n{text}")
+            size += len(text)
+            if size >= PDF_MAX_CHARS:
+                logger.warning("PDF text truncated at PDF_MAX_CHARS.")
+                break
+    finally:
+        pages.close()
+    bump("pdf_pages_extracted", len(parts))
+    return "\n\n".join(parts)[:PDF_MAX_CHARS]
+
+@timed("lab_values")
+def lab_report_prompt(final_text):
+    """(LLM input, prompt_type, rows) for a lab report: the compact table of parsed
+    values when the parser understood the report, the raw text otherwise."""
+    if not LAB_VALUES_ENABLED:
+        return final_text, "lab_report", []
+    rows, coverage = lab_values.extract(final_text)
+    if len(rows) < LAB_VALUES_MIN_ROWS or coverage < LAB_VALUES_MIN_COVERAGE:
+        bump("lab_values_raw_fallbacks")
+        return final_text, "lab_report", rows
+    table = lab_values.compact_table(rows, lab_values.other_findings(final_text))
+    bump("lab_values_tables")
+    bump("lab_values_chars_saved", max(0, len(final_text) - len(table)))
+    return table, "lab_values", rows
+
+# --- Map-reduce for oversized lab reports ---
+LAB_CHUNK_SYSTEM_PROMPT = (
+    "You are reading one part of a long lab report. List each flagged or out-of-range result on its own line as "
+    "'name: value unit (reference range) [H/L]', copying names, values, units and ranges exactly as printed. "
+    "Then one line 'Normal: ' naming the tests in range, names only. Then one line each for any interpretive "
+    "comment, critical value, specimen problem or clinician note. Ignore letterheads, addresses, page numbers "
+    "and boilerplate. Do not interpret, diagnose or add advice. "
+    "Reply in plain text; if the part holds no results or findings, reply 'none'."
+)
+_lab_chunk_pool = ThreadPoolExecutor(max_workers=LAB_CHUNK_WORKERS, thread_name_prefix="askdoc-labchunk")
+
+def lab_report_chunks(text):
+    """Map-step chunks for a lab report prompt, or None when it fits one call."""
+    if not LAB_CHUNKING_ENABLED:
+        return None
+    tokens = report_chunks.count_tokens(text)
+    if tokens <= LAB_CHUNK_THRESHOLD_TOKENS:
+        return None
+    chunks = report_chunks.split(text, max(LAB_CHUNK_TOKENS, -(-tokens // LAB_CHUNK_MAX)))
+    bump("lab_chunked_reports")
+    bump("lab_chunks", len(chunks))
+    return chunks
 
-        if not final_text:
-            return jsonify({"error": "Missing lab report text or image to analyze"}), 400
+def lab_chunk_messages(chunk):
+    return [{"role": "system", "content": LAB_CHUNK_SYSTEM_PROMPT}, {"role": "user", "content": chunk}]
 
-        profile_context = build_profile_context(profile_data)
-        ai = generate_openai_response(final_text, language, profile_context, prompt_type="lab_report")
-        if not ai:
-            return jsonify({"error": "AI failed to generate response for lab report"}), 500
+def lab_chunk_cache_key(chunk):
+    return ai_cache_key("lab_chunk", "", LAB_CHUNK_SYSTEM_PROMPT, chunk)
 
-        parsed = parse_openai_json(ai)
-        parsed["nearby_doctors"] = get_nearby_doctors(parsed.get("suggested_doctor", "general"), location) if location else []
-        parsed["extracted_text"] = final_text
-        return jsonify(parsed), 200
+def parsed_lab_chunk(chunk):
+    """The chunk as a compact table when the lab value parser understood it, else None."""
+    if not LAB_VALUES_ENABLED:
+        return None
+    rows, coverage = lab_values.extract(chunk)
+    if len(rows) < LAB_VALUES_MIN_ROWS or coverage < LAB_VALUES_MIN_COVERAGE:
+        return None
+    bump("lab_chunks_parsed")
+    return lab_values.compact_table(rows, lab_values.other_findings(chunk))
+
+def lab_findings_text(summaries):
+    """Reduce-step input from the map results, (summary, truncated) or None per part,
+    in report order; None when every part failed."""
+    failed = sum(1 for s in summaries if s is None)
+    if failed:
+        bump("lab_chunks_failed", failed)
+    if failed == len(summaries):
+        return None
+    parts = []
+    for i, s in enumerate(summaries, 1):
+        if s is None:
+            parts.append(f"[Part {i} of {len(summaries)}]\n(this part could not be read)")
+        else:
+            cut = ", cut off: it may hold more results than listed" if s[1] else ""
+            parts.append(f"[Part {i} of {len(summaries)}{cut}]\n{s[0].strip()}")
+    return "\n\n".join(parts)
+
+def lab_chunk_summary(resp, cache_key):
+    """(summary, truncated) from a map-step reply, or None when it is empty. A summary
+    cut off at LAB_CHUNK_SUMMARY_TOKENS is used but not cached."""
+    choice = resp.choices[0]
+    summary, truncated = choice.message.content, choice.finish_reason == "length"
+    if not summary:
+        return None
+    if truncated:
+        bump("lab_chunks_truncated")
+    elif AI_CACHE_TTL > 0:
+        ai_cache.set(cache_key, summary)
+    return summary, truncated
+
+def condense_lab_chunk(chunk, use_cache):
+    table = parsed_lab_chunk(chunk)
+    if table is not None:
+        return table, False
+    cache_key = lab_chunk_cache_key(chunk)
+    if use_cache and AI_CACHE_TTL > 0:
+        cached = ai_cache.get(cache_key)
+        if cached is not None:
+            return cached, False
+    try:
+        start = time.perf_counter()
+        with upstream_call("openai"):
+            resp = openai_call(
+                client.chat.completions.create,
+                model="gpt-4o-mini",
+                temperature=0,
+                max_tokens=LAB_CHUNK_SUMMARY_TOKENS,
+                messages=lab_chunk_messages(chunk),
+            )
+        record_openai_usage(resp.usage, "lab_chunk", time.perf_counter() - start)
+    except OpenAIUnavailable:
+        return None
+    except Exception as e:
+        logger.error(f"OpenAI error condensing a lab report chunk: {e}")
+        return None
+    return lab_chunk_summary(resp, cache_key)
+
+def analyze_lab_text(prompt_text, prompt_type, language, profile_context, use_cache=None):
+    """Analysis JSON for a lab report prompt: one call, or map-reduce over its
+    chunks when the text is over LAB_CHUNK_THRESHOLD_TOKENS."""
+    chunks = lab_report_chunks(prompt_text)
+    if chunks is None:
+        return generate_openai_response(prompt_text, language, profile_context, prompt_type=prompt_type, use_cache=use_cache)
+    if use_cache is None:
+        use_cache = not cache_bypassed()  # the pool threads have no request context
+    with stage("lab_map"):
+        summaries = list(_lab_chunk_pool.map(lambda chunk: condense_lab_chunk(chunk, use_cache), chunks))
+    findings = lab_findings_text(summaries)
+    if findings is None:
+        return None
+    return generate_openai_response(findings, language, profile_context, prompt_type="lab_findings", use_cache=use_cache)
+
+def lab_report_has_input(data):
+    extracted = data.get("extracted_text", "")
+    return bool((extracted and extracted != PDF_SENTINEL) or any(data.get(k) for k in ("image_base64", "image_bytes", "pdf_base64", "pdf_bytes")))
+
+def run_lab_report_analysis(data, use_cache=None):
+    """Lab report pipeline shared by the synchronous route and the job workers.
+    Returns (body, status)."""
+    image = data.get("image_bytes") or data.get("image_base64")
+    extracted_text_frontend = data.get("extracted_text", "")
+    location = data.get("location")
+    profile_data = data.get("profile", {})
+    language = data.get("language", "English")
+
+    final_text = ""
+    if extracted_text_frontend and extracted_text_frontend != PDF_SENTINEL:
+        final_text = extracted_text_frontend
+    elif data.get("pdf_bytes"):
+        final_text = pdf_bytes_to_text(data["pdf_bytes"])
+    elif data.get("pdf_base64"):
+        final_text = pdf_base64_to_text(data["pdf_base64"])
+    elif image:
+        final_text = annotate_image(image, labels=False, text=True, document=True)["text"]
+
+    if not final_text:
+        return {"error": "Missing lab report text or image to analyze"}, 400
+
+    profile_context = build_profile_context(profile_data)
+    block = red_flag_triage(final_text, lab_red_flags)
+    prompt_text, prompt_type, rows = lab_report_prompt(final_text)
+    prefetch = start_doctor_prefetch(final_text, location)
+    ai = analyze_lab_text(prompt_text, prompt_type, language, profile_context, use_cache=use_cache)
+    if not ai:
+        error = "AI failed to generate response for lab report"
+        if block is not None:
+            return dict(triage_fallback(block, error), extracted_text=final_text), 200
+        return {"error": error}, ai_failure_status()
+
+    parsed = apply_triage(parse_openai_json(ai), block)
+    parsed["nearby_doctors"] = resolve_nearby_doctors(prefetch, parsed.get("suggested_doctor", "general"), location)
+    parsed["extracted_text"] = final_text
+    parsed["lab_values"] = rows
+    return parsed, 200
+
+@app.route("/analyze-lab-report", methods=["POST"])
+@cross_origin()
+@token_required
+def analyze_lab_report(current_user=None):
+    try:
+        data = read_analysis_payload(allow_pdf=True)
+        if "respond-async" in request.headers.get("Prefer", ""):
+            return submit_lab_report_job(data)
+        body, status = run_lab_report_analysis(data)
+        return jsonify(body), status
+    except UploadError as e:
+        return jsonify({"error": str(e)}), e.status
     except Exception as e:
         logger.exception("Error in /analyze-lab-report")
         return jsonify({"error": "Failed to analyze lab report", "details": str(e)}), 500
 
+# --- Lab report jobs (POST returns a job id; GET /jobs/<id> polls or long-polls) ---
+# red-flagged `Prefer: respond-async` /analyze requests run their LLM analysis here too
+def worker_tag():
+    """Short id of this worker process (host and pid); job ids start with it."""
+    return hashlib.sha256(f"{socket.gethostname()}:{os.getpid()}".encode("utf-8")).hexdigest()[:8]
+
+class JobStore:
+    """Bounded, TTL'd in-process job registry with content-hash dedupe.
+    Jobs run in the worker process that accepted them. With a shared store (the
+    sqlite AI cache) each job's state is also published there, so GET /jobs/<id>
+    works from every worker on the host; job ids carry the owning worker's tag so
+    a poll that lands on another instance gets a 404 naming the owner."""
+
+    def __init__(self, workers, max_pending, max_jobs, ttl, shared=None):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="askdoc-job")
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.shared = shared
+        self.jobs = TTLCache(max_jobs, ttl)
+        self.by_hash = TTLCache(max_jobs, ttl)
+        self.pending = 0
+        self._lock = threading.Lock()
+
+    def submit(self, content_hash, fn):
+        """Returns (job, created); job is None when the queue is full."""
+        with self._lock:
+            job_id = self.by_hash.get(content_hash)
+            job = self.jobs.get(job_id) if job_id else None
+            if job is not None and job["status"] != "failed":
+                bump("lab_jobs_deduplicated")
+                return job, False
+            if self.pending >= self.max_pending:
+                bump("lab_jobs_rejected")
+                return None, False
+            job = {
+                "id": f"{worker_tag()}.{uuid.uuid4()}",
+                "status": "queued",
+                "created_at": time.time(),
+                "finished_at": None,
+                "result": None,
+                "http_status": None,
+                "done": threading.Event(),
+            }
+            self.jobs.set(job["id"], job)
+            self.by_hash.set(content_hash, job["id"])
+            self.pending += 1
+        bump("lab_jobs_submitted")
+        self._publish(job)
+        self.pool.submit(self._run, job, fn)
+        return job, True
+
+    def _run(self, job, fn):
+        job["status"] = "running"
+        self._publish(job)
+        try:
+            body, status = fn()
+        except Exception as e:
+            logger.exception("Lab report job failed")
+            body, status = {"error": "Failed to analyze lab report", "details": str(e)}, 500
+        job["result"], job["http_status"] = body, status
+        job["status"] = "done" if status < 500 else "failed"
+        job["finished_at"] = time.time()
+        with self._lock:
+            self.pending -= 1
+        self._publish(job)
+        job["done"].set()
+
+    def _publish(self, job):
+        if self.shared is None:
+            return
+        try:
+            self.shared.set("job:" + job["id"], json.dumps(job_view(job), default=str), ttl=self.ttl)
+        except Exception as e:
+            logger.warning(f"Shared job store write failed: {e}")
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def shared_view(self, job_id):
+        """The job's last published view when another worker on the host runs it, else None."""
+        if self.shared is None:
+            return None
+        try:
+            value = self.shared.get("job:" + job_id)
+        except Exception as e:
+            logger.warning(f"Shared job store read failed: {e}")
+            return None
+        return json.loads(value) if value is not None else None
+
+    @staticmethod
+    def elsewhere(job_id):
+        """True for a job id issued by a different worker process."""
+        tag, sep, _ = job_id.partition(".")
+        return bool(sep) and tag != worker_tag()
+
+def job_view(job):
+    view = {k: job[k] for k in ("id", "status", "created_at", "finished_at")}
+    if job["status"] in ("done", "failed"):
+        view["http_status"] = job["http_status"]
+        view["result"] = job["result"]
+    return view
+
+lab_jobs = JobStore(LAB_JOB_WORKERS, LAB_JOB_QUEUE_MAX, LAB_JOB_MAX_STORED, LAB_JOB_TTL, ai_cache.shared)
+
+def _hash_default(value):
+    if isinstance(value, bytes):
+        return hashlib.sha256(value).hexdigest()
+    return str(value)
+
+def submit_lab_report_job(data):
+    if not lab_report_has_input(data):
+        return jsonify({"error": "Missing lab report text or image to analyze"}), 400
+    use_cache = not cache_bypassed()
+    content_hash = hashlib.sha256(json.dumps(data, sort_keys=True, default=_hash_default).encode("utf-8")).hexdigest()
+    job, created = lab_jobs.submit(content_hash, lambda: run_lab_report_analysis(data, use_cache=use_cache))
+    if job is None:
+        resp = make_response(jsonify({"error": "Too many lab report jobs in progress, retry shortly"}), 503)
+        resp.headers["Retry-After"] = "5"
+        return resp
+    resp = make_response(jsonify(job_view(job)), 202 if created else 200)
+    resp.headers["Location"] = f"/jobs/{job['id']}"
+    return resp
+
+@app.route("/analyze-lab-report/jobs", methods=["POST"])
+@cross_origin()
+@token_required
+def create_lab_report_job(current_user=None):
+    try:
+        return submit_lab_report_job(read_analysis_payload(allow_pdf=True))
+    except UploadError as e:
+        return jsonify({"error": str(e)}), e.status
+    except Exception as e:
+        logger.exception("Error in /analyze-lab-report/jobs")
+        return jsonify({"error": "Failed to queue lab report", "details": str(e)}), 500
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+@cross_origin()
+@token_required
+def get_job(job_id, current_user=None):
+    try:
+        wait = min(float(request.args.get("wait", 0)), LAB_JOB_MAX_WAIT)
+    except ValueError:
+        wait = 0
+    job = lab_jobs.get(job_id)
+    if job is None:
+        return get_shared_job(job_id, wait)
+    if wait > 0:
+        job["done"].wait(wait)
+    return jsonify(job_view(job)), 200
+
+def get_shared_job(job_id, wait):
+    """GET /jobs/<id> for a job this worker doesn't hold: its shared view, polled for up
+    to `wait` seconds, or a 404 that tells "another worker" (code and owner tag) apart
+    from "no such job"."""
+    deadline = time.time() + wait
+    view = lab_jobs.shared_view(job_id)
+    while view is not None and view["status"] not in ("done", "failed") and time.time() < deadline:
+        time.sleep(SINGLEFLIGHT_POLL_INTERVAL)
+        view = lab_jobs.shared_view(job_id) or view
+    if view is not None:
+        bump("lab_jobs_shared_reads")
+        return jsonify(view), 200
+    if lab_jobs.elsewhere(job_id):
+        bump("lab_jobs_other_worker")
+        return jsonify({"error": "Job is held by another worker or instance; poll again (session affinity "
+                                 "routes you back to it)", "code": "job_on_other_worker",
+                        "owner": job_id.partition(".")[0], "worker": worker_tag()}), 404
+    return jsonify({"error": "Job not found or expired"}), 404
+
 @app.route("/api/ask", methods=["POST"])
 @cross_origin()
 @token_required
@@ -579,21 +2896,232 @@ def ask(current_user=None):
         if not question:
             return jsonify({"error": "No question provided"}), 400
 
-        resp = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": question}],
-            temperature=0.5,
-        )
+        with stage("openai"), upstream_call("openai"):
+            resp = openai_call(
+                client.chat.completions.create,
+                model="gpt-4o-mini",
+                messages=[{"role": "user", "content": question}],
+                temperature=0.5,
+            )
+        record_openai_usage(resp.usage, "ask")
         reply = resp.choices[0].message.content
         return jsonify({"reply": reply}), 200
+    except OpenAIUnavailable as e:
+        logger.warning(f"/api/ask failed fast: {e}")
+        return jsonify({"error": "AI service temporarily unavailable, retry shortly"}), 503
     except Exception as e:
         logger.error(f"OpenAI error in /api/ask: {e}")
         return jsonify({"error": "OpenAI request failed"}), 500
 
 # --- History (Supabase REST) ---
+# --- History write-behind queue ---
+class HistoryQueue:
+    """Durable queue of history rows waiting to be inserted, shared by the workers on
+    the host. Rows keep the user's Supabase JWT so the insert still goes through RLS;
+    a row whose token has expired by flush time is dead-lettered, not retried. Dead rows
+    lose the JWT at once and the row after HISTORY_DEAD_RETENTION."""
+
+    def __init__(self, path, max_depth):
+        self.max_depth = max_depth
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS history_queue ("
+            " id TEXT PRIMARY KEY, user_id TEXT NOT NULL, jwt TEXT NOT NULL, row TEXT NOT NULL,"
+            " enqueued_at REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, next_attempt_at REAL NOT NULL,"
+            " claimed_until REAL NOT NULL DEFAULT 0, dead INTEGER NOT NULL DEFAULT 0, last_error TEXT)"
+        )
+        self._conn.execute("UPDATE history_queue SET jwt = '' WHERE dead = 1 AND jwt != ''")  # from before dead rows dropped it
+
+    def enqueue(self, row, token):
+        """False when the queue is full (backpressure)."""
+        now = time.time()
+        with self._lock:
+            if self._depth() >= self.max_depth:
+                return False
+            self._conn.execute(
+                "INSERT OR IGNORE INTO history_queue (id, user_id, jwt, row, enqueued_at, next_attempt_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (row["id"], row["user_id"], token, json.dumps(row), now, now),
+            )
+        return True
+
+    def claim(self, limit, lease=60):
+        """Take up to `limit` due rows for `lease` seconds; another worker's flusher skips them."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(
+                    "SELECT id, user_id, jwt, row, enqueued_at, attempts FROM history_queue"
+                    " WHERE dead = 0 AND next_attempt_at <= ? AND claimed_until <= ? ORDER BY enqueued_at LIMIT ?",
+                    (now, now, limit),
+                ).fetchall()
+                self._conn.executemany(
+                    "UPDATE history_queue SET claimed_until = ? WHERE id = ?", [(now + lease, r[0]) for r in rows]
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return rows
+
+    def ack(self, ids):
+        with self._lock:
+            self._conn.executemany("DELETE FROM history_queue WHERE id = ?", [(i,) for i in ids])
+
+    def retry(self, ids, attempts, error):
+        backoff = min(2 ** attempts, 300)
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE history_queue SET attempts = attempts + 1, next_attempt_at = ?, claimed_until = 0,"
+                " dead = (attempts + 1 >= ?), jwt = CASE WHEN attempts + 1 >= ? THEN '' ELSE jwt END,"
+                " last_error = ? WHERE id = ?",
+                [(time.time() + backoff, HISTORY_FLUSH_MAX_ATTEMPTS, HISTORY_FLUSH_MAX_ATTEMPTS, error[:500], i) for i in ids],
+            )
+
+    def kill(self, ids, error):
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE history_queue SET dead = 1, jwt = '', claimed_until = 0, last_error = ? WHERE id = ?",
+                [(error[:500], i) for i in ids],
+            )
+
+    def purge_user(self, user_id):
+        """Drop every queued row of a user (account deletion); returns how many."""
+        with self._lock:
+            return self._conn.execute("DELETE FROM history_queue WHERE user_id = ?", (user_id,)).rowcount
+
+    def purge_dead(self, retention):
+        with self._lock:
+            return self._conn.execute(
+                "DELETE FROM history_queue WHERE dead = 1 AND enqueued_at < ?", (time.time() - retention,)
+            ).rowcount
+
+    def _depth(self):
+        return self._conn.execute("SELECT COUNT(*) FROM history_queue WHERE dead = 0").fetchone()[0]
+
+    def depth(self):
+        with self._lock:
+            return self._depth()
+
+    def stats(self):
+        with self._lock:
+            pending, dead, oldest = self._conn.execute(
+                "SELECT SUM(dead = 0), SUM(dead = 1), MIN(CASE WHEN dead = 0 THEN enqueued_at END) FROM history_queue"
+            ).fetchone()
+        return {
+            "depth": pending or 0,
+            "dead": dead or 0,
+            "oldest_age_seconds": round(time.time() - oldest, 3) if oldest else 0,
+            "max_depth": self.max_depth,
+        }
+
+_history_queue = None
+_history_queue_lock = threading.Lock()
+_history_flush_wakeup = threading.Event()
+
+def history_queue():
+    """The queue, opened (and its flusher started) on first use."""
+    global _history_queue
+    with _history_queue_lock:
+        if _history_queue is None:
+            _history_queue = HistoryQueue(HISTORY_QUEUE_PATH, HISTORY_QUEUE_MAX)
+            threading.Thread(target=_history_flusher, name="askdoc-history-flush", daemon=True).start()
+        return _history_queue
+
+def flush_history_queue():
+    """One flush pass: a multi-row insert per JWT (RLS is per user). Returns rows landed."""
+    queue = history_queue()
+    claimed = queue.claim(HISTORY_FLUSH_BATCH)
+    by_token = {}
+    for row_id, user_id, token, row, enqueued_at, attempts in claimed:
+        by_token.setdefault(token, []).append((row_id, user_id, json.loads(row), enqueued_at, attempts))
+
+    landed = 0
+    for token, items in by_token.items():
+        if HISTORY_BACKEND == "postgres":
+            landed += _flush_history_postgres(queue, token, items)
+            continue
+        ids = [i[0] for i in items]
+        headers = {
+            "apikey": SUPABASE_ANON_KEY,
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json",
+            # a replayed batch (e.g. after a timeout that did land) must not duplicate rows
+            "Prefer": "return=minimal,resolution=ignore-duplicates",
+        }
+        try:
+            with upstream_call("supabase"):
+                r = http_session("supabase").post(f"{SUPABASE_URL}/rest/v1/history", headers=headers,
+                                                  data=json.dumps([i[2] for i in items]), timeout=30)
+        except Exception as e:
+            logger.warning(f"History flush failed, will retry: {e}")
+            queue.retry(ids, max(i[4] for i in items), str(e))
+            continue
+        now = time.time()
+        if r.status_code in (200, 201, 204):
+            queue.ack(ids)
+            landed += len(ids)
+            for _, _, _, enqueued_at, _ in items:
+                history_queue_seconds.observe("flushed", now - enqueued_at)
+            for user_id in {i[1] for i in items}:
+                invalidate_history(user_id)
+        elif r.status_code in (408, 429) or r.status_code >= 500:
+            logger.warning(f"History flush got {r.status_code}, will retry: {r.text[:200]}")
+            queue.retry(ids, max(i[4] for i in items), f"{r.status_code} {r.text}")
+        else:
+            # bad row or expired/invalid JWT: retrying cannot help
+            logger.error(f"History flush rejected ({r.status_code}), dead-lettering {len(ids)} rows: {r.text[:200]}")
+            queue.kill(ids, f"{r.status_code} {r.text}")
+            for _, _, _, enqueued_at, _ in items:
+                history_queue_seconds.observe("dead", now - enqueued_at)
+    bump("history_rows_flushed", landed)
+    return landed
+
+def _flush_history_postgres(queue, token, items):
+    ids = [i[0] for i in items]
+    now = time.time()
+    try:
+        db_insert_history(verify_supabase_jwt(token), [i[2] for i in items])
+    except PermissionError as e:
+        logger.error(f"History flush rejected, dead-lettering {len(ids)} rows: {e}")
+        queue.kill(ids, str(e))
+        for item in items:
+            history_queue_seconds.observe("dead", now - item[3])
+        return 0
+    except Exception as e:
+        logger.warning(f"History flush failed, will retry: {e}")
+        queue.retry(ids, max(i[4] for i in items), str(e))
+        return 0
+    queue.ack(ids)
+    for item in items:
+        history_queue_seconds.observe("flushed", time.time() - item[3])
+    for user_id in {i[1] for i in items}:
+        invalidate_history(user_id)
+    return len(ids)
+
+def _history_flusher():
+    last_purge = 0.0
+    while True:
+        _history_flush_wakeup.wait(HISTORY_FLUSH_INTERVAL)
+        _history_flush_wakeup.clear()
+        try:
+            while flush_history_queue() >= HISTORY_FLUSH_BATCH:
+                pass  # keep draining full batches
+            if time.time() - last_purge > 60:
+                bump("history_dead_purged", _history_queue.purge_dead(HISTORY_DEAD_RETENTION))
+                last_purge = time.time()
+        except Exception:
+            logger.exception("History flusher error")
+
+if HISTORY_WRITE_MODE == "behind" or os.path.exists(HISTORY_QUEUE_PATH):
+    history_queue()  # drain whatever an earlier process (or a respond-async save) left behind
+
 @app.route("/api/history", methods=["POST"])
 @cross_origin()
 @token_required
+@idempotent
 def save_history(current_user=None):
     try:
         data = request.get_json() or {}
@@ -617,8 +3145,12 @@ def save_history(current_user=None):
         if not isinstance(remedies, list): remedies = [remedies] if remedies else []
         if not isinstance(citations, list): citations = [citations] if isinstance(citations, dict) else []
 
+        # with an Idempotency-Key the row id is derived from it, so even a retry that
+        # outlives the stored reply cannot insert a second row
+        idempotency_key = request.headers.get("Idempotency-Key", "").strip()
+        row_id = uuid.uuid5(uuid.NAMESPACE_URL, f"askdoc:history:{user_id}:{idempotency_key}") if idempotency_key else uuid.uuid4()
         payload = {
-            "id": str(uuid.uuid4()),
+            "id": str(row_id),
             "user_id": user_id,
             "query": query,
             "detected_condition": parsed.get("detected_condition"),
@@ -638,24 +3170,155 @@ def save_history(current_user=None):
             "citations": citations,
         }
 
+        if HISTORY_WRITE_MODE == "behind" or "respond-async" in request.headers.get("Prefer", ""):
+            if not history_queue().enqueue(payload, supa_jwt):
+                bump("history_queue_rejected")
+                resp = make_response(jsonify({"error": "History queue is full, retry shortly"}), 503)
+                resp.headers["Retry-After"] = "5"
+                return resp
+            bump("history_rows_queued")
+            if history_queue().depth() >= HISTORY_FLUSH_BATCH:
+                _history_flush_wakeup.set()
+            return jsonify({"success": True, "queued": True, "id": payload["id"]}), 202
+
+        if HISTORY_BACKEND == "postgres":
+            try:
+                claims = verify_supabase_jwt(supa_jwt, user_id)
+            except PermissionError as e:
+                return jsonify({"error": str(e)}), 401
+            with stage("postgres"):
+                db_insert_history(claims, [payload])
+            invalidate_history(user_id)
+            return jsonify({"success": True, "data": [payload]}), 200
+
         url = f"{SUPABASE_URL}/rest/v1/history"
         headers = {
             "apikey": SUPABASE_ANON_KEY,
             # 👇 **use the user's JWT** so RLS sees auth.uid()
             "Authorization": f"Bearer {supa_jwt}",
             "Content-Type": "application/json",
-            "Prefer": "return=representation",
+            "Prefer": "return=representation" + (",resolution=ignore-duplicates" if idempotency_key else ""),
         }
-        r = requests.post(url, headers=headers, data=json.dumps(payload), timeout=30)
+        with stage("supabase"), upstream_call("supabase"):
+            r = http_session("supabase").post(url, headers=headers, data=json.dumps(payload), timeout=30)
         if r.status_code != 201:
             logger.error(f"Supabase insert error: {r.text}")
             return jsonify({"error": "Failed to save history", "details": r.text}), 500
+        invalidate_history(user_id)
         return jsonify({"success": True, "data": r.json()}), 200
 
     except Exception as e:
         logger.exception("Exception while saving history")
         return jsonify({"error": str(e)}), 500
 
+# Columns of the Supabase `history` table; "response" is the decoded raw_text
+HISTORY_COLUMNS = (
+    "id", "user_id", "query", "detected_condition", "medical_analysis", "remedies", "urgency",
+    "medicines", "suggested_doctor", "raw_text", "timestamp", "nursing_explanation", "personal_notes",
+    "relevant_information", "why_happening_explanation", "immediate_action", "nurse_tips", "citations",
+)
+HISTORY_LIST_FIELDS = ("id", "timestamp", "query", "detected_condition", "urgency", "suggested_doctor")
+HISTORY_MAX_LIMIT = int(os.getenv("HISTORY_MAX_LIMIT", "200"))
+
+# user_id -> {(jwt hash, query): (body, headers, etag, generation)}
+history_cache = TTLCache(HISTORY_CACHE_MAX_USERS, HISTORY_CACHE_TTL)
+HISTORY_CACHE_PAGES_PER_USER = 32
+HISTORY_CACHE_ENABLED = HISTORY_CACHE_TTL > 0 and (ai_cache.shared is not None or WEB_CONCURRENCY <= 1)
+if HISTORY_CACHE_TTL > 0 and not HISTORY_CACHE_ENABLED:
+    logger.warning("History cache disabled: WEB_CONCURRENCY > 1 needs AI_CACHE_BACKEND=sqlite to invalidate it across workers")
+_history_local_generation = Counter()
+# guards the per-user page dicts stored in history_cache
+_history_pages_lock = threading.Lock()
+
+def cached_history_page(user_id, cache_key):
+    with _history_pages_lock:
+        entries = history_cache.get(user_id)
+        return entries.get(cache_key) if entries is not None else None
+
+def store_history_page(user_id, cache_key, page):
+    with _history_pages_lock:
+        entries = history_cache.get(user_id)
+        if entries is None or len(entries) >= HISTORY_CACHE_PAGES_PER_USER:
+            entries = {}
+            history_cache.set(user_id, entries)
+        entries[cache_key] = page
+
+def history_generation(user_id):
+    """(local, shared) markers bumped by invalidate_history. A reply fetched under an
+    older generation is never served, even if it was stored after the invalidation."""
+    shared = None
+    if ai_cache.shared is not None:
+        try:
+            shared = ai_cache.shared.get("histgen:" + user_id)
+        except Exception as e:
+            logger.warning(f"History cache generation read failed: {e}")
+    with _stats_lock:
+        return _history_local_generation[user_id], shared
+
+def invalidate_history(user_id):
+    with _stats_lock:
+        _history_local_generation[user_id] += 1
+    history_cache.delete(user_id)
+    if ai_cache.shared is not None:
+        try:
+            ai_cache.shared.set("histgen:" + user_id, uuid.uuid4().hex, ttl=HISTORY_CACHE_TTL)
+        except Exception as e:
+            logger.warning(f"History cache invalidation failed: {e}")
+
+def history_etag(body):
+    """Strong validator: a digest of the exact bytes served."""
+    return hashlib.sha256(body).hexdigest()[:32]
+
+def history_response(body, headers, etag):
+    if request.if_none_match.contains_weak(etag):
+        bump("history_not_modified")
+        resp = Response(status=304)
+    else:
+        resp = Response(body, status=200, mimetype="application/json")
+        resp.headers.update(headers)
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
+
+def history_query(args):
+    """Parsed GET /api/history query: {"params" (PostgREST), "fields", "columns", "limit", "before"}.
+
+    `limit` caps the page, `before=<timestamp>,<id>` continues after the last row
+    of the previous page (newest first, id breaks timestamp ties), `fields=a,b`
+    projects columns and `view=list` is the summary projection. Without any of
+    them the full history is returned, as before. Raises ValueError.
+    """
+    params = {"user_id": f"eq.{args['user_id']}", "order": "timestamp.desc,id.desc"}
+
+    fields = columns = None
+    if args.get("fields"):
+        fields = [f.strip() for f in args["fields"].split(",") if f.strip()]
+        unknown = [f for f in fields if f != "response" and f not in HISTORY_COLUMNS]
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    elif args.get("view") == "list":
+        fields = list(HISTORY_LIST_FIELDS)
+    if fields is not None:
+        columns = ["raw_text" if f == "response" else f for f in fields]
+        columns = list(dict.fromkeys(columns + ["id", "timestamp"]))  # id/timestamp are needed for the cursor
+        params["select"] = ",".join(columns)
+
+    limit = None
+    if args.get("limit"):
+        limit = int(args["limit"])
+        if not 1 <= limit <= HISTORY_MAX_LIMIT:
+            raise ValueError(f"limit must be between 1 and {HISTORY_MAX_LIMIT}")
+        params["limit"] = str(limit)
+
+    before = None
+    if args.get("before"):
+        ts, _, row_id = args["before"].rpartition(",")
+        datetime.fromisoformat(ts.replace("Z", "+00:00"))
+        row_id = str(uuid.UUID(row_id))
+        params["or"] = f'(timestamp.lt."{ts}",and(timestamp.eq."{ts}",id.lt.{row_id}))'
+        before = (ts, row_id)
+    return {"params": params, "fields": fields, "columns": columns, "limit": limit, "before": before}
+
 @app.route("/api/history", methods=["GET"])
 @cross_origin()
 @token_required
@@ -670,29 +3333,70 @@ def get_history(current_user=None):
         if not supa_jwt:
             return jsonify({"error": "Missing Supabase auth token"}), 401
 
-        url = f"{SUPABASE_URL}/rest/v1/history?user_id=eq.{user_id}&order=timestamp.desc"
-        headers = {
-            "apikey": SUPABASE_ANON_KEY,
-            # 👇 Use the user's JWT so RLS sees auth.uid()
-            "Authorization": f"Bearer {supa_jwt}",
-            "Content-Type": "application/json",
-        }
-
-        r = requests.get(url, headers=headers, timeout=30)
-        if r.status_code != 200:
-            logger.error(f"Supabase fetch error: {r.text}")
-            return jsonify({"error": "Failed to fetch history", "details": r.text}), 500
-
-        history = r.json()
-        # best-effort: inflate 'response' from raw_text
-        for entry in history:
-            raw = entry.get("raw_text")
-            if isinstance(raw, str) and raw:
-                try:
-                    entry["response"] = json.loads(raw)
-                except Exception:
-                    entry["response"] = {}
-        return jsonify(history), 200
+        try:
+            query = history_query(request.args)
+        except ValueError as e:
+            return jsonify({"error": f"Invalid history query: {e}"}), 400
+        fields, limit = query["fields"], query["limit"]
+
+        cache_key = (hashlib.sha256(supa_jwt.encode("utf-8")).hexdigest(), urlencode(sorted(request.args.items(multi=True))))
+        generation = None
+        if HISTORY_CACHE_ENABLED:
+            generation = history_generation(user_id)
+            cached = cached_history_page(user_id, cache_key) if not cache_bypassed() else None
+            if cached is not None and cached[3] == generation:
+                bump("history_cache_hits")
+                return history_response(*cached[:3])
+            bump("history_cache_misses")
+
+        if HISTORY_BACKEND == "postgres":
+            try:
+                claims = verify_supabase_jwt(supa_jwt, user_id)
+            except PermissionError as e:
+                return jsonify({"error": str(e)}), 401
+            with stage("postgres"):
+                history = db_history_page(claims, user_id, query["columns"] or HISTORY_COLUMNS, limit, query["before"])
+        else:
+            url = f"{SUPABASE_URL}/rest/v1/history"
+            headers = {
+                "apikey": SUPABASE_ANON_KEY,
+                # 👇 Use the user's JWT so RLS sees auth.uid()
+                "Authorization": f"Bearer {supa_jwt}",
+                "Content-Type": "application/json",
+            }
+
+            with stage("supabase"), upstream_call("supabase"):
+                r = http_session("supabase").get(url, params=query["params"], headers=headers, timeout=30)
+            if r.status_code != 200:
+                logger.error(f"Supabase fetch error: {r.text}")
+                return jsonify({"error": "Failed to fetch history", "details": r.text}), 500
+
+            history = r.json()
+        # best-effort: inflate 'response' from raw_text (only when it was asked for)
+        if fields is None or "response" in fields:
+            for entry in history:
+                raw = entry.get("raw_text")
+                if isinstance(raw, str) and raw:
+                    try:
+                        entry["response"] = json.loads(raw)
+                    except Exception:
+                        entry["response"] = {}
+                if fields is not None and "raw_text" not in fields:
+                    entry.pop("raw_text", None)
+
+        body = jsonify(history).get_data()
+        extra = {}
+        if limit and len(history) == limit:
+            last = history[-1]
+            cursor = f"{last.get('timestamp')},{last.get('id')}"
+            next_args = request.args.to_dict()
+            next_args["before"] = cursor
+            extra["X-Next-Cursor"] = cursor
+            extra["Link"] = f'<{request.path}?{urlencode(next_args)}>; rel="next"'
+        etag = history_etag(body)
+        if HISTORY_CACHE_ENABLED:
+            store_history_page(user_id, cache_key, (body, extra, etag, generation))
+        return history_response(body, extra, etag)
 
     except Exception as e:
         logger.exception("Exception while fetching history")
@@ -732,7 +3436,8 @@ def request_password_reset(current_user=None):
         url = f"{SUPABASE_URL}/auth/v1/recover"
         headers = {"apikey": SUPABASE_ANON_KEY, "Content-Type": "application/json"}
         payload = {"email": email, "redirect_to": redirect_to}
-        r = requests.post(url, headers=headers, json=payload, timeout=20)
+        with stage("supabase"), upstream_call("supabase"):
+            r = http_session("supabase").post(url, headers=headers, json=payload, timeout=20)
         r.raise_for_status()
         return jsonify({"message": "Password reset email sent."}), 200
     except requests.exceptions.RequestException as e:
@@ -773,6 +3478,12 @@ def delete_account(current_user=None):
             "Prefer": "return=representation",
         }
 
+        # queued history first, so no worker's flusher writes rows back after the delete;
+        # the queue file is shared, so this also drops rows queued by other workers
+        purged = history_queue().purge_user(user_id)
+        if purged:
+            logger.info(f"Dropped {purged} queued history rows of deleted user {user_id}")
+
         # delete rows from your tables
         base = f"{SUPABASE_URL}/rest/v1"
         endpoints = [
@@ -780,15 +3491,23 @@ def delete_account(current_user=None):
             f"{base}/history?user_id=eq.{user_id}",
             f"{base}/medications?user_id=eq.{user_id}",
         ]
+        if HISTORY_BACKEND == "postgres":
+            with stage("postgres"):
+                db_delete_user_data(user_id)
+            invalidate_history(user_id)
+            endpoints = []
         for ep in endpoints:
-            dr = requests.delete(ep, headers=svc_headers, timeout=20)
+            with stage("supabase"), upstream_call("supabase"):
+                dr = http_session("supabase").delete(ep, headers=svc_headers, timeout=20)
+            invalidate_history(user_id)
             if dr.status_code not in (200, 204):
                 logger.error(f"Failed table delete {ep}: {dr.status_code} {dr.text}")
                 return jsonify({"result": {"success": False, "error": "Failed to delete user data", "details": dr.text}}), 500
 
         # delete from Supabase Auth
         auth_url = f"{SUPABASE_URL}/auth/v1/admin/users/{user_id}"
-        ar = requests.delete(auth_url, headers=svc_headers, timeout=20)
+        with stage("supabase"), upstream_call("supabase"):
+            ar = http_session("supabase").delete(auth_url, headers=svc_headers, timeout=20)
         if ar.status_code != 204:
             logger.error(f"Failed auth delete: {ar.status_code} {ar.text}")
             return jsonify({"result": {"success": False, "error": "Failed to delete user from Supabase Auth", "details": ar.text}}), 500
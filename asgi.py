@@ -0,0 +1,472 @@
+# asgi.py
+# Async serving mode:
+#   GUNICORN_MODE=asgi gunicorn -b :8080                    (see gunicorn.conf.py)
+#   uvicorn asgi:application --port 8080                     (local)
+#
+# The AI routes (/analyze, /photo-analyze, /analyze-lab-report, /api/doctors)
+# run natively on the event loop: OpenAI, Vision and Places calls are awaited,
+# so one process can hold hundreds of analyses in flight instead of pinning a
+# worker thread per request. Every other route (history, account, password
+# reset, SSE stream, CORS preflight) is served by the Flask app through a
+# threaded WSGI bridge, so contracts are identical in both modes.
+import os
+import base64
+import json
+import time
+import asyncio
+import logging
+
+import httpx
+from a2wsgi import WSGIMiddleware
+from openai import AsyncOpenAI
+
+import app as core
+
+logger = logging.getLogger("asgi")
+
+ASYNC_MAX_INFLIGHT = int(os.getenv("ASYNC_MAX_INFLIGHT", "512"))
+ASYNC_HTTP_MAX_CONNECTIONS = int(os.getenv("ASYNC_HTTP_MAX_CONNECTIONS", "100"))
+ASYNC_WSGI_THREADS = int(os.getenv("ASYNC_WSGI_THREADS", "16"))
+
+aclient = AsyncOpenAI(api_key=core.OPENAI_API_KEY, max_retries=0, timeout=core.OPENAI_TIMEOUT)
+_http = None
+_inflight = None
+
+def http_client():
+    global _http
+    if _http is None:
+        limits = httpx.Limits(max_connections=ASYNC_HTTP_MAX_CONNECTIONS, max_keepalive_connections=ASYNC_HTTP_MAX_CONNECTIONS)
+        _http = httpx.AsyncClient(limits=limits, timeout=60)
+    return _http
+
+def inflight_limit():
+    global _inflight
+    if _inflight is None:
+        _inflight = asyncio.Semaphore(ASYNC_MAX_INFLIGHT)
+    return _inflight
+
+class AsyncSingleFlight:
+    """Event-loop counterpart of core.SingleFlight. The shared call runs as its own
+    task, so a caller that disconnects doesn't cancel it for the others."""
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+
+    async def do(self, key, fn):
+        task = self._calls.get(key)
+        if task is not None:
+            core.bump(f"{self.name}_coalesced")
+        else:
+            task = self._calls[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        return await asyncio.shield(task)
+
+openai_flight = AsyncSingleFlight("openai_singleflight")
+doctors_flight = AsyncSingleFlight("doctors_singleflight")
+
+# --- Async upstream helpers (mirror the sync ones in app.py) ---
+async def openai_call(create, **kwargs):
+    """Awaitable core.openai_call: same breaker, retry budget and backoff, but
+    the wait between attempts doesn't hold a thread."""
+    core.openai_retry_budget.record_request()
+    attempt = 0
+    while True:
+        if not core.openai_breaker.allow():
+            core.bump("openai_breaker_rejected")
+            raise core.OpenAIUnavailable(core.openai_breaker.retry_after())
+        try:
+            result = await create(**kwargs)
+        except asyncio.CancelledError:
+            core.openai_breaker.abandon()
+            raise
+        except Exception as e:
+            delay = core.openai_attempt_failed(e, attempt)
+            if delay is None:
+                raise
+            logger.warning(f"OpenAI attempt {attempt + 1} failed ({e}); retrying in {delay:.2f}s")
+            await asyncio.sleep(delay)
+            attempt += 1
+            continue
+        core.openai_breaker.record(True)
+        return result
+
+async def generate_openai_response(user_input_text, language, profile_context, prompt_type="symptoms", use_cache=True):
+    with core.stage("openai"):
+        return await _generate_openai_response(user_input_text, language, profile_context, prompt_type, use_cache)
+
+async def _generate_openai_response(user_input_text, language, profile_context, prompt_type, use_cache):
+    cache_key = core.ai_cache_key(prompt_type, language, profile_context, user_input_text)
+    if use_cache and core.AI_CACHE_TTL > 0:
+        # the shared tier is sqlite with a busy timeout; never wait on it from the loop
+        cached = await asyncio.to_thread(core.ai_cache.get, cache_key)
+        if cached is not None:
+            return cached
+    if not use_cache:
+        return await _call_openai(cache_key, user_input_text, language, profile_context, prompt_type)
+    return await openai_flight.do(cache_key, lambda: _call_openai(cache_key, user_input_text, language, profile_context, prompt_type))
+
+async def _call_openai(cache_key, user_input_text, language, profile_context, prompt_type):
+    try:
+        start = time.perf_counter()
+        with core.upstream_call("openai"):
+            resp = await openai_call(
+                aclient.chat.completions.create,
+                model="gpt-4o-mini",
+                temperature=0.4,
+                response_format={"type": "json_object"},
+                messages=core.build_analysis_messages(user_input_text, language, profile_context, prompt_type),
+                extra_body={"prompt_cache_key": core.PROMPT_ID},
+            )
+        core.record_openai_usage(resp.usage, prompt_type, time.perf_counter() - start)
+        reply = resp.choices[0].message.content
+    except core.OpenAIUnavailable:
+        return None
+    except Exception as e:
+        logger.error(f"OpenAI error in async generate_openai_response: {e}")
+        return None
+    if reply and core.AI_CACHE_TTL > 0:
+        await asyncio.to_thread(core.ai_cache.set, cache_key, reply)
+    return reply
+
+async def analyze_lab_text(prompt_text, prompt_type, language, profile_context, use_cache=True):
+    chunks = await asyncio.to_thread(core.lab_report_chunks, prompt_text)
+    if chunks is None:
+        return await generate_openai_response(prompt_text, language, profile_context, prompt_type, use_cache=use_cache)
+    limit = asyncio.Semaphore(core.LAB_CHUNK_WORKERS)
+
+    async def condense(chunk):
+        async with limit:
+            return await _condense_lab_chunk(chunk, use_cache)
+
+    with core.stage("lab_map"):
+        summaries = await asyncio.gather(*(condense(chunk) for chunk in chunks))
+    findings = core.lab_findings_text(summaries)
+    if findings is None:
+        return None
+    return await generate_openai_response(findings, language, profile_context, "lab_findings", use_cache=use_cache)
+
+async def _condense_lab_chunk(chunk, use_cache):
+    table = await asyncio.to_thread(core.parsed_lab_chunk, chunk)
+    if table is not None:
+        return table, False
+    cache_key = core.lab_chunk_cache_key(chunk)
+    if use_cache and core.AI_CACHE_TTL > 0:
+        cached = await asyncio.to_thread(core.ai_cache.get, cache_key)
+        if cached is not None:
+            return cached, False
+    try:
+        start = time.perf_counter()
+        with core.upstream_call("openai"):
+            resp = await openai_call(
+                aclient.chat.completions.create,
+                model="gpt-4o-mini",
+                temperature=0,
+                max_tokens=core.LAB_CHUNK_SUMMARY_TOKENS,
+                messages=core.lab_chunk_messages(chunk),
+            )
+        core.record_openai_usage(resp.usage, "lab_chunk", time.perf_counter() - start)
+    except core.OpenAIUnavailable:
+        return None
+    except Exception as e:
+        logger.error(f"OpenAI error condensing a lab report chunk (async): {e}")
+        return None
+    return await asyncio.to_thread(core.lab_chunk_summary, resp, cache_key)
+
+async def get_nearby_doctors(specialty, location):
+    with core.stage("places"):
+        return await _get_nearby_doctors(specialty, location)
+
+async def _get_nearby_doctors(specialty, location):
+    if not core.GOOGLE_API_KEY:
+        logger.error("GOOGLE_API_KEY not set.")
+        return []
+    plan = core.doctors_lookup_plan(specialty, location)
+    if plan is None:
+        return []
+    key, query_specialty, location_str = plan
+    doctors = core.cached_doctors(key, query_specialty, location_str)
+    if doctors is not None:
+        return doctors
+    return await doctors_flight.do(key, lambda: _fetch_nearby_doctors(key, query_specialty, location_str))
+
+async def _fetch_nearby_doctors(key, query_specialty, location_str):
+    try:
+        url, params = core.places_request(query_specialty, location_str)
+        with core.upstream_call("google_places"):
+            r = await http_client().get(url, params=params, timeout=20)
+        r.raise_for_status()
+        doctors = core.places_response_to_doctors(r.json())
+    except Exception as e:
+        logger.error(f"Places API error: {e}")
+        return []
+    core.doctors_cache.set(key, (core.doctors_for_cache(doctors), time.time()))
+    return doctors
+
+async def annotate_image(base64_image, labels=True, text=True, document=False):
+    with core.stage("vision"):
+        return await _annotate_image(base64_image, labels, text, document)
+
+async def _annotate_image(base64_image, labels, text, document):
+    if not core.GOOGLE_VISION_API_KEY:
+        logger.error("GOOGLE_VISION_API_KEY not set.")
+        return {"labels": [], "text": ""}
+    # decoding and re-encoding the image is CPU work; keep it off the event loop
+    req = await asyncio.to_thread(core.vision_annotate_request, base64_image, labels, text, document)
+    if req is None:
+        return {"labels": [], "text": ""}
+    try:
+        url, body = req
+        with core.upstream_call("google_vision"):
+            res = await http_client().post(url, json=body, timeout=60 if text else 30)
+        res.raise_for_status()
+        return core.vision_response_to_annotations(res.json())
+    except Exception as e:
+        logger.error(f"Vision annotate error: {e}")
+        return {"labels": [], "text": ""}
+
+def start_doctor_prefetch(text, location):
+    if not (core.SPECULATIVE_DOCTORS and location):
+        return None
+    specialty = core.predict_specialty(text)
+    return specialty, asyncio.ensure_future(get_nearby_doctors(specialty, location))
+
+async def resolve_nearby_doctors(prefetch, suggested_doctor, location):
+    if not location:
+        return []
+    if prefetch is not None:
+        specialty, task = prefetch
+        if core.canonical_specialty(suggested_doctor) == specialty:
+            core.bump("doctor_speculation_hits")
+            with core.stage("places_prefetch_wait"):
+                return await task
+        core.bump("doctor_speculation_misses")
+        task.cancel()
+    return await get_nearby_doctors(suggested_doctor, location)
+
+# --- Async route handlers: (status, body dict) ---
+async def analyze_symptoms(data, headers):
+    symptoms = data.get("symptoms")
+    profile_data = data.get("profile", {})
+    location = data.get("location")
+    language = data.get("language", "English")
+
+    if not symptoms:
+        return 400, {"error": "Symptoms required"}
+
+    logger.info(f"[ANALYZE] Input: {symptoms}, User ID: {profile_data.get('user_id')}")
+    profile_context = core.build_profile_context(profile_data)
+    block = await asyncio.to_thread(core.red_flag_triage, symptoms)
+
+    prefetch = start_doctor_prefetch(symptoms, location)
+    ai = await generate_openai_response(symptoms, language, profile_context, "symptoms", use_cache=not _cache_bypassed(headers))
+    if not ai:
+        error = "AI analysis failed to generate response from OpenAI"
+        if block is not None:
+            return 200, core.triage_fallback(block, error)
+        return core.ai_failure_status(), {"error": error}
+
+    result = core.apply_triage(core.parse_openai_json(ai), block)
+    result["nearby_doctors"] = await resolve_nearby_doctors(prefetch, result.get("suggested_doctor", "general"), location)
+    return 200, result
+
+async def analyze_photo(data, headers):
+    image_base64 = data.get("image_base64")
+    profile_data = data.get("profile", {})
+    location = data.get("location")
+
+    if not image_base64:
+        return 400, {"error": "No image provided"}
+
+    raw = await asyncio.to_thread(core.decode_base64_upload, image_base64)
+    use_cache = not _cache_bypassed(headers)
+    fingerprint = await asyncio.to_thread(core.image_fingerprint, raw)
+    profile_context = core.build_profile_context(profile_data)
+    analysis_kind = core.photo_analysis_kind(profile_context)
+
+    # near-duplicate lookup scans the stored hashes
+    cached = await asyncio.to_thread(core.image_cache.get, fingerprint, analysis_kind) if use_cache else None
+    if cached is not None:
+        parsed = dict(cached)
+        parsed["nearby_doctors"] = await resolve_nearby_doctors(None, parsed.get("suggested_doctor", "general"), location)
+        return 200, parsed
+
+    annotations = await asyncio.to_thread(core.image_cache.get, fingerprint, "vision") if use_cache else None
+    if annotations is None:
+        annotations = await annotate_image(raw, labels=True, text=True)
+        if annotations["labels"] or annotations["text"]:
+            core.image_cache.set(fingerprint, "vision", annotations)
+    labels, text = annotations["labels"], annotations["text"]
+
+    desc = f"The image provides visual cues: {', '.join(labels)}." if labels else "The image provides limited visual cues."
+    if text:
+        desc += f' Additionally, text detected in the image: "{text}"'
+    block = await asyncio.to_thread(core.red_flag_triage, text)
+
+    prefetch = start_doctor_prefetch(desc, location)
+    ai = await generate_openai_response(desc, "English", profile_context, "photo_analysis", use_cache=use_cache)
+    if not ai:
+        error = "AI analysis failed to generate response from OpenAI"
+        if block is not None:
+            return 200, core.triage_fallback(block, error)
+        return core.ai_failure_status(), {"error": error}
+
+    parsed = core.apply_triage(core.parse_openai_json(ai), block)
+    parsed["image_labels"] = labels
+    parsed["image_description"] = desc
+    core.image_cache.set(fingerprint, analysis_kind, dict(parsed))
+    parsed["nearby_doctors"] = await resolve_nearby_doctors(prefetch, parsed.get("suggested_doctor", "general"), location)
+    return 200, parsed
+
+async def analyze_lab_report(data, headers):
+    image_base64 = data.get("image_base64")
+    extracted_text_frontend = data.get("extracted_text", "")
+    location = data.get("location")
+    profile_data = data.get("profile", {})
+    language = data.get("language", "English")
+
+    final_text = ""
+    if extracted_text_frontend and extracted_text_frontend != core.PDF_SENTINEL:
+        final_text = extracted_text_frontend
+    elif data.get("pdf_base64"):
+        final_text = await asyncio.to_thread(core.pdf_base64_to_text, data["pdf_base64"])
+    elif image_base64:
+        final_text = (await annotate_image(image_base64, labels=False, text=True, document=True))["text"]
+
+    if not final_text:
+        return 400, {"error": "Missing lab report text or image to analyze"}
+
+    profile_context = core.build_profile_context(profile_data)
+    block = await asyncio.to_thread(core.red_flag_triage, final_text, core.lab_red_flags)
+    prompt_text, prompt_type, rows = await asyncio.to_thread(core.lab_report_prompt, final_text)
+    prefetch = start_doctor_prefetch(final_text, location)
+    ai = await analyze_lab_text(prompt_text, prompt_type, language, profile_context, use_cache=not _cache_bypassed(headers))
+    if not ai:
+        error = "AI failed to generate response for lab report"
+        if block is not None:
+            return 200, dict(core.triage_fallback(block, error), extracted_text=final_text)
+        return core.ai_failure_status(), {"error": error}
+
+    parsed = core.apply_triage(core.parse_openai_json(ai), block)
+    parsed["nearby_doctors"] = await resolve_nearby_doctors(prefetch, parsed.get("suggested_doctor", "general"), location)
+    parsed["extracted_text"] = final_text
+    parsed["lab_values"] = rows
+    return 200, parsed
+
+async def api_doctors(data, headers):
+    specialty = data.get("specialty") or "general"
+    location = data.get("location")
+    return 200, {"doctors": await get_nearby_doctors(specialty, location)}
+
+# path -> (handler, error message used by the Flask route for unexpected failures)
+ASYNC_ROUTES = {
+    "/analyze": (analyze_symptoms, "Failed to analyze symptoms"),
+    "/photo-analyze": (analyze_photo, "Failed to analyze image"),
+    "/analyze-lab-report": (analyze_lab_report, "Failed to analyze lab report"),
+    "/api/doctors": (api_doctors, "Failed to fetch doctors"),
+}
+
+# --- ASGI plumbing ---
+def _cache_bypassed(headers):
+    if headers.get("x-cache-bypass", "").lower() in ("1", "true", "yes"):
+        return True
+    return "no-cache" in headers.get("cache-control", "").lower()
+
+def _unauthorized(headers):
+    auth_header = headers.get("authorization")
+    if not auth_header or not auth_header.startswith("Bearer "):
+        logger.warning("Unauthorized: Bearer token missing or malformed.")
+        return {"error": "Unauthorized: Bearer token missing or malformed"}
+    if auth_header.split(" ", 1)[1] != core.API_AUTH_TOKEN:
+        logger.warning("Unauthorized: Invalid API token.")
+        return {"error": "Unauthorized: Invalid API token"}
+    return None
+
+async def _read_body(receive):
+    chunks = []
+    more = True
+    while more:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        more = message.get("more_body", False)
+    return b"".join(chunks)
+
+async def _send_json(send, status, body, extra_headers=()):
+    # same encoding as Flask's jsonify (sorted keys, compact, trailing newline)
+    payload = (json.dumps(body, sort_keys=True, separators=(",", ":")) + "\n").encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(payload)).encode()),
+            (b"access-control-allow-origin", b"*"),
+            *extra_headers,
+        ],
+    })
+    await send({"type": "http.response.body", "body": payload})
+
+async def _handle(scope, receive, send):
+    handler, failure_message = ASYNC_ROUTES[scope["path"]]
+    headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope.get("headers", [])}
+    started = time.perf_counter()
+    timings = {}
+    core._server_timing.set(timings)
+    body = await _read_body(receive)
+
+    denied = _unauthorized(headers)
+    if denied is not None:
+        return await _send_json(send, 401, denied)
+    try:
+        data = json.loads(body) if body else {}
+        if not isinstance(data, dict):
+            data = {}
+        async with inflight_limit():
+            status, result = await handler(data, headers)
+    except core.UploadError as e:
+        status, result = e.status, {"error": str(e)}
+    except Exception as e:
+        logger.exception(f"Error in async {scope['path']}")
+        status, result = 500, {"error": failure_message, "details": str(e)}
+    core.request_seconds.observe(handler.__name__, time.perf_counter() - started)
+    extra = [(b"server-timing", core.server_timing_header(timings).encode())] if timings else []
+    if status == 503 and core.openai_breaker.failing_fast():
+        extra.append((b"retry-after", str(max(1, int(core.openai_breaker.retry_after() + 0.5))).encode()))
+    await _send_json(send, status, result, extra)
+
+def _wants_stream(scope):
+    """`Accept: text/event-stream`: /analyze answers with its SSE stream, which only the
+    Flask side implements; the native handlers reply with one JSON body."""
+    return any(k.lower() == b"accept" and b"text/event-stream" in v for k, v in scope.get("headers", []))
+
+def _wants_wsgi(scope):
+    # SSE requests go to the Flask stream, `Prefer: respond-async` requests to the Flask
+    # job queue, binary uploads (multipart or raw image/pdf bodies) to Flask's upload
+    # parsing, and requests with an Idempotency-Key to the Flask reply store
+    if _wants_stream(scope):
+        return True
+    for k, v in scope.get("headers", []):
+        k = k.lower()
+        if (k == b"prefer" and b"respond-async" in v) or k == b"idempotency-key":
+            return True
+        if k == b"content-type" and not v.lower().startswith(b"application/json"):
+            return True
+    return False
+
+_wsgi = WSGIMiddleware(core.app, workers=ASYNC_WSGI_THREADS)
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if _http is not None:
+                    await _http.aclose()
+                await aclient.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] == "http" and scope["method"] == "POST" and scope["path"] in ASYNC_ROUTES and not _wants_wsgi(scope):
+        return await _handle(scope, receive, send)
+    return await _wsgi(scope, receive, send)
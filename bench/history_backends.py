@@ -0,0 +1,189 @@
+"""Benchmark: /api/history over Supabase REST vs. the pooled Postgres path.
+
+Creates the history table (plus the profiles/medications tables account
+deletion touches) in the database at DATABASE_URL, seeds it, and times the
+same requests against HISTORY_BACKEND=rest and HISTORY_BACKEND=postgres:
+full history, the list view, a keyset page, and a POST.
+
+The REST side is the stub Supabase from stubs.py by default (seeded with the
+same rows); its --rest-latency adds a fixed per-request delay standing in for
+the network hop. Point --rest-url at a real PostgREST (with --anon-key) that
+serves the same database for an apples-to-apples run. Responses skip the
+history cache (X-Cache-Bypass) so every request reaches the backend.
+
+    DATABASE_URL=postgresql://postgres@localhost:5432/postgres python bench/history_backends.py
+    python bench/history_backends.py --rows 500 --requests 300 --concurrency 8
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import jwt
+import psycopg2
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [HERE, os.path.dirname(HERE)]
+from stubs import ANALYSIS, StubConfig, start_stubs, stub_env  # noqa: E402
+
+TOKEN = "bench-token"
+SECRET = "bench-jwt-secret-" + "x" * 32
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS history (
+    id uuid PRIMARY KEY,
+    user_id uuid NOT NULL,
+    query text,
+    detected_condition text,
+    medical_analysis text,
+    remedies jsonb,
+    urgency text,
+    medicines jsonb,
+    suggested_doctor text,
+    raw_text text,
+    timestamp timestamptz NOT NULL DEFAULT now(),
+    nursing_explanation text,
+    personal_notes text,
+    relevant_information text,
+    why_happening_explanation text,
+    immediate_action text,
+    nurse_tips text,
+    citations jsonb
+);
+CREATE INDEX IF NOT EXISTS history_user_timestamp_idx ON history (user_id, timestamp DESC, id DESC);
+CREATE TABLE IF NOT EXISTS profiles (user_id uuid PRIMARY KEY, data jsonb);
+CREATE TABLE IF NOT EXISTS medications (id bigserial PRIMARY KEY, user_id uuid NOT NULL, name text);
+"""
+
+def percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(round(q / 100 * (len(sorted_values) - 1))))]
+
+def history_row(user_id, i, start):
+    return {
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "query": f"symptom report {i}",
+        "detected_condition": ANALYSIS["detected_condition"],
+        "medical_analysis": ANALYSIS["medical_analysis"],
+        "remedies": ANALYSIS["remedies"],
+        "urgency": ANALYSIS["urgency"],
+        "medicines": ANALYSIS["medications"],
+        "suggested_doctor": ANALYSIS["suggested_doctor"],
+        "raw_text": json.dumps(ANALYSIS),
+        "timestamp": (start + timedelta(minutes=i)).isoformat() + "+00:00",
+        "nursing_explanation": ANALYSIS["nursing_explanation"],
+        "personal_notes": ANALYSIS["personal_notes"],
+        "relevant_information": ANALYSIS["relevant_information"],
+        "why_happening_explanation": ANALYSIS["why_happening_explanation"],
+        "immediate_action": ANALYSIS["immediate_action"],
+        "nurse_tips": ANALYSIS["nurse_tips"],
+        "citations": ANALYSIS["citations"],
+    }
+
+def seed(dsn, sslmode, users, rows_per_user):
+    import app
+    conn = psycopg2.connect(dsn, sslmode=sslmode)
+    with conn, conn.cursor() as cur:
+        cur.execute(SCHEMA)
+        cur.execute("DELETE FROM history WHERE user_id = ANY(%s::uuid[])", (users,))
+    conn.close()
+    start = datetime.utcnow() - timedelta(days=30)
+    rows = [history_row(u, i, start) for u in users for i in range(rows_per_user)]
+    for u in users:
+        app.db_insert_history(None, [r for r in rows if r["user_id"] == u])
+    return rows
+
+def run(client, requests, concurrency, make_request):
+    timings, errors = [], 0
+
+    def one(i):
+        t0 = time.perf_counter()
+        status = make_request(client, i)
+        return time.perf_counter() - t0, status
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        t0 = time.perf_counter()
+        results = list(pool.map(one, range(requests)))
+        wall = time.perf_counter() - t0
+    for seconds, status in results:
+        timings.append(seconds)
+        errors += status >= 400
+    timings.sort()
+    return {"p50": percentile(timings, 50) * 1000, "p95": percentile(timings, 95) * 1000,
+            "rps": requests / wall, "errors": errors}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=os.getenv("DATABASE_URL"), help="Postgres to seed and query (default: $DATABASE_URL)")
+    parser.add_argument("--sslmode", default=os.getenv("DATABASE_SSLMODE", "disable"))
+    parser.add_argument("--rls-role", default="", help="role to SET LOCAL per transaction (needs Supabase-style policies)")
+    parser.add_argument("--rest-url", help="real PostgREST/Supabase URL serving the same database (default: stub)")
+    parser.add_argument("--anon-key", default="", help="apikey header for --rest-url")
+    parser.add_argument("--jwt-secret", default=SECRET, help="HS256 secret the REST side also verifies")
+    parser.add_argument("--rest-latency", type=float, default=0.0, help="extra seconds per stub Supabase request")
+    parser.add_argument("--users", type=int, default=5)
+    parser.add_argument("--rows", type=int, default=200, help="history rows per user")
+    parser.add_argument("--page", type=int, default=20, help="limit for the list/page requests")
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error("set DATABASE_URL or pass --database-url")
+
+    server, state = start_stubs(StubConfig(supabase_latency=args.rest_latency))
+    env = stub_env(server)
+    if args.rest_url:
+        env.update(SUPABASE_URL=args.rest_url, SUPABASE_ANON_KEY=args.anon_key)
+    os.environ.update(env, API_AUTH_TOKEN=TOKEN, DATABASE_URL=args.database_url, DATABASE_SSLMODE=args.sslmode,
+                      DB_RLS_ROLE=args.rls_role, SUPABASE_JWT_SECRET=args.jwt_secret,
+                      DB_POOL_MAX=str(max(4, args.concurrency + 1)), HISTORY_WRITE_MODE="sync")
+    import app
+
+    users = [str(uuid.UUID(int=i + 1)) for i in range(args.users)]
+    tokens = {u: jwt.encode({"sub": u, "aud": "authenticated", "role": "authenticated",
+                             "exp": int(time.time()) + 3600}, args.jwt_secret, algorithm="HS256") for u in users}
+    rows = seed(args.database_url, args.sslmode, users, args.rows)
+    if not args.rest_url:
+        state.history.extend(dict(r) for r in rows)
+    cursors = {u: sorted((r["timestamp"], r["id"]) for r in rows if r["user_id"] == u)[len(rows) // len(users) // 2]
+               for u in users}
+
+    def headers(u):
+        return {"Authorization": f"Bearer {TOKEN}", "X-Supabase-Auth": tokens[u], "X-Cache-Bypass": "1"}
+
+    def get(query):
+        def make_request(client, i):
+            u = users[i % len(users)]
+            return client.get(f"/api/history?user_id={u}{query(u)}", headers=headers(u)).status_code
+        return make_request
+
+    def post(client, i):
+        u = users[i % len(users)]
+        body = {"user_id": u, "query": f"bench post {i}", "response": ANALYSIS}
+        return client.post("/api/history", headers=headers(u), json=body).status_code
+
+    scenarios = [
+        (f"GET full ({args.rows} rows)", get(lambda u: "")),
+        (f"GET view=list limit={args.page}", get(lambda u: f"&view=list&limit={args.page}")),
+        (f"GET keyset page limit={args.page}", get(lambda u: f"&limit={args.page}&before={quote(','.join(cursors[u]))}")),
+        ("POST", post),
+    ]
+    client = app.app.test_client()
+    print(f"{args.users} users x {args.rows} rows, {args.requests} requests per scenario, concurrency {args.concurrency}, "
+          f"REST: {'stub' if not args.rest_url else args.rest_url}\n")
+    print(f"{'scenario':<32} {'backend':<9} {'p50 ms':>8} {'p95 ms':>8} {'req/s':>8} {'errors':>7}")
+    for name, make_request in scenarios:
+        for backend in ("rest", "postgres"):
+            app.HISTORY_BACKEND = backend
+            run(client, min(20, args.requests), args.concurrency, make_request)  # warm pools and prepared statements
+            r = run(client, args.requests, args.concurrency, make_request)
+            print(f"{name:<32} {backend:<9} {r['p50']:>8.2f} {r['p95']:>8.2f} {r['rps']:>8.0f} {r['errors']:>7}")
+    print(f"\npool: {json.dumps(app.db_pool_stats())}")
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Benchmark: Vision image preprocessing (EXIF fix, per-feature downscale, re-encode).
+
+For each sample image, reports the bytes the photo and lab report routes would
+send to Vision before and after preprocessing, the time the preprocessing
+costs, and the upload time saved at a given uplink speed.
+
+With no arguments the samples are synthetic phone photos of a printed lab
+report (12 MP and 4 MP JPEGs, one rotated via EXIF, and a PNG screenshot).
+Pass your own files to measure those instead.
+
+--ocr also sends each image to the real Vision API before and after
+preprocessing (needs GOOGLE_VISION_API_KEY) and compares the OCR text: with
+the ground truth for synthetic samples, or with the original's OCR for yours.
+
+    python bench/image_preprocess.py
+    python bench/image_preprocess.py scans/*.jpg --ocr
+"""
+import argparse
+import difflib
+import io
+import os
+import sys
+import time
+
+from PIL import Image, ImageDraw, ImageFilter, ImageFont
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import app  # noqa: E402
+from stubs import LAB_TEXT  # noqa: E402
+
+def lab_report_photo(width, height, orientation=1):
+    """A printed lab report photographed slightly off-axis, as phone JPEG bytes."""
+    page = Image.new("RGB", (width, height), (236, 233, 226))
+    draw = ImageDraw.Draw(page)
+    font = ImageFont.load_default(size=max(12, height // 70))
+    y = height // 12
+    for line in (LAB_TEXT * 2).splitlines():
+        draw.text((width // 12, y), line, fill=(25, 25, 30), font=font)
+        y += int(font.size * 1.6)
+    page = page.rotate(1.5, resample=Image.BICUBIC, fillcolor=(120, 110, 100)).filter(ImageFilter.GaussianBlur(0.6))
+    exif = Image.Exif()
+    if orientation != 1:
+        # store the pixels as the sensor saw them and let EXIF say how to turn them upright
+        page = page.transpose(Image.ROTATE_90)
+        exif[0x0112] = orientation
+    buf = io.BytesIO()
+    page.save(buf, "JPEG", quality=92, exif=exif.tobytes())
+    return buf.getvalue()
+
+def screenshot_png(width, height):
+    buf = io.BytesIO()
+    img = Image.open(io.BytesIO(lab_report_photo(width, height)))
+    img.save(buf, "PNG")
+    return buf.getvalue()
+
+def synthetic_samples():
+    return [
+        ("photo_12mp.jpg", lab_report_photo(4000, 3000), LAB_TEXT),
+        ("photo_4mp_exif6.jpg", lab_report_photo(2304, 1728, orientation=6), LAB_TEXT),
+        ("screenshot.png", screenshot_png(1170, 2532), LAB_TEXT),
+    ]
+
+def request_bytes(body):
+    return sum(len(r["image"]["content"]) for r in body["requests"])
+
+def vision_ocr(body):
+    url = f"{app.GOOGLE_VISION_URL}?key={app.GOOGLE_VISION_API_KEY}"
+    res = app.http_session("google_vision").post(url, json=body, timeout=60)
+    res.raise_for_status()
+    return app.vision_response_to_annotations(res.json())["text"]
+
+def similarity(a, b):
+    return difflib.SequenceMatcher(None, " ".join(a.split()), " ".join(b.split())).ratio()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("images", nargs="*", help="image files (default: synthetic lab report photos)")
+    parser.add_argument("--repeat", type=int, default=5, help="preprocessing runs per image, for timing")
+    parser.add_argument("--uplink-mbps", type=float, default=10.0, help="server -> Vision bandwidth for the upload estimate")
+    parser.add_argument("--ocr", action="store_true", help="compare real Vision OCR before/after (needs GOOGLE_VISION_API_KEY)")
+    args = parser.parse_args()
+
+    samples = [(os.path.basename(p), open(p, "rb").read(), None) for p in args.images] or synthetic_samples()
+    print(f"label edge {app.VISION_LABEL_MAX_EDGE}px, OCR edge {app.VISION_OCR_MAX_EDGE}px, "
+          f"{app.VISION_IMAGE_FORMAT} q{app.VISION_IMAGE_QUALITY}, uplink {args.uplink_mbps} Mbit/s\n")
+    print(f"{'image':<22} {'route':<6} {'before':>10} {'after':>10} {'saved':>6} {'prep ms':>8} {'upload ms saved':>16}")
+    for name, raw, truth in samples:
+        for route, labels, document in (("photo", True, False), ("lab", False, True)):
+            app.IMAGE_PREPROCESS = False
+            _, before = app.vision_annotate_request(raw, labels=labels, text=True, document=document)
+            app.IMAGE_PREPROCESS = True
+            timings = []
+            for _ in range(args.repeat):
+                t0 = time.perf_counter()
+                _, after = app.vision_annotate_request(raw, labels=labels, text=True, document=document)
+                timings.append(time.perf_counter() - t0)
+            b, a = request_bytes(before), request_bytes(after)
+            upload_saved = (b - a) * 8 / (args.uplink_mbps * 1e6) * 1000
+            print(f"{name:<22} {route:<6} {b:>10,} {a:>10,} {1 - a / b:>6.0%} "
+                  f"{sorted(timings)[len(timings) // 2] * 1000:>8.1f} {upload_saved:>16.0f}")
+            if args.ocr and route == "lab":
+                for req in (before, after):
+                    for r in req["requests"]:
+                        r["features"] = [{"type": "DOCUMENT_TEXT_DETECTION"}]
+                t0 = time.perf_counter()
+                text_before = vision_ocr(before)
+                t1 = time.perf_counter()
+                text_after = vision_ocr(after)
+                t2 = time.perf_counter()
+                reference = truth or text_before
+                print(f"{'':<22} ocr    similarity to {'truth' if truth else 'original'}: "
+                      f"before {similarity(reference, text_before):.3f}, after {similarity(reference, text_after):.3f}; "
+                      f"Vision {1000 * (t1 - t0):.0f} ms -> {1000 * (t2 - t1):.0f} ms")
+
+if __name__ == "__main__":
+    main()
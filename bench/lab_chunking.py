@@ -0,0 +1,121 @@
+"""Benchmark: map-reduce vs. single-call analysis of long lab reports.
+
+Builds multi-page lab reports (result tables from lab_extraction.py's
+generator, each page followed by free-text interpretive comments) and times
+app.analyze_lab_text() with LAB_CHUNKING_ENABLED off (one call with the whole
+text) and on (section chunks condensed concurrently, then a reduce call).
+Reports prompt tokens per path, chunk counts, how many chunks the local
+parser handled without a call, and the split time.
+
+The local lab value parser reads these synthetic tables well enough that
+the whole report would go out as a compact table and never reach the
+chunked path. So by default it is switched off (LAB_VALUES_ENABLED=0), to
+stand in for layouts it can't read. --parse keeps it on, which measures the
+app as configured.
+
+By default it runs against the stub OpenAI from stubs.py. Its latency is
+first-token latency, plus prompt tokens / --prefill-rate, plus completion
+tokens / --token-rate. So the stub numbers show how the two paths scale
+under that model, not how fast real OpenAI is. --openai runs against the real
+API instead (needs OPENAI_API_KEY).
+
+    python bench/lab_chunking.py
+    python bench/lab_chunking.py --pages 4,12,24 --threshold 4000 --chunk-tokens 2000
+    python bench/lab_chunking.py --openai --pages 8 --repeat 2
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [HERE, os.path.dirname(HERE)]
+import report_chunks  # noqa: E402
+from lab_extraction import make_report  # noqa: E402
+from stubs import StubConfig, start_stubs, stub_env  # noqa: E402
+
+COMMENTS = [
+    "Comment: Specimen slightly hemolyzed; potassium may be falsely elevated. Recommend redraw if clinically indicated.",
+    "Interpretation: Findings are consistent with iron deficiency. Correlate with clinical history and CBC indices.",
+    "Note: eGFR calculated using the CKD-EPI 2021 equation without a race coefficient.",
+    "Critical value called to Dr. Smith's office at 10:42 and read back by the nurse.",
+    "Pathologist review: mild anisocytosis and occasional target cells noted on the peripheral smear.",
+    "Method change effective 01/2024: vitamin D now measured by LC-MS/MS; results may run 5-10% lower.",
+]
+
+def long_report(pages, seed):
+    rng = random.Random(seed)
+    parts = []
+    for page in range(1, pages + 1):
+        text, _ = make_report(rng, page, noise=0.03)
+        comments = " ".join(rng.sample(COMMENTS, 3))
+        parts.append(f"{text}\n\n{comments}\n{comments}\nPage {page} of {pages}")
+    return "\n\n".join(parts)
+
+def prompt_tokens(app):
+    with app._stats_lock:
+        return sum(n for (_, kind), n in app._openai_tokens.items() if kind == "prompt")
+
+def run(app, text, chunked, repeat):
+    app.LAB_CHUNKING_ENABLED = chunked
+    prompt_text, prompt_type, _ = app.lab_report_prompt(text)
+    timings, tokens_before = [], prompt_tokens(app)
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        reply = app.analyze_lab_text(prompt_text, prompt_type, "English", "No profile provided.", use_cache=False)
+        timings.append(time.perf_counter() - t0)
+        if not reply:
+            raise SystemExit("analysis failed; see the log above")
+    return statistics.median(timings), (prompt_tokens(app) - tokens_before) / repeat, prompt_type
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", default="4,8,16,32", help="report lengths to test, in pages")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per path and length (median reported)")
+    parser.add_argument("--seed", type=int, default=5)
+    parser.add_argument("--threshold", type=int, default=None, help="LAB_CHUNK_THRESHOLD_TOKENS (default: app's)")
+    parser.add_argument("--chunk-tokens", type=int, default=None, help="LAB_CHUNK_TOKENS (default: app's)")
+    parser.add_argument("--workers", type=int, default=None, help="LAB_CHUNK_WORKERS (default: app's)")
+    parser.add_argument("--parse", action="store_true", help="keep the local lab value parser on")
+    parser.add_argument("--openai", action="store_true", help="use the real OpenAI API instead of the stub")
+    parser.add_argument("--latency", type=float, default=0.4, help="stub first-token latency, seconds")
+    parser.add_argument("--prefill-rate", type=float, default=8000.0, help="stub prompt tokens per second")
+    parser.add_argument("--token-rate", type=float, default=100.0, help="stub completion tokens per second")
+    args = parser.parse_args()
+
+    server = None
+    if not args.openai:
+        server, _ = start_stubs(StubConfig(openai_latency=args.latency, token_rate=args.token_rate, prefill_rate=args.prefill_rate))
+        os.environ.update(stub_env(server))
+    os.environ["LAB_VALUES_ENABLED"] = "1" if args.parse else "0"
+    for name, value in (("LAB_CHUNK_THRESHOLD_TOKENS", args.threshold), ("LAB_CHUNK_TOKENS", args.chunk_tokens),
+                        ("LAB_CHUNK_WORKERS", args.workers)):
+        if value is not None:
+            os.environ[name] = str(value)
+    import app
+
+    print(f"OpenAI: {'real API' if args.openai else f'stub ({args.latency}s + prompt/{args.prefill_rate:g} + completion/{args.token_rate:g} tok/s)'}")
+    print(f"threshold {app.LAB_CHUNK_THRESHOLD_TOKENS} tokens, chunks of ~{app.LAB_CHUNK_TOKENS}, {app.LAB_CHUNK_WORKERS} workers, "
+          f"token counts {'from tiktoken' if report_chunks.exact_counts() else 'estimated as chars/4'}\n")
+    print(f"{'pages':>5} {'tokens':>7} {'chunks':>6} {'parsed':>6} {'split ms':>8} "
+          f"{'single s':>9} {'prompt tok':>10} {'chunked s':>10} {'prompt tok':>10} {'speedup':>8}")
+    for pages in (int(p) for p in args.pages.split(",")):
+        text = long_report(pages, args.seed)
+        prompt_text = app.lab_report_prompt(text)[0]
+        tokens = report_chunks.count_tokens(prompt_text)
+        t0 = time.perf_counter()
+        chunks = report_chunks.split(prompt_text, max(app.LAB_CHUNK_TOKENS, -(-tokens // app.LAB_CHUNK_MAX)))
+        split_ms = (time.perf_counter() - t0) * 1000
+        parsed = sum(app.parsed_lab_chunk(c) is not None for c in chunks)
+        single, single_tokens, _ = run(app, text, False, args.repeat)
+        chunked, chunked_tokens, _ = run(app, text, True, args.repeat)
+        mapped = tokens > app.LAB_CHUNK_THRESHOLD_TOKENS
+        print(f"{pages:>5} {tokens:>7} {len(chunks) if mapped else '-':>6} {parsed if mapped else '-':>6} {split_ms:>8.2f} "
+              f"{single:>9.2f} {single_tokens:>10.0f} {chunked:>10.2f} {chunked_tokens:>10.0f} {single / chunked:>7.2f}x")
+    if server is not None:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
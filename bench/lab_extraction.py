@@ -0,0 +1,192 @@
+"""Benchmark: local lab value extraction (lab_values.py) on a labelled corpus.
+
+Generates synthetic OCR text of lab reports in the layouts seen in practice
+(column tables, "Name: value unit (range)" lines, pipe tables) wrapped in the
+usual letterhead, patient block and footer boilerplate, with spelling
+variation in names, units and flags and some OCR damage (--noise). Every row
+has ground truth, so the script reports extraction recall/precision, unit and
+low/normal/high flag accuracy, parse time per report, and how much smaller the
+report part of the prompt gets (parsed table vs. raw text, in tokens when
+tiktoken is installed and chars/4 otherwise).
+
+Pass OCR text files to measure those instead (speed and size only, no truth).
+--openai N sends N reports to the real model both ways (needs OPENAI_API_KEY)
+and compares prompt tokens and latency.
+
+    python bench/lab_extraction.py --reports 500
+    python bench/lab_extraction.py --openai 5
+    python bench/lab_extraction.py reports/*.txt
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [HERE, os.path.dirname(HERE)]
+import lab_values  # noqa: E402
+
+# analyte -> (printed names, unit variants, printed reference range, value range)
+PANEL = {
+    "glucose": (("Glucose", "Glucose, Fasting", "GLUCOSE", "Fasting Glucose"), ("mg/dL", "mg/dl"), "70-99", (60, 180)),
+    "hba1c": (("Hemoglobin A1c", "HbA1c", "HEMOGLOBIN A1C", "A1C"), ("%",), "4.0-5.6", (4.5, 9.5)),
+    "cholesterol": (("Total Cholesterol", "Cholesterol, Total", "CHOLESTEROL"), ("mg/dL",), "<200", (140, 260)),
+    "ldl": (("LDL Cholesterol", "LDL-C", "LDL Calc"), ("mg/dL",), "<100", (60, 190)),
+    "hdl": (("HDL Cholesterol", "HDL-C", "HDL"), ("mg/dL",), ">40", (28, 80)),
+    "triglycerides": (("Triglycerides", "TRIGLYCERIDES", "Trig"), ("mg/dL",), "<150", (60, 320)),
+    "hemoglobin": (("Hemoglobin", "HGB", "Hgb"), ("g/dL",), "12.0-15.5", (9.5, 17.0)),
+    "hematocrit": (("Hematocrit", "HCT"), ("%",), "36-46", (30, 52)),
+    "wbc": (("WBC", "White Blood Cell Count", "WBC Count"), ("x10^3/uL", "K/uL", "10^9/L"), "4.0-11.0", (2.5, 15.0)),
+    "platelets": (("Platelets", "Platelet Count", "PLT"), ("x10^3/uL", "K/uL"), "150-400", (90, 480)),
+    "sodium": (("Sodium", "NA", "Na"), ("mmol/L", "mEq/L"), "135-145", (128, 150)),
+    "potassium": (("Potassium", "K"), ("mmol/L", "mEq/L"), "3.5-5.1", (3.0, 6.0)),
+    "creatinine": (("Creatinine", "CREATININE", "Creatinine, Serum"), ("mg/dL",), "0.57-1.00", (0.4, 2.2)),
+    "egfr": (("eGFR", "Estimated GFR"), ("mL/min/1.73m2",), ">59", (35, 120)),
+    "alt": (("ALT", "ALT (SGPT)", "SGPT"), ("U/L", "IU/L"), "7-56", (8, 120)),
+    "ast": (("AST", "AST (SGOT)"), ("U/L", "IU/L"), "10-40", (10, 110)),
+    "tsh": (("TSH", "Thyroid Stimulating Hormone"), ("uIU/mL", "mIU/L", "µIU/mL"), "0.4-4.0", (0.05, 9.0)),
+    "vitamin_d": (("Vitamin D, 25-Hydroxy", "25-OH Vitamin D", "Vitamin D"), ("ng/mL",), "30-100", (8, 70)),
+    "ferritin": (("Ferritin",), ("ng/mL",), "15-150", (5, 300)),
+    "vitamin_b12": (("Vitamin B12", "B12"), ("pg/mL",), "200-900", (120, 1100)),
+}
+HEADERS = [
+    "QUEST REGIONAL LABORATORIES\n1450 Commerce Blvd, Suite 200, Springfield, IL 62704\nPhone: (555) 010-2233  Fax: (555) 010-2234\nCLIA: 14D0000000",
+    "CITY GENERAL HOSPITAL - DEPARTMENT OF PATHOLOGY\n500 Hospital Drive, Riverside CA 92501\nLab Director: A. Patel, MD",
+]
+PATIENT = ("Patient: DOE, JANE    DOB: 01/02/1980    Sex: F\nAccession: A2024-0{n}    Collected: 03/14/2024 07:45    "
+           "Received: 03/14/2024 09:10\nOrdering Physician: R. Smith, MD    NPI 1234567890\nSpecimen: Serum    Fasting: Yes")
+FOOTER = ("Results should be interpreted in the context of clinical findings. Reference ranges are method- and\n"
+          "population-specific. This report was electronically signed. Page 1 of 1.\n"
+          "For questions about this report call client services at (555) 010-2233, Monday-Friday 8am-6pm.")
+
+def ocr_noise(rng, line, rate):
+    """Typical OCR damage: O for 0, l for 1, a dropped space, a stray footnote mark."""
+    if rng.random() < rate:
+        line = line.replace("0", "O", 1)
+    if rng.random() < rate:
+        line = line.replace("1", "l", 1)
+    if rng.random() < rate:
+        line = line.replace("  ", " ", 1).replace(" mg", "mg", 1)
+    if rng.random() < rate:
+        i = rng.randrange(len(line))
+        line = line[:i] + rng.choice("*'.") + line[i:]
+    return line
+
+def make_report(rng, n, noise=0.0):
+    layout = rng.choice(("columns", "colon", "pipes"))
+    analytes = rng.sample(sorted(PANEL), rng.randint(6, len(PANEL)))
+    truth, lines = [], []
+    if layout == "columns":
+        lines.append(f"{'Test':<28}{'Result':<10}{'Flag':<6}{'Units':<14}Reference Range")
+    elif layout == "pipes":
+        lines.append("| Test | Result | Units | Reference | Flag |")
+    for analyte in analytes:
+        names, units, reference, (lo, hi) = PANEL[analyte]
+        name, unit = rng.choice(names), rng.choice(units)
+        value = round(rng.uniform(lo, hi), 1 if hi < 20 else 0)
+        value_text = f"{value:g}"
+        show_range = rng.random() > 0.15
+        expected = lab_values.flag_value(value, lab_values.parse_range(reference)) if show_range else None
+        printed = {"high": "H", "low": "L"}.get(expected, "")
+        if not show_range:
+            typical = lab_values.ANALYTES[analyte][1].get(lab_values.normalize_unit(unit))
+            expected = lab_values.flag_value(value, lab_values.parse_range(typical)) if typical else None
+        range_text = reference if show_range else ""
+        if layout == "columns":
+            lines.append(f"{name:<28}{value_text:<10}{printed:<6}{unit:<14}{range_text}")
+        elif layout == "colon":
+            ref = f" (Ref: {range_text})" if range_text else ""
+            lines.append(f"{name}: {value_text} {unit}{ref}{' ' + ('High' if printed == 'H' else 'Low') if printed else ''}")
+        else:
+            lines.append(f"| {name} | {value_text} | {unit} | {range_text} | {printed} |")
+        lines[-1] = ocr_noise(rng, lines[-1], noise)
+        truth.append({"analyte": analyte, "value": value, "unit": unit, "flag": expected})
+    text = "\n".join([rng.choice(HEADERS), PATIENT.format(n=n), "", *lines, "", FOOTER])
+    return text, truth
+
+def token_counter():
+    try:
+        import tiktoken
+        enc = tiktoken.get_encoding("o200k_base")
+        return "tokens", lambda s: len(enc.encode(s))
+    except Exception:
+        return "tokens (chars/4)", lambda s: max(1, len(s) // 4)
+
+def score(rows, truth):
+    found = {r["analyte"]: r for r in rows if r["analyte"]}
+    hits = [(t, found[t["analyte"]]) for t in truth if t["analyte"] in found and found[t["analyte"]]["value"] == t["value"]]
+    expected = {t["analyte"] for t in truth}
+    return {
+        "truth": len(truth),
+        "hits": len(hits),
+        "extracted": len(rows),
+        "spurious": sum(1 for r in rows if r["analyte"] not in expected),
+        "unit_ok": sum(1 for t, r in hits if r["unit"] == t["unit"]),
+        "flagged": sum(1 for t, _ in hits if t["flag"] is not None),
+        "flag_ok": sum(1 for t, r in hits if t["flag"] is not None and r["flag"] == t["flag"]),
+    }
+
+def openai_compare(reports, count):
+    import app
+    print(f"\nOpenAI ({count} reports, raw text vs. parsed table):")
+    print(f"{'':<8} {'prompt tok':>11} {'latency s':>10}")
+    for label, use_table in (("raw", False), ("table", True)):
+        tokens, latency = [], []
+        for text, _ in reports[:count]:
+            prompt, prompt_type, _ = app.lab_report_prompt(text) if use_table else (text, "lab_report", [])
+            t0 = time.perf_counter()
+            resp = app.client.chat.completions.create(
+                model="gpt-4o-mini", temperature=0.4, response_format={"type": "json_object"},
+                messages=app.build_analysis_messages(prompt, "English", "No profile provided.", prompt_type),
+            )
+            latency.append(time.perf_counter() - t0)
+            tokens.append(resp.usage.prompt_tokens)
+        print(f"{label:<8} {statistics.mean(tokens):>11.0f} {statistics.median(latency):>10.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="*", help="OCR text files (default: synthetic labelled corpus)")
+    parser.add_argument("--reports", type=int, default=300, help="synthetic reports to generate")
+    parser.add_argument("--seed", type=int, default=11)
+    parser.add_argument("--noise", type=float, default=0.03, help="per-line probability of each kind of OCR damage")
+    parser.add_argument("--openai", type=int, default=0, metavar="N", help="compare real OpenAI prompt tokens/latency on N reports")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    if args.files:
+        reports = [(open(p, encoding="utf-8", errors="replace").read(), None) for p in args.files]
+    else:
+        reports = [make_report(rng, n, args.noise) for n in range(args.reports)]
+    unit_name, count_tokens = token_counter()
+
+    totals, timings, raw_tokens, table_tokens, fallbacks = {}, [], 0, 0, 0
+    for text, truth in reports:
+        t0 = time.perf_counter()
+        rows, coverage = lab_values.extract(text)
+        table = lab_values.compact_table(rows, lab_values.other_findings(text))
+        timings.append(time.perf_counter() - t0)
+        usable = len(rows) >= 3 and coverage >= 0.8
+        fallbacks += not usable
+        raw_tokens += count_tokens(text)
+        table_tokens += count_tokens(table if usable else text)
+        if truth is not None:
+            for k, v in score(rows, truth).items():
+                totals[k] = totals.get(k, 0) + v
+
+    timings.sort()
+    print(f"{len(reports)} reports, {sum(len(t) for t, _ in reports) / len(reports):.0f} chars on average\n")
+    if totals:
+        print(f"recall     {totals['hits'] / totals['truth']:.3f}  ({totals['hits']}/{totals['truth']} rows with the right value)")
+        print(f"precision  {1 - totals['spurious'] / totals['extracted']:.3f}  ({totals['spurious']} spurious of {totals['extracted']} extracted)")
+        print(f"units      {totals['unit_ok'] / max(1, totals['hits']):.3f}")
+        print(f"flags      {totals['flag_ok'] / max(1, totals['flagged']):.3f}  (low/normal/high vs. truth)")
+    print(f"parse      p50 {timings[len(timings) // 2] * 1000:.2f} ms, p99 {timings[int(len(timings) * 0.99)] * 1000:.2f} ms per report")
+    print(f"report     {raw_tokens / len(reports):.0f} -> {table_tokens / len(reports):.0f} {unit_name} in the prompt per report "
+          f"({1 - table_tokens / raw_tokens:.0%} smaller; {fallbacks} reports fell back to raw text)")
+    if args.openai:
+        openai_compare(reports, args.openai)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Load test: sync gunicorn (app:app) vs. async mode (asgi:application) on /analyze.
+
+Starts the upstream stand-ins from stubs.py with a fixed completion latency,
+runs each server mode against them, and sends the same batch of concurrent
+/analyze requests to both. No real API keys are needed.
+
+    python bench/load_asgi_vs_wsgi.py --requests 200 --concurrency 100 --latency 1.0
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from loadtest import TOKEN, free_port, percentile, start_app
+from stubs import StubConfig, start_stubs, stub_env
+
+def drive(port, total, concurrency):
+    url = f"http://127.0.0.1:{port}/analyze"
+    headers = {"Authorization": f"Bearer {TOKEN}"}
+
+    def one(i):
+        t0 = time.perf_counter()
+        r = requests.post(url, json={"symptoms": f"headache variant {i}"}, headers=headers, timeout=300)
+        return time.perf_counter() - t0, r.status_code
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(total)))
+    elapsed = time.perf_counter() - started
+    latencies = sorted(lat for lat, status in results if status == 200)
+    errors = sum(1 for _, status in results if status != 200)
+    return elapsed, latencies, errors
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=1.0, help="stub completion latency in seconds")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=1, help="gunicorn threads for the sync mode")
+    args = parser.parse_args()
+
+    stubs, _ = start_stubs(StubConfig(openai_latency=args.latency, token_rate=1e9))
+    env = dict(stub_env(stubs), AI_CACHE_TTL="0")
+    print(f"{args.requests} x /analyze, concurrency {args.concurrency}, stub latency {args.latency}s, workers {args.workers}")
+    print(f"{'mode':<6} {'req/s':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'errors':>7}")
+    for mode in ("wsgi", "asgi"):
+        port = free_port()
+        proc = start_app(mode, port, env, args.workers, args.threads)
+        try:
+            elapsed, lat, errors = drive(port, args.requests, args.concurrency)
+        finally:
+            proc.terminate()
+            proc.wait(timeout=30)
+        print(f"{mode:<6} {args.requests / elapsed:8.1f} {percentile(lat, 50):8.3f} {percentile(lat, 95):8.3f} "
+              f"{percentile(lat, 99):8.3f} {errors:7d}")
+    stubs.shutdown()
+
+if __name__ == "__main__":
+    main()
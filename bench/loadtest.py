@@ -0,0 +1,243 @@
+"""Offline load test for the AskDoc backend.
+
+Starts the upstream stand-ins from stubs.py, boots the app under gunicorn
+(sync or async mode) pointed at them, and drives a weighted mix of
+/analyze, /photo-analyze, /analyze-lab-report and /api/history traffic.
+Prints request count, errors, req/s and p50/p95/p99 latency per endpoint.
+
+    python bench/loadtest.py --duration 30 --concurrency 32
+    python bench/loadtest.py --mode both --mix analyze=70,history_get=30 --json out.json
+"""
+import argparse
+import base64
+import io
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from stubs import StubConfig, LAB_TEXT, start_stubs, stub_env
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOKEN = "bench-token"
+USERS = [f"00000000-0000-0000-0000-{i:012d}" for i in range(20)]
+LOCATIONS = [{"lat": 40.7128, "lng": -74.0060}, {"lat": 34.0522, "lng": -118.2437}, {"lat": 41.8781, "lng": -87.6298}]
+SYMPTOMS = [
+    "headache and stiff neck since yesterday",
+    "itchy red rash on my forearm",
+    "burning stomach pain after meals",
+    "dry cough and mild fever for three days",
+    "feeling dizzy when standing up",
+    "lower back pain after lifting boxes",
+    "sore throat and earache",
+    "blood sugar was 180 after dinner",
+]
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return float("nan")
+    return sorted_values[min(len(sorted_values) - 1, int(round(q / 100 * (len(sorted_values) - 1))))]
+
+def start_app(mode, port, env, workers=1, threads=1):
+    """Run gunicorn with gunicorn.conf.py in the given mode; returns the process once /health answers."""
+    env = dict(os.environ, **env, GUNICORN_MODE=mode, WEB_CONCURRENCY=str(workers),
+               GUNICORN_THREADS=str(threads), API_AUTH_TOKEN=TOKEN)
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "-b", f"127.0.0.1:{port}", "--log-level", "warning"],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            if requests.get(f"http://127.0.0.1:{port}/health", timeout=1).ok:
+                return proc
+        except requests.RequestException:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError(f"{mode} server did not start")
+
+def sample_image_base64():
+    try:
+        from PIL import Image, ImageDraw
+    except ImportError:
+        return base64.b64encode(b"\x89PNG\r\n\x1a\n" + b"\x00" * 1024).decode()
+    img = Image.new("RGB", (1200, 900), "white")
+    draw = ImageDraw.Draw(img)
+    for i, line in enumerate(LAB_TEXT.splitlines()):
+        draw.text((40, 40 + i * 28), line, fill="black")
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=85)
+    return base64.b64encode(buf.getvalue()).decode()
+
+class Traffic:
+    """Builds one request per endpoint kind; `unique_ratio` of AI requests get text that defeats caches."""
+
+    def __init__(self, base_url, unique_ratio):
+        self.base_url = base_url
+        self.unique_ratio = unique_ratio
+        self.image_b64 = sample_image_base64()
+        self.local = threading.local()
+
+    def session(self):
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+            self.local.session.headers["Authorization"] = f"Bearer {TOKEN}"
+        return self.local.session
+
+    def _text(self, pool):
+        text = random.choice(pool)
+        if random.random() < self.unique_ratio:
+            text += f" (case {random.getrandbits(40):x})"
+        return text
+
+    def analyze(self):
+        body = {"symptoms": self._text(SYMPTOMS), "location": random.choice(LOCATIONS),
+                "profile": {"user_id": random.choice(USERS), "age": 42}}
+        return self.session().post(f"{self.base_url}/analyze", json=body, timeout=120)
+
+    def photo(self):
+        body = {"image_base64": self.image_b64, "location": random.choice(LOCATIONS), "profile": {"age": 30}}
+        return self.session().post(f"{self.base_url}/photo-analyze", json=body, timeout=120)
+
+    def lab(self):
+        if random.random() < 0.5:
+            body = {"image_base64": self.image_b64}
+        else:
+            body = {"extracted_text": self._text([LAB_TEXT])}
+        body["location"] = random.choice(LOCATIONS)
+        return self.session().post(f"{self.base_url}/analyze-lab-report", json=body, timeout=120)
+
+    def history_get(self):
+        return self.session().get(f"{self.base_url}/api/history", params={"user_id": random.choice(USERS)},
+                                  headers={"X-Supabase-Auth": "stub.jwt.token"}, timeout=60)
+
+    def history_post(self):
+        body = {"user_id": random.choice(USERS), "query": self._text(SYMPTOMS),
+                "response": {"detected_condition": "Stub", "urgency": "Low", "remedies": ["Rest"]}}
+        return self.session().post(f"{self.base_url}/api/history", json=body,
+                                   headers={"X-Supabase-Auth": "stub.jwt.token"}, timeout=60)
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+def run(base_url, mix, concurrency, duration, total, unique_ratio):
+    traffic = Traffic(base_url, unique_ratio)
+    names = list(mix)
+    weights = [mix[n] for n in names]
+    samples = {n: [] for n in names}
+    errors = {n: 0 for n in names}
+    lock = threading.Lock()
+    issued = [0]
+    deadline = time.perf_counter() + duration if duration else None
+
+    def worker():
+        while True:
+            with lock:
+                if total and issued[0] >= total:
+                    return
+                issued[0] += 1
+            if deadline and time.perf_counter() >= deadline:
+                return
+            name = random.choices(names, weights)[0]
+            t0 = time.perf_counter()
+            try:
+                ok = getattr(traffic, name)().status_code < 400
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - t0
+            with lock:
+                if ok:
+                    samples[name].append(elapsed)
+                else:
+                    errors[name] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(worker)
+    wall = time.perf_counter() - started
+
+    report = {"wall_seconds": round(wall, 3), "endpoints": {}}
+    for name in names:
+        lat = sorted(samples[name])
+        report["endpoints"][name] = {
+            "requests": len(lat) + errors[name],
+            "errors": errors[name],
+            "rps": round(len(lat) / wall, 2) if wall else 0.0,
+            "p50": round(percentile(lat, 50), 4),
+            "p95": round(percentile(lat, 95), 4),
+            "p99": round(percentile(lat, 99), 4),
+        }
+    return report
+
+def print_report(mode, report):
+    print(f"\n[{mode}] wall {report['wall_seconds']}s")
+    print(f"{'endpoint':<14} {'reqs':>6} {'errs':>5} {'req/s':>8} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for name, r in report["endpoints"].items():
+        print(f"{name:<14} {r['requests']:>6} {r['errors']:>5} {r['rps']:>8.2f} {r['p50']:>8.3f} {r['p95']:>8.3f} {r['p99']:>8.3f}")
+    if "upstream_calls" in report:
+        print("upstream calls:", ", ".join(f"{k}={v}" for k, v in sorted(report["upstream_calls"].items())))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=("wsgi", "asgi", "both"), default="wsgi")
+    parser.add_argument("--mix", default="analyze=50,photo=15,lab=15,history_get=15,history_post=5")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds to run (ignored if --requests is set)")
+    parser.add_argument("--requests", type=int, default=0)
+    parser.add_argument("--unique-ratio", type=float, default=0.5, help="share of AI requests that cannot hit a cache")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--openai-latency", type=float, default=0.8)
+    parser.add_argument("--token-rate", type=float, default=150.0)
+    parser.add_argument("--vision-latency", type=float, default=0.6)
+    parser.add_argument("--places-latency", type=float, default=0.3)
+    parser.add_argument("--supabase-latency", type=float, default=0.05)
+    parser.add_argument("--app-env", action="append", default=[], metavar="KEY=VALUE", help="extra env for the app")
+    parser.add_argument("--json", dest="json_out", help="write the report to this file")
+    args = parser.parse_args()
+
+    config = StubConfig(args.openai_latency, args.token_rate, args.vision_latency, args.places_latency, args.supabase_latency)
+    stubs, state = start_stubs(config)
+    env = stub_env(stubs)
+    env.update(dict(kv.split("=", 1) for kv in args.app_env))
+    mix = parse_mix(args.mix)
+
+    reports = {}
+    for mode in (("wsgi", "asgi") if args.mode == "both" else (args.mode,)):
+        port = free_port()
+        proc = start_app(mode, port, env, args.workers, args.threads)
+        state.calls.clear()
+        try:
+            report = run(f"http://127.0.0.1:{port}", mix, args.concurrency,
+                         None if args.requests else args.duration, args.requests, args.unique_ratio)
+        finally:
+            proc.terminate()
+            proc.wait(timeout=30)
+        report["upstream_calls"] = dict(state.calls)
+        reports[mode] = report
+        print_report(mode, report)
+
+    stubs.shutdown()
+    if args.json_out:
+        with open(args.json_out, "w") as f:
+            json.dump(reports, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""Benchmark: /analyze through an OpenAI outage, with and without the breaker.
+
+Drives steady concurrent /analyze traffic (cache bypassed) through three
+phases against the stub OpenAI: healthy, an outage (--fail-rate of chat
+calls fail with --fail-status after the usual latency, optionally with
+Retry-After), and recovery. It runs twice:
+- "resilient" is the app as configured: retry budget plus circuit breaker.
+- "retries only" has the breaker and budget switched off, so every request
+  retries OPENAI_MAX_RETRIES times, as the SDK's default retries used to.
+
+For each phase it reports how requests were answered, latency, and how many
+upstream attempts each request cost (load amplification). It also shows the
+breaker transitions, how long worker threads were held, and how soon
+requests succeeded again after the outage.
+
+    python bench/openai_resilience.py
+    python bench/openai_resilience.py --concurrency 16 --outage 20 --fail-status 429 --retry-after 1
+"""
+import argparse
+import logging
+import os
+import statistics
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [HERE, os.path.dirname(HERE)]
+from stubs import StubConfig, start_stubs, stub_env  # noqa: E402
+
+TOKEN = "bench-token"
+PHASES = ("healthy", "outage", "recovery")
+
+def percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(round(q / 100 * (len(sorted_values) - 1))))]
+
+def drive(app, config, state, args):
+    """Run the three phases; returns (per-phase results, breaker state changes, first success after the outage)."""
+    client = app.app.test_client()
+    headers = {"Authorization": f"Bearer {TOKEN}", "X-Cache-Bypass": "1"}
+    results, lock, stop = [], threading.Lock(), threading.Event()
+    phase = {"name": "healthy"}
+
+    def worker(n):
+        i = 0
+        while not stop.is_set():
+            name, t0 = phase["name"], time.perf_counter()
+            status = client.post("/analyze", json={"symptoms": f"mild headache {n}-{i}"}, headers=headers).status_code
+            with lock:
+                results.append((name, status, time.perf_counter() - t0, time.perf_counter()))
+            i += 1
+
+    threads = [threading.Thread(target=worker, args=(n,), daemon=True) for n in range(args.concurrency)]
+    transitions, attempts, last = [], {}, None
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for name, seconds, fail_rate in (("healthy", args.healthy, 0.0), ("outage", args.outage, args.fail_rate),
+                                     ("recovery", args.recovery, 0.0)):
+        phase["name"] = name
+        config.openai_fail_rate = fail_rate
+        if name == "recovery":
+            outage_end = time.perf_counter()
+        before = state.calls.get("openai", 0)
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            current = app.openai_breaker.stats()["state"]
+            if current != last:
+                transitions.append((time.perf_counter() - start, current))
+                last = current
+            time.sleep(0.05)
+        attempts[name] = state.calls.get("openai", 0) - before
+    stop.set()
+    for t in threads:
+        t.join()
+
+    recovered = next((done - outage_end for name, status, _, done in sorted(results, key=lambda r: r[3])
+                      if done > outage_end and status == 200), None)
+    summary = {}
+    for name in PHASES:
+        rows = [r for r in results if r[0] == name]
+        latencies = sorted(r[2] for r in rows) or [0.0]
+        summary[name] = {
+            "requests": len(rows),
+            "ok": sum(r[1] == 200 for r in rows),
+            "fast_503": sum(r[1] == 503 for r in rows),
+            "other_5xx": sum(r[1] >= 500 and r[1] != 503 for r in rows),
+            "p50": statistics.median(latencies),
+            "p95": percentile(latencies, 95),
+            "busy": sum(r[2] for r in rows),
+            "attempts": attempts[name],
+        }
+    return summary, transitions, recovered
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=8, help="client threads sending /analyze back to back")
+    parser.add_argument("--healthy", type=float, default=5.0, help="seconds before the outage")
+    parser.add_argument("--outage", type=float, default=15.0, help="seconds of failing OpenAI")
+    parser.add_argument("--recovery", type=float, default=20.0, help="seconds after the outage")
+    parser.add_argument("--fail-rate", type=float, default=1.0, help="share of chat calls failing during the outage")
+    parser.add_argument("--fail-status", type=int, default=503)
+    parser.add_argument("--retry-after", type=float, default=None, help="Retry-After seconds sent with failures")
+    parser.add_argument("--latency", type=float, default=0.3, help="stub OpenAI latency, seconds (failures included)")
+    parser.add_argument("--mode", choices=("both", "resilient", "retries-only"), default="both")
+    args = parser.parse_args()
+
+    config = StubConfig(openai_latency=args.latency, token_rate=1e9, places_latency=0.0,
+                        openai_fail_status=args.fail_status, openai_retry_after=args.retry_after)
+    server, state = start_stubs(config)
+    os.environ.update(stub_env(server), API_AUTH_TOKEN=TOKEN, SPECULATIVE_DOCTORS="0", GOOGLE_API_KEY="")
+    import app
+    logging.disable(logging.ERROR)  # one line per failed request otherwise
+
+    configured = (app.openai_breaker, app.openai_retry_budget)
+    modes = {"resilient": configured,
+             "retries-only": (app.CircuitBreaker("openai_breaker", 1, 10 ** 9, 2.0, 0), app.RetryBudget(10 ** 9, 10 ** 9, 1))}
+    print(f"{args.concurrency} clients; healthy {args.healthy:g}s, outage {args.outage:g}s ({args.fail_rate:.0%} {args.fail_status}"
+          f"{f', Retry-After {args.retry_after:g}s' if args.retry_after is not None else ''}), recovery {args.recovery:g}s; "
+          f"OPENAI_MAX_RETRIES={app.OPENAI_MAX_RETRIES}, breaker at {app.OPENAI_BREAKER_ERROR_RATE:.0%} of "
+          f">={app.OPENAI_BREAKER_MIN_CALLS} calls / {app.OPENAI_BREAKER_WINDOW:g}s, cooldown {app.OPENAI_BREAKER_COOLDOWN:g}s")
+    for mode in (("resilient", "retries-only") if args.mode == "both" else (args.mode,)):
+        app.openai_breaker, app.openai_retry_budget = modes[mode]
+        summary, transitions, recovered = drive(app, config, state, args)
+        print(f"\n{mode}")
+        print(f"  {'phase':<9} {'requests':>8} {'ok':>6} {'503':>6} {'5xx':>6} {'p50 s':>7} {'p95 s':>7} "
+              f"{'busy s':>7} {'attempts':>8} {'per req':>7}")
+        for name in PHASES:
+            r = summary[name]
+            print(f"  {name:<9} {r['requests']:>8} {r['ok']:>6} {r['fast_503']:>6} {r['other_5xx']:>6} {r['p50']:>7.2f} "
+                  f"{r['p95']:>7.2f} {r['busy']:>7.1f} {r['attempts']:>8} {r['attempts'] / max(1, r['requests']):>7.2f}")
+        if mode == "resilient":
+            print("  breaker: " + ", ".join(f"{s} at {t:.1f}s" for t, s in transitions))
+        print(f"  first success {f'{recovered:.2f}s' if recovered is not None else 'never'} after the outage ended")
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+"""Local stand-ins for the upstream APIs app.py talks to.
+
+One threaded HTTP server emulates:
+  POST /v1/chat/completions                    OpenAI (blocking and stream=true)
+  POST /v1/images:annotate, /v1/files:annotate Google Vision
+  GET  /maps/api/place/nearbysearch/json       Google Places Nearby Search
+  GET/POST/DELETE /rest/v1/<table>             Supabase PostgREST (history kept in memory)
+  POST /auth/v1/recover, DELETE /auth/v1/admin/users/<id>   Supabase Auth
+
+Latencies are configurable per upstream; chat completions also take a token
+rate so longer replies take longer, as they do upstream, and can be made to
+fail (openai_fail_rate, settable while running) to exercise the retry path.
+
+Standalone:  python bench/stubs.py --port 9100   (prints the env vars to export)
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+ANALYSIS = {
+    "detected_condition": "Tension-type headache",
+    "medical_analysis": "Symptoms described may be consistent with a tension-type headache, which is common and often linked to stress, posture or poor sleep.",
+    "why_happening_explanation": "Muscle tension in the neck and scalp could contribute, especially with long screen time.",
+    "immediate_action": "Consider resting in a quiet room, staying hydrated and taking a short break from screens.",
+    "nurse_tips": "Gentle neck stretches and regular meals may help. Keep a symptom diary to discuss with a clinician.",
+    "remedies": ["Hydration", "Rest", "Warm compress on the neck"],
+    "medications": [{"name": "acetaminophen", "dose": "as labelled", "time": "as needed"}],
+    "urgency": "Low",
+    "suggested_doctor": "General Practitioner",
+    "nursing_explanation": "Headaches like this are usually not dangerous but worth monitoring.",
+    "personal_notes": "Your profile lists no conditions that change this picture.",
+    "relevant_information": "Seek care urgently for sudden severe headache, fever with stiff neck, or weakness.",
+    "hipaa_disclaimer": "Disclaimer: I am a virtual AI assistant and not a medical doctor. This information is for educational purposes only and is not a substitute for professional medical advice. Always consult a qualified healthcare provider for diagnosis and treatment.",
+    "citations": [{"title": "Tension headache", "url": "https://medlineplus.gov/ency/article/000797.htm"}],
+    "history_summary": ["Headache", "Likely tension-type", "Self-care suggested"],
+}
+
+LAB_TEXT = """CITY GENERAL LABORATORY
+Patient: DOE, JANE   DOB: 01/02/1980
+Test                Result    Units     Reference Range
+Glucose, Fasting    112       mg/dL     70-99      H
+Hemoglobin A1c      6.1       %         4.0-5.6    H
+Total Cholesterol   185       mg/dL     <200
+LDL Cholesterol     118       mg/dL     <100       H
+HDL Cholesterol     52        mg/dL     >40
+Triglycerides       140       mg/dL     <150
+TSH                 2.1       uIU/mL    0.4-4.0
+Hemoglobin          13.2      g/dL      12.0-15.5
+"""
+
+class StubConfig:
+    def __init__(self, openai_latency=0.8, token_rate=150.0, vision_latency=0.6, places_latency=0.3, supabase_latency=0.05,
+                 prefill_rate=0.0, openai_fail_rate=0.0, openai_fail_status=503, openai_retry_after=None):
+        self.openai_latency = openai_latency      # seconds to first token
+        self.token_rate = token_rate              # completion tokens per second after that
+        self.prefill_rate = prefill_rate          # prompt tokens per second added to the first token (0: size-blind)
+        self.openai_fail_rate = openai_fail_rate  # share of chat calls that fail (after openai_latency); settable live
+        self.openai_fail_status = openai_fail_status
+        self.openai_retry_after = openai_retry_after  # Retry-After seconds sent with failures, if any
+        self.vision_latency = vision_latency
+        self.places_latency = places_latency
+        self.supabase_latency = supabase_latency
+
+class StubState:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.history = []
+        self.calls = {}
+        self.prefixes = set()  # system prompts seen, for emulating OpenAI's prompt cache
+
+    def count(self, name):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+def make_handler(config, state):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # headers and body go out in separate writes; with Nagle on, keep-alive clients stall ~40 ms on each
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        # --- plumbing ---
+        def _body(self):
+            length = int(self.headers.get("Content-Length", 0) or 0)
+            raw = self.rfile.read(length) if length else b""
+            try:
+                return json.loads(raw) if raw else {}
+            except ValueError:
+                return {}
+
+        def _json(self, status, payload, headers=None):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _empty(self, status):
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        # --- routes ---
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path.endswith("/place/nearbysearch/json"):
+                return self._places(parse_qs(url.query))
+            if url.path.startswith("/rest/v1/"):
+                return self._rest_get(url.path[len("/rest/v1/"):], parse_qs(url.query))
+            self._json(404, {"error": "not found"})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            body = self._body()
+            if url.path.endswith("/chat/completions"):
+                return self._chat(body)
+            if url.path.endswith("images:annotate"):
+                return self._vision(body)
+            if url.path.endswith("files:annotate"):
+                return self._vision_files(body)
+            if url.path.startswith("/rest/v1/"):
+                return self._rest_post(url.path[len("/rest/v1/"):], body)
+            if url.path == "/auth/v1/recover":
+                state.count("supabase_auth")
+                time.sleep(config.supabase_latency)
+                return self._json(200, {})
+            self._json(404, {"error": "not found"})
+
+        def do_DELETE(self):
+            url = urlparse(self.path)
+            state.count("supabase")
+            time.sleep(config.supabase_latency)
+            if url.path.startswith("/rest/v1/"):
+                user = (parse_qs(url.query).get("user_id") or ["eq."])[0][3:]
+                with state.lock:
+                    state.history = [r for r in state.history if r.get("user_id") != user]
+                return self._empty(204)
+            if url.path.startswith("/auth/v1/admin/users/"):
+                return self._empty(204)
+            self._json(404, {"error": "not found"})
+
+        def _chat(self, body):
+            state.count("openai")
+            if config.openai_fail_rate and random.random() < config.openai_fail_rate:
+                state.count("openai_failed")
+                time.sleep(config.openai_latency)
+                headers = {"Retry-After": str(config.openai_retry_after)} if config.openai_retry_after is not None else None
+                return self._json(config.openai_fail_status, {"error": {"message": "stub failure", "type": "server_error"}}, headers)
+            messages = body.get("messages", [])
+            finish_reason = "stop"
+            if body.get("response_format"):
+                content = json.dumps(ANALYSIS)
+            elif body.get("max_tokens") and messages:
+                # a condensing call (lab report map step): the start of the input, up to max_tokens
+                content = str(messages[-1].get("content", ""))
+                if len(content) > body["max_tokens"] * 4:
+                    content, finish_reason = content[:body["max_tokens"] * 4], "length"
+            else:
+                content = "This is a stub reply."
+            tokens = max(1, len(content) // 4)
+            prefix = str(messages[0].get("content", "")) if messages else ""
+            with state.lock:
+                seen = prefix in state.prefixes
+                state.prefixes.add(prefix)
+            # like OpenAI: a repeated prefix of 1024+ tokens is cached in 128-token steps
+            cached = len(prefix) // 4 // 128 * 128 if seen and len(prefix) // 4 >= 1024 else 0
+            usage = {
+                "prompt_tokens": sum(len(str(m.get("content", ""))) for m in messages) // 4,
+                "completion_tokens": tokens,
+                "prompt_tokens_details": {"cached_tokens": cached},
+            }
+            usage["total_tokens"] = usage["prompt_tokens"] + tokens
+            time.sleep(config.openai_latency + (usage["prompt_tokens"] / config.prefill_rate if config.prefill_rate else 0))
+            if body.get("stream"):
+                return self._chat_stream(content, tokens, usage if (body.get("stream_options") or {}).get("include_usage") else None)
+            time.sleep(tokens / config.token_rate)
+            self._json(200, {
+                "id": "chatcmpl-stub", "object": "chat.completion", "created": int(time.time()),
+                "model": body.get("model", "gpt-4o-mini"),
+                "choices": [{"index": 0, "finish_reason": finish_reason, "message": {"role": "assistant", "content": content}}],
+                "usage": usage,
+            })
+
+        def _chat_stream(self, content, tokens, usage):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            pieces = [content[i:i + 16] for i in range(0, len(content), 16)]
+            delay = tokens / config.token_rate / max(1, len(pieces))
+            for piece in pieces:
+                chunk = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": int(time.time()),
+                         "model": "gpt-4o-mini",
+                         "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                self.wfile.flush()
+                time.sleep(delay)
+            if usage is not None:
+                chunk = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": int(time.time()),
+                         "model": "gpt-4o-mini", "choices": [], "usage": usage}
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.close_connection = True
+
+        def _vision(self, body):
+            state.count("vision")
+            time.sleep(config.vision_latency)
+            features = {f.get("type") for r in body.get("requests", []) for f in r.get("features", [])}
+            response = {}
+            if "LABEL_DETECTION" in features:
+                response["labelAnnotations"] = [
+                    {"description": d, "score": s} for d, s in (("Skin", 0.95), ("Rash", 0.81), ("Arm", 0.77))
+                ]
+            if features & {"TEXT_DETECTION", "DOCUMENT_TEXT_DETECTION"}:
+                response["fullTextAnnotation"] = {"text": LAB_TEXT}
+            self._json(200, {"responses": [response]})
+
+        def _vision_files(self, body):
+            state.count("vision")
+            time.sleep(config.vision_latency)
+            pages = [{"fullTextAnnotation": {"text": LAB_TEXT}}]
+            self._json(200, {"responses": [{"responses": pages, "totalPages": 1}]})
+
+        def _places(self, query):
+            state.count("places")
+            time.sleep(config.places_latency)
+            results = [
+                {"name": f"Stub Clinic {i}", "vicinity": f"{i} Main St", "rating": 4.9 - i * 0.2,
+                 "place_id": f"stub-{i}", "opening_hours": {"open_now": i % 2 == 0}}
+                for i in range(8)
+            ]
+            self._json(200, {"results": results, "status": "OK"})
+
+        def _rest_get(self, table, query):
+            state.count("supabase")
+            time.sleep(config.supabase_latency)
+            if table != "history":
+                return self._json(200, [])
+            user = (query.get("user_id") or ["eq."])[0][3:]
+            with state.lock:
+                rows = [r for r in state.history if r.get("user_id") == user]
+            rows.sort(key=lambda r: (r.get("timestamp", ""), r.get("id", "")), reverse=True)
+            keyset = re.match(r'\(timestamp\.lt\."([^"]+)",and\(timestamp\.eq\."[^"]+",id\.lt\.([^)]+)\)\)', (query.get("or") or [""])[0])
+            if keyset:
+                before = (keyset.group(1), keyset.group(2))
+                rows = [r for r in rows if (r.get("timestamp", ""), r.get("id", "")) < before]
+            if "limit" in query:
+                rows = rows[:int(query["limit"][0])]
+            if "select" in query and query["select"][0] != "*":
+                cols = query["select"][0].split(",")
+                rows = [{c: r.get(c) for c in cols} for r in rows]
+            self._json(200, rows, {"Content-Range": f"0-{max(0, len(rows) - 1)}/{len(rows)}"})
+
+        def _rest_post(self, table, body):
+            state.count("supabase")
+            time.sleep(config.supabase_latency)
+            rows = body if isinstance(body, list) else [body]
+            ignore_duplicates = "resolution=ignore-duplicates" in self.headers.get("Prefer", "")
+            inserted = []
+            with state.lock:
+                existing = {r.get("id") for r in state.history}
+                for row in rows:
+                    row.setdefault("id", str(uuid.uuid4()))
+                    if ignore_duplicates and row["id"] in existing:
+                        continue
+                    inserted.append(row)
+                    if table == "history":
+                        state.history.append(row)
+            self._json(201, inserted)
+
+    return Handler
+
+def start_stubs(config=None, host="127.0.0.1", port=0):
+    """Start the stand-in server on a background thread; returns (server, state)."""
+    state = StubState()
+    server = ThreadingHTTPServer((host, port), make_handler(config or StubConfig(), state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+def stub_env(server):
+    """Env vars that point app.py (and asgi.py) at a running stub server."""
+    base = f"http://{server.server_address[0]}:{server.server_port}"
+    return {
+        "OPENAI_BASE_URL": f"{base}/v1",
+        "OPENAI_API_KEY": "stub",
+        "GOOGLE_API_KEY": "stub",
+        "GOOGLE_VISION_API_KEY": "stub",
+        "GOOGLE_PLACES_URL": f"{base}/maps/api/place/nearbysearch/json",
+        "GOOGLE_VISION_URL": f"{base}/v1/images:annotate",
+        "GOOGLE_VISION_FILES_URL": f"{base}/v1/files:annotate",
+        "SUPABASE_URL": base,
+        "SUPABASE_ANON_KEY": "stub",
+        "SUPABASE_SERVICE_ROLE_KEY": "stub",
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--openai-latency", type=float, default=0.8)
+    parser.add_argument("--token-rate", type=float, default=150.0)
+    parser.add_argument("--vision-latency", type=float, default=0.6)
+    parser.add_argument("--places-latency", type=float, default=0.3)
+    parser.add_argument("--supabase-latency", type=float, default=0.05)
+    args = parser.parse_args()
+    config = StubConfig(args.openai_latency, args.token_rate, args.vision_latency, args.places_latency, args.supabase_latency)
+    server, _ = start_stubs(config, args.host, args.port)
+    for k, v in stub_env(server).items():
+        print(f"export {k}={v}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Benchmark: red-flag triage matcher throughput (triage.py).
+
+Times RedFlagMatcher.triage() on short symptom inputs and on long OCR-like
+text (lab report lines with red-flag phrases, some negated, mixed in), and
+compares the Aho-Corasick pass with the naive approach of one regex search
+per phrase. Also checks a handful of labelled inputs so a phrase or negation
+change that breaks them shows up here.
+
+    python bench/triage_matcher.py
+    python bench/triage_matcher.py --sizes 1000,100000,1000000 --repeat 3
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [HERE, os.path.dirname(HERE)]
+import triage  # noqa: E402
+from stubs import LAB_TEXT  # noqa: E402
+
+SYMPTOMS = [
+    ("crushing chest pain radiating to my left arm and I'm sweating", True),
+    ("my mom's face is drooping on one side and her speech is slurred", True),
+    ("I can't breathe properly, lips turning blue", True),
+    ("worst headache of my life came on suddenly", True),
+    ("no relief from the crushing chest pain after resting", True),
+    ("I'm not sure, but I think I'm having a heart attack", True),
+    ("no chest pain, no shortness of breath, just a runny nose", False),
+    ("denies suicidal thoughts; sleeping poorly", False),
+    ("history of anaphylaxis to peanuts, today only a mild rash", False),
+    ("stroke ruled out last year; now a mild tension headache", False),
+    ("itchy red rash on my forearm for two days", False),
+    ("dry cough and mild fever for three days", False),
+]
+FILLER = [line for line in LAB_TEXT.splitlines() if line.strip()] + [
+    "Patient denies chest pain or shortness of breath.",
+    "Negative for anaphylaxis on prior testing.",
+    "Reports no relief from heartburn after meals.",
+    "Follow-up in 3 months. Continue current medications.",
+]
+
+def long_text(size, seed=7):
+    rng = random.Random(seed)
+    lines, total = [], 0
+    while total < size:
+        line = rng.choice(FILLER) if rng.random() > 0.02 else rng.choice([s for s, _ in SYMPTOMS])
+        lines.append(line)
+        total += len(line) + 1
+    return "\n".join(lines)[:size]
+
+def naive_matcher():
+    patterns = [(category, re.compile(r"\b" + r"\s+".join(map(re.escape, triage.tokenize(p))) + r"\b"))
+                for category, (phrases, _) in triage.RED_FLAGS.items() for p in phrases]
+
+    def scan(text):
+        normalised = " ".join(triage.tokenize(text))
+        return [category for category, pattern in patterns if pattern.search(normalised)]
+    return scan, len(patterns)
+
+def best_of(fn, arg, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(arg)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000,100000,1000000", help="long-input sizes in characters")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    matcher = triage.RedFlagMatcher()
+    build_ms = (time.perf_counter() - t0) * 1000
+    naive, n_patterns = naive_matcher()
+    print(f"{n_patterns} phrases, automaton {len(matcher.phrases.goto)} states, built in {build_ms:.1f} ms\n")
+
+    wrong = [(text, expected) for text, expected in SYMPTOMS if (matcher.triage(text) is not None) != expected]
+    for text, expected in wrong:
+        print(f"MISMATCH expected {'flag' if expected else 'no flag'}: {text}")
+    print(f"labelled inputs: {len(SYMPTOMS) - len(wrong)}/{len(SYMPTOMS)} correct")
+
+    loops = 2000
+    t0 = time.perf_counter()
+    for _ in range(loops // len(SYMPTOMS)):
+        for text, _ in SYMPTOMS:
+            matcher.triage(text)
+    per_input = (time.perf_counter() - t0) / (loops // len(SYMPTOMS) * len(SYMPTOMS))
+    print(f"short symptom inputs: {per_input * 1e6:.1f} us each\n")
+
+    print(f"{'chars':>10} {'flags':>6} {'negated':>8} {'automaton ms':>13} {'MB/s':>7} {'per-phrase regex ms':>20} {'speedup':>8}")
+    for size in (int(s) for s in args.sizes.split(",")):
+        text = long_text(size)
+        scan = matcher.scan(text)
+        auto = best_of(matcher.triage, text, args.repeat)
+        slow = best_of(naive, text, max(1, args.repeat // 2))
+        print(f"{size:>10,} {sum(not m['negated'] for m in scan):>6} {sum(m['negated'] for m in scan):>8} "
+              f"{auto * 1000:>13.2f} {size / auto / 1e6:>7.1f} {slow * 1000:>20.2f} {slow / auto:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
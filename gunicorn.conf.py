@@ -0,0 +1,17 @@
+# gunicorn.conf.py — picked up automatically by `gunicorn` in the Dockerfile.
+# app.py sizes its outbound HTTP pools from the same GUNICORN_THREADS value.
+#
+# GUNICORN_MODE=wsgi (default): Flask app, sync/threaded workers.
+# GUNICORN_MODE=asgi: asgi.py on uvicorn workers; AI routes run on an event loop.
+import os
+
+mode = os.getenv("GUNICORN_MODE", "wsgi").lower()
+
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+threads = int(os.getenv("GUNICORN_THREADS", "1"))
+
+if mode == "asgi":
+    wsgi_app = "asgi:application"
+    worker_class = "uvicorn.workers.UvicornWorker"
+else:
+    wsgi_app = "app:app"
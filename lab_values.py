@@ -0,0 +1,217 @@
+# lab_values.py
+# Structured lab value extraction from OCR text. A precompiled synonym
+# pattern finds the analyte at the start of a line, a unit table and a range
+# pattern pick the rest of the row apart, and values are flagged low/normal/
+# high against the printed reference range (or a typical adult range when the
+# report has none). Pure Python, no app imports.
+import re
+
+# analyte -> (synonyms, typical adult reference range per unit);
+# synonyms match case-insensitively with spaces, commas and hyphens interchangeable
+ANALYTES = {
+    "glucose": (("glucose", "glucose fasting", "fasting glucose", "fasting blood sugar", "blood sugar", "fbs", "glu"),
+                {"mg/dl": "70-99", "mmol/l": "3.9-5.5"}),
+    "hba1c": (("hemoglobin a1c", "haemoglobin a1c", "hb a1c", "a1c", "glycated hemoglobin", "glycohemoglobin"),
+              {"%": "4.0-5.6", "mmol/mol": "20-38"}),
+    "cholesterol": (("total cholesterol", "cholesterol total", "cholesterol", "chol"),
+                    {"mg/dl": "<200", "mmol/l": "<5.2"}),
+    "ldl": (("ldl cholesterol", "ldl chol", "ldl c", "ldl calculated", "ldl calc", "ldl"),
+            {"mg/dl": "<100", "mmol/l": "<2.6"}),
+    "hdl": (("hdl cholesterol", "hdl chol", "hdl c", "hdl"), {"mg/dl": ">40", "mmol/l": ">1.0"}),
+    "triglycerides": (("triglycerides", "triglyceride", "trig", "tg"), {"mg/dl": "<150", "mmol/l": "<1.7"}),
+    "hemoglobin": (("hemoglobin", "haemoglobin", "hgb", "hb"), {"g/dl": "12.0-17.5", "g/l": "120-175"}),
+    "hematocrit": (("hematocrit", "haematocrit", "hct"), {"%": "36-50"}),
+    "wbc": (("white blood cell count", "white blood cells", "white cell count", "wbc count", "wbc", "leukocytes"),
+            {"10^3/ul": "4.0-11.0"}),
+    "rbc": (("red blood cell count", "red blood cells", "red cell count", "rbc count", "rbc", "erythrocytes"),
+            {"10^6/ul": "4.0-5.9"}),
+    "platelets": (("platelet count", "platelets", "plt"), {"10^3/ul": "150-400"}),
+    "mcv": (("mcv", "mean corpuscular volume"), {"fl": "80-100"}),
+    "mch": (("mch", "mean corpuscular hemoglobin"), {"pg": "27-33"}),
+    "mchc": (("mchc",), {"g/dl": "32-36"}),
+    "rdw": (("rdw", "rdw cv", "red cell distribution width"), {"%": "11.5-14.5"}),
+    "sodium": (("sodium", "na"), {"mmol/l": "135-145"}),
+    "potassium": (("potassium", "k"), {"mmol/l": "3.5-5.1"}),
+    "chloride": (("chloride", "cl"), {"mmol/l": "98-107"}),
+    "bicarbonate": (("carbon dioxide", "total co2", "co2", "bicarbonate", "hco3"), {"mmol/l": "22-29"}),
+    "bun": (("blood urea nitrogen", "urea nitrogen", "bun"), {"mg/dl": "7-20"}),
+    "creatinine": (("creatinine", "creatinine serum", "creat"), {"mg/dl": "0.6-1.3", "umol/l": "53-115"}),
+    "egfr": (("egfr", "estimated gfr", "gfr estimated", "gfr"), {"ml/min/1.73m2": ">=60"}),
+    "calcium": (("calcium", "ca"), {"mg/dl": "8.6-10.3", "mmol/l": "2.15-2.55"}),
+    "albumin": (("albumin", "alb"), {"g/dl": "3.5-5.0", "g/l": "35-50"}),
+    "protein": (("total protein", "protein total"), {"g/dl": "6.0-8.3"}),
+    "bilirubin": (("total bilirubin", "bilirubin total", "bilirubin", "tbil"), {"mg/dl": "0.1-1.2", "umol/l": "2-21"}),
+    "alt": (("alt", "sgpt", "alanine aminotransferase", "alt sgpt"), {"u/l": "7-56"}),
+    "ast": (("ast", "sgot", "aspartate aminotransferase", "ast sgot"), {"u/l": "10-40"}),
+    "alp": (("alkaline phosphatase", "alk phos", "alp"), {"u/l": "44-147"}),
+    "tsh": (("tsh", "thyroid stimulating hormone", "thyrotropin"), {"uiu/ml": "0.4-4.0"}),
+    "free_t4": (("free t4", "t4 free", "ft4", "free thyroxine"), {"ng/dl": "0.8-1.8", "pmol/l": "10-23"}),
+    "vitamin_d": (("vitamin d 25 hydroxy", "vitamin d 25 oh", "25 oh vitamin d", "25 hydroxy vitamin d",
+                                        "vitamin d", "vit d"), {"ng/ml": "30-100", "nmol/l": "75-250"}),
+    "vitamin_b12": (("vitamin b12", "vit b12", "b12", "cobalamin"), {"pg/ml": "200-900", "pmol/l": "148-664"}),
+    "ferritin": (("ferritin",), {"ng/ml": "15-300"}),
+    "iron": (("serum iron", "iron"), {"ug/dl": "60-170"}),
+    "uric_acid": (("uric acid", "urate"), {"mg/dl": "3.5-7.2"}),
+    "magnesium": (("magnesium",), {"mg/dl": "1.7-2.2"}),
+    "phosphorus": (("phosphorus", "phosphate"), {"mg/dl": "2.5-4.5"}),
+    "crp": (("c reactive protein", "hs crp", "crp"), {"mg/l": "<10"}),
+    "esr": (("esr", "sed rate", "sedimentation rate"), {"mm/hr": "0-20"}),
+    "psa": (("psa", "prostate specific antigen"), {"ng/ml": "0-4.0"}),
+    "inr": (("inr",), {"": "0.8-1.2"}),
+}
+
+UNITS = (
+    "mg/dl", "g/dl", "g/l", "mg/l", "ug/dl", "µg/dl", "mcg/dl", "ng/ml", "ng/dl", "pg/ml", "pg", "fl", "%",
+    "mmol/l", "umol/l", "µmol/l", "nmol/l", "pmol/l", "mmol/mol", "meq/l", "u/l", "iu/l", "miu/l", "uiu/ml", "µiu/ml",
+    "miu/ml", "u/ml", "mm/hr", "mm/h", "ml/min/1.73m2", "ml/min/1.73 m2", "ml/min", "10^3/ul", "10^6/ul", "x10^3/ul",
+    "x10^6/ul", "10*3/ul", "10*6/ul", "k/ul", "m/ul", "10^9/l", "10^12/l", "x10^9/l", "x10^12/l", "thou/ul", "mill/ul",
+)
+# spellings that mean the same unit (and the same numbers) for the typical-range lookup
+UNIT_ALIASES = {
+    "µg/dl": "ug/dl", "mcg/dl": "ug/dl", "µmol/l": "umol/l", "µiu/ml": "uiu/ml", "miu/l": "uiu/ml", "meq/l": "mmol/l",
+    "mm/h": "mm/hr", "ml/min/1.73 m2": "ml/min/1.73m2", "x10^3/ul": "10^3/ul", "10*3/ul": "10^3/ul", "k/ul": "10^3/ul",
+    "thou/ul": "10^3/ul", "10^9/l": "10^3/ul", "x10^9/l": "10^3/ul", "x10^6/ul": "10^6/ul", "10*6/ul": "10^6/ul",
+    "m/ul": "10^6/ul", "mill/ul": "10^6/ul", "10^12/l": "10^6/ul", "x10^12/l": "10^6/ul", "iu/l": "u/l",
+}
+FLAG_WORDS = {"h": "high", "hh": "high", "high": "high", "l": "low", "ll": "low", "low": "low"}
+
+_NUMBER = r"\d+(?:\.\d+)?"
+_SEP = r"[\s,\-]*"
+
+def _phrase(words):
+    return _SEP.join(re.escape(w) for w in words.split())
+
+def _alternation(options):
+    return "|".join(sorted(options, key=len, reverse=True))
+
+def _squash(name):
+    return re.sub(r"[\s,\-]+", "", name.lower())
+
+_SYNONYMS = {_squash(syn): key for key, (synonyms, _) in ANALYTES.items() for syn in synonyms}
+_ANALYTE = re.compile(r"^[\s*•·|\-]*(?P<name>" + _alternation(_phrase(s) for synonyms, _ in ANALYTES.values() for s in synonyms)
+                      + r")(?![a-z0-9]|-\d)", re.I)  # "CA-125", "CA125" are not calcium
+_UNIT = r"(?:" + _alternation(re.escape(u).replace(r"\ ", r"\s?") for u in UNITS) + r")(?![a-z0-9/])"
+_VALUE = re.compile(r"(?<![\w.])(?P<qualifier>[<>]=?)?\s*(?P<number>" + _NUMBER + r")(?![\d/:])")
+_UNIT_AFTER = re.compile(r"[\s|]*(?:(?P<flag>HH|LL|H|L|HIGH|LOW|\*)[\s|]+)?(?P<unit>" + _UNIT + r")?", re.I)
+_RANGE = re.compile(r"(?P<low>" + _NUMBER + r")\s*(?:-|–|—|to)\s*(?P<high>" + _NUMBER + r")"
+                    r"|(?P<op>[<>]=?|≤|≥)\s*(?P<bound>" + _NUMBER + ")")
+_FLAG = re.compile(r"(?<![\w/])(?P<flag>HH|LL|H|L|HIGH|LOW|High|Low|high|low)(?![\w/])")
+_GENERIC = re.compile(r"^[\s*•·|\-]*(?P<name>[A-Za-z][A-Za-z0-9 ,()'\-]{1,40}?)[\s:|]+(?=[<>]?\s*\d)")
+_RESULT_LINE = re.compile(r"(?<![\w.])" + _NUMBER + r"[\s|]*" + _UNIT, re.I)
+# results with no number ("HIV 1/2 Ab: REACTIVE", "Blood culture: Positive - Gram negative
+# rods") and the lab's own notes ("Critical value called to ..."), which the table keeps verbatim
+_QUALITATIVE = re.compile(r"^[\s*•·|\-]*[A-Za-z][^:\n]{0,60}?[\s:|\-]+(?:positive|negative|non[\s\-]?reactive|reactive"
+                          r"|not\s+detected|detected|present|absent|abnormal|indeterminate|equivocal|trace|no\s+growth"
+                          r"|growth|not\s+seen|seen)(?![a-z])", re.I)
+_NOTE = re.compile(r"^[\s*•·|\-]*(?:comments?|notes?|interpretation|impression|remarks?|addendum|pathologist[^:\n]{0,30})"
+                   r"\s*[:\-]|(?<![a-z])(?:critical|panic)(?![a-z])", re.I)
+
+def normalize_unit(unit):
+    unit = (unit or "").lower().replace("μ", "µ")
+    unit = re.sub(r"\s+", " ", unit)
+    return UNIT_ALIASES.get(unit, unit)
+
+def parse_range(text):
+    """(low, high, strict) from "70-99", "<200", ">=60"...; None when there is no range.
+    `strict` means the bound itself is out of range ("<200": 200 is high)."""
+    m = _RANGE.search(text or "")
+    if m is None:
+        return None
+    if m.group("low") is not None:
+        return float(m.group("low")), float(m.group("high")), False
+    op, bound = m.group("op"), float(m.group("bound"))
+    strict = op in ("<", ">")
+    return (None, bound, strict) if op in ("<", "<=", "≤") else (bound, None, strict)
+
+def flag_value(value, reference):
+    low, high, strict = reference
+    if high is not None and (value >= high if strict else value > high):
+        return "high"
+    if low is not None and (value <= low if strict else value < low):
+        return "low"
+    return "normal"
+
+def parse_line(line):
+    """One result row from a report line, or None."""
+    m = _ANALYTE.match(line)
+    if m is not None:
+        analyte, rest = _SYNONYMS[_squash(m.group("name"))], line[m.end():]
+        name = m.group("name")
+    else:
+        m = _GENERIC.match(line)
+        if m is None or not _RESULT_LINE.search(line):
+            return None  # unknown analytes need a unit to tell them from dates, addresses, ids
+        analyte, name, rest = None, m.group("name").strip(" ,:-"), line[m.end():]
+    value = _VALUE.search(rest)
+    if value is None or re.search(r"\d", rest[:value.start()]):
+        return None
+    if rest[:value.start()] in ("-", "–") or re.match(r"[-–]\d", rest[value.end():]):
+        return None  # part of the name ("CA-125") or of a range or code ("CA 19-9"), not the result
+    name = (name + rest[:value.start()]).strip(" \t,:|-")  # keep qualifiers like "Glucose, Fasting"
+    after = rest[value.end():]
+    unit_match = _UNIT_AFTER.match(after)
+    unit = (unit_match.group("unit") or "").strip()
+    remainder = after[unit_match.end():]
+    printed = _RANGE.search(remainder)
+    reference_text = printed.group(0).strip() if printed else None
+    flag_text = remainder[:printed.start()] + " " + remainder[printed.end():] if printed else remainder
+    printed_flag = unit_match.group("flag") or (_FLAG.search(flag_text).group("flag") if _FLAG.search(flag_text) else None)
+
+    number = float(value.group("number"))
+    reference, source = (parse_range(reference_text), "report") if reference_text else (None, None)
+    if reference is None and analyte is not None:
+        typical = ANALYTES[analyte][1].get(normalize_unit(unit))
+        if typical is not None:
+            reference, reference_text, source = parse_range(typical), typical, "typical"
+    if value.group("qualifier") or reference is None:
+        flag = FLAG_WORDS.get((printed_flag or "").lower())  # "<0.01" against a range proves little; trust the lab
+    else:
+        flag = flag_value(number, reference)
+    return {
+        "analyte": analyte,
+        "name": name,
+        "value": number,
+        "value_text": (value.group("qualifier") or "") + value.group("number"),
+        "unit": unit,
+        "reference": reference_text,
+        "reference_source": source,
+        "flag": flag,
+    }
+
+def extract(text):
+    """(rows, coverage): parsed result rows, and the share of result-looking lines
+    (a number followed by a unit) that produced one."""
+    rows, candidates, parsed = [], 0, 0
+    for line in (text or "").splitlines():
+        is_candidate = _RESULT_LINE.search(line) is not None
+        candidates += is_candidate
+        row = parse_line(line)
+        if row is not None:
+            rows.append(row)
+            parsed += is_candidate
+    return rows, (parsed / candidates if candidates else 0.0)
+
+def other_findings(text):
+    """Lines that carry a finding but no row: qualitative results, the lab's comments
+    and critical-value notes, and result-looking lines the parser gave up on
+    ("CA 19-9 35 U/mL"), in order, without repeats."""
+    found = []
+    for line in (text or "").splitlines():
+        line = line.strip(" \t|")
+        finding = _QUALITATIVE.match(line) or _NOTE.search(line) or _RESULT_LINE.search(line)
+        if finding and parse_line(line) is None and line not in found:
+            found.append(line)
+    return found
+
+def compact_table(rows, findings=()):
+    """The rows as short text lines for the LLM prompt, then any other findings verbatim."""
+    lines = []
+    for r in rows:
+        unit = f" {r['unit']}" if r["unit"] else ""
+        ref = f" (ref {r['reference']})" if r["reference_source"] == "report" else \
+            f" (typical {r['reference']})" if r["reference"] else ""
+        flag = f" {r['flag'].upper()}" if r["flag"] and r["flag"] != "normal" else ""
+        lines.append(f"{r['name']}: {r['value_text']}{unit}{ref}{flag}")
+    if findings:
+        lines += ["Other findings:", *findings]
+    return "\n".join(lines)
@@ -0,0 +1,28 @@
+# pdf_text.py
+# Page-range PDF helpers for app.py's process pool. Kept import-light so
+# spawned workers don't load the Flask app.
+from io import BytesIO
+
+from PyPDF2 import PdfReader, PdfWriter
+
+def page_count(path):
+    return len(PdfReader(path).pages)
+
+def extract_pages(path, start, stop):
+    """Text of pages [start, stop); pages that fail to parse come back empty."""
+    reader = PdfReader(path)
+    texts = []
+    for i in range(start, stop):
+        try:
+            texts.append(reader.pages[i].extract_text() or "")
+        except Exception:
+            texts.append("")
+    return texts
+
+def single_page_pdf(path, index):
+    """A one-page PDF (bytes) holding page `index`, for per-page OCR."""
+    writer = PdfWriter()
+    writer.add_page(PdfReader(path).pages[index])
+    buf = BytesIO()
+    writer.write(buf)
+    return buf.getvalue()
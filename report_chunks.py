@@ -0,0 +1,70 @@
+# report_chunks.py
+# Token counting and section-aware splitting of long report text for the
+# map-reduce lab report path. Sections are the blocks between blank lines,
+# form feeds and page markers; they are packed greedily into chunks under a
+# token budget, and only a section too big on its own is cut (on line
+# boundaries, then characters). Pure Python, no app imports; tiktoken gives
+# exact counts when installed, chars/4 otherwise.
+import re
+
+try:
+    import tiktoken
+    _ENCODING = tiktoken.get_encoding("o200k_base")  # gpt-4o / gpt-4o-mini
+except Exception:  # not installed, or the encoding can't be loaded offline
+    _ENCODING = None
+
+_SECTION_BREAK = re.compile(r"\n[ \t]*\n+|\f+|\n(?=[ \t]*(?:-{3,}|={3,}|Page \d+ of \d+))", re.IGNORECASE)
+
+def exact_counts():
+    return _ENCODING is not None
+
+def count_tokens(text):
+    if not text:
+        return 0
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text, disallowed_special=()))
+    return (len(text) + 3) // 4
+
+def sections(text):
+    return [s.strip("\n") for s in _SECTION_BREAK.split(text or "") if s.strip()]
+
+def _split_oversized(section, max_tokens):
+    """Cut one section that is over budget on its own: whole lines where
+    possible, a long line by characters."""
+    pieces, current, size = [], [], 0
+    for line in section.splitlines():
+        n = count_tokens(line) + 1
+        if n > max_tokens:
+            if current:
+                pieces.append("\n".join(current))
+                current, size = [], 0
+            step = max(1, len(line) * max_tokens // n)
+            for i in range(0, len(line), step):
+                pieces.append(line[i:i + step])
+            continue
+        if current and size + n > max_tokens:
+            pieces.append("\n".join(current))
+            current, size = [], 0
+        current.append(line)
+        size += n
+    if current:
+        pieces.append("\n".join(current))
+    return pieces
+
+def split(text, max_tokens):
+    """Chunks of `text` of at most about `max_tokens` each, in order, keeping
+    sections whole whenever they fit."""
+    chunks, current, size = [], [], 0
+    for section in sections(text):
+        n = count_tokens(section) + 2
+        parts = [section] if n <= max_tokens else _split_oversized(section, max_tokens)
+        for part in parts:
+            n = count_tokens(part) + 2
+            if current and size + n > max_tokens:
+                chunks.append("\n\n".join(current))
+                current, size = [], 0
+            current.append(part)
+            size += n
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
@@ -0,0 +1,8 @@
+import os
+import tempfile
+
+# app.py reads its configuration at import; keep tests off the real token and shared files
+_tmp = tempfile.mkdtemp(prefix="askdoc-tests-")
+os.environ.setdefault("API_AUTH_TOKEN", "test-token")
+os.environ.setdefault("HISTORY_QUEUE_PATH", os.path.join(_tmp, "history-queue.sqlite3"))
+os.environ.setdefault("AI_CACHE_SQLITE_PATH", os.path.join(_tmp, "cache.sqlite3"))
@@ -0,0 +1,102 @@
+import time
+
+import app
+
+def test_ttl_cache_expires_entries():
+    cache = app.TTLCache(10, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2, ttl=-1)
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert len(cache) == 1
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = app.TTLCache(2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+
+def test_ttl_cache_delete():
+    cache = app.TTLCache(10, ttl=60)
+    cache.set("a", 1)
+    cache.delete("a")
+    cache.delete("missing")
+    assert cache.get("a") is None
+
+def _rows(cache):
+    return cache._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+def test_sqlite_cache_round_trip(tmp_path):
+    cache = app.SqliteCache(str(tmp_path / "cache.sqlite3"), ttl=60)
+    cache.set("k", "v")
+    assert cache.get("k") == "v"
+    cache.set("k", "w")
+    assert cache.get("k") == "w"
+    cache.delete("k")
+    assert cache.get("k") is None
+
+def test_sqlite_cache_is_shared_between_connections(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    app.SqliteCache(path, ttl=60).set("k", "v")
+    assert app.SqliteCache(path, ttl=60).get("k") == "v"
+
+def test_sqlite_cache_hides_expired_rows(tmp_path):
+    cache = app.SqliteCache(str(tmp_path / "cache.sqlite3"), ttl=60)
+    cache.set("k", "v", ttl=-1)
+    assert cache.get("k") is None
+
+def test_sqlite_cache_add_only_sets_absent_or_expired_keys(tmp_path):
+    cache = app.SqliteCache(str(tmp_path / "cache.sqlite3"), ttl=60)
+    assert cache.add("lease", "a")
+    assert not cache.add("lease", "b")
+    assert cache.get("lease") == "a"
+    cache.set("old", "x", ttl=-1)
+    assert cache.add("old", "y")
+    assert cache.get("old") == "y"
+
+def test_sqlite_cache_prunes_on_an_interval_not_every_write(tmp_path):
+    cache = app.SqliteCache(str(tmp_path / "cache.sqlite3"), ttl=60, prune_interval=3600)
+    cache.set("first", "v")  # the first write sweeps and arms the timer
+    cache.set("gone", "v", ttl=-1)
+    cache.set("other", "v")
+    assert _rows(cache) == 3
+    assert cache.prune() == 1
+    assert _rows(cache) == 2
+
+def test_sqlite_cache_prunes_once_the_interval_has_passed(tmp_path):
+    cache = app.SqliteCache(str(tmp_path / "cache.sqlite3"), ttl=60, prune_interval=3600)
+    cache.set("gone", "v", ttl=-1)
+    cache._next_prune = time.time() - 1
+    cache.set("other", "v")
+    assert _rows(cache) == 1
+
+def test_response_cache_fills_local_from_shared(tmp_path):
+    shared = app.SqliteCache(str(tmp_path / "cache.sqlite3"), ttl=60)
+    shared.set("k", "v")
+    cache = app.ResponseCache(app.TTLCache(10, 60), shared, name="test_cache")
+    assert cache.get("k") == "v"
+    assert cache.local.get("k") == "v"
+
+def test_ai_cache_key_normalizes_whitespace_and_case():
+    key = app.ai_cache_key("symptoms", "English", "Age: 30", "Sore  throat\n")
+    assert key == app.ai_cache_key("symptoms", " english", "age: 30", "sore throat")
+    assert key.startswith("ai:")
+
+def test_ai_cache_key_separates_prompt_types_and_profiles():
+    key = app.ai_cache_key("symptoms", "English", "", "headache")
+    assert key != app.ai_cache_key("photo_analysis", "English", "", "headache")
+    assert key != app.ai_cache_key("symptoms", "English", "Age: 30", "headache")
+    assert key != app.ai_cache_key("symptoms", "Spanish", "", "headache")
+
+def test_history_pages_are_kept_per_user_and_key():
+    app.store_history_page("u1", ("jwt", "a"), "page-a")
+    app.store_history_page("u1", ("jwt", "b"), "page-b")
+    assert app.cached_history_page("u1", ("jwt", "a")) == "page-a"
+    assert app.cached_history_page("u1", ("jwt", "b")) == "page-b"
+    assert app.cached_history_page("u2", ("jwt", "a")) is None
+    app.invalidate_history("u1")
+    assert app.cached_history_page("u1", ("jwt", "a")) is None
@@ -0,0 +1,35 @@
+import lab_values
+
+REPORT = """Glucose 112 mg/dL 70-99 H
+Hemoglobin 13.2 g/dL 12.0-15.5
+Potassium 4.1 mmol/L 3.5-5.1
+HIV 1/2 Ab: REACTIVE
+Blood culture: Positive - Gram negative rods
+Comment: Critical value called to Dr Smith
+Results should be interpreted in the context of clinical findings.
+"""
+
+def test_table_keeps_qualitative_results_and_notes():
+    rows, _ = lab_values.extract(REPORT)
+    table = lab_values.compact_table(rows, lab_values.other_findings(REPORT))
+    assert len(rows) == 3
+    for line in ("HIV 1/2 Ab: REACTIVE", "Blood culture: Positive - Gram negative rods",
+                 "Comment: Critical value called to Dr Smith"):
+        assert line in table
+    assert "interpreted" not in table
+
+def test_numeric_rows_are_not_repeated_as_findings():
+    assert lab_values.other_findings("Glucose 112 mg/dL 70-99 H\nTSH 2.1 uIU/mL 0.4-4.0") == []
+
+def test_tumour_markers_are_not_read_as_calcium():
+    ca125 = lab_values.parse_line("CA-125 40 U/mL 0-35")
+    assert (ca125["analyte"], ca125["name"], ca125["value"], ca125["flag"]) == (None, "CA-125", 40.0, "high")
+    assert lab_values.parse_line("CA 19-9 35 U/mL 0-37") is None
+    assert lab_values.parse_line("Ca 9.4 mg/dL 8.6-10.3")["analyte"] == "calcium"
+
+def test_unparsed_result_lines_reach_the_table():
+    text = "Calcium 9.4 mg/dL 8.6-10.3\nCA 19-9 35 U/mL 0-37"
+    rows, _ = lab_values.extract(text)
+    table = lab_values.compact_table(rows, lab_values.other_findings(text))
+    assert [r["analyte"] for r in rows] == ["calcium"]
+    assert "CA 19-9 35 U/mL 0-37" in table
@@ -0,0 +1,109 @@
+import threading
+
+import app
+
+HEADERS = {"Authorization": f"Bearer {app.API_AUTH_TOKEN}"}
+
+def test_breaker_opens_at_the_error_rate():
+    breaker = app.CircuitBreaker("test_breaker", window=60, min_calls=4, error_rate=0.5, cooldown=60)
+    for ok in (True, True, False):
+        assert breaker.allow()
+        breaker.record(ok)
+    assert breaker.state == "closed"
+    breaker.record(False)
+    assert breaker.is_open()
+    assert not breaker.allow()
+
+def test_breaker_lets_one_probe_through_after_the_cooldown():
+    breaker = app.CircuitBreaker("test_breaker", window=60, min_calls=1, error_rate=0.5, cooldown=0)
+    breaker.record(False)
+    assert breaker.is_open()
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    assert not breaker.allow()
+    breaker.record(True)
+    assert breaker.state == "closed"
+    assert breaker.allow()
+
+def test_breaker_reopens_when_the_probe_fails():
+    breaker = app.CircuitBreaker("test_breaker", window=60, min_calls=1, error_rate=0.5, cooldown=0)
+    breaker.record(False)
+    assert breaker.allow()
+    breaker.record(False)
+    assert breaker.is_open()
+
+def test_retry_budget_caps_retries_by_request_share():
+    budget = app.RetryBudget(ratio=0.5, minimum=1, window=60)
+    for _ in range(4):
+        budget.record_request()
+    assert [budget.spend() for _ in range(4)] == [True, True, True, False]
+    assert budget.stats() == {"requests": 4, "retries": 3, "allowed": 3.0}
+
+def test_json_field_stream_reports_members_as_they_complete():
+    stream = app.JsonFieldStream()
+    assert stream.feed('{"detected_condition": "Mig') == []
+    assert stream.feed('raine", "remedies": ["rest", "wat') == [("detected_condition", "Migraine")]
+    assert stream.feed('er"], "note": "a, {b}"}') == [("remedies", ["rest", "water"]), ("note", "a, {b}")]
+
+def test_json_field_stream_handles_escaped_quotes():
+    stream = app.JsonFieldStream()
+    assert stream.feed('{"a": "say \\"hi\\", then", "b": 1}') == [("a", 'say "hi", then'), ("b", 1)]
+
+def test_idempotency_key_replays_the_first_reply():
+    client = app.app.test_client()
+    headers = dict(HEADERS, **{"Idempotency-Key": "test-replay"})
+    first = client.post("/analyze", json={}, headers=headers)
+    again = client.post("/analyze", json={}, headers=headers)
+    assert first.status_code == again.status_code == 400
+    assert "Idempotent-Replayed" not in first.headers
+    assert again.headers["Idempotent-Replayed"] == "true"
+    assert again.get_json() == first.get_json()
+
+def test_idempotency_key_reused_with_another_body_is_422():
+    client = app.app.test_client()
+    headers = dict(HEADERS, **{"Idempotency-Key": "test-mismatch"})
+    client.post("/analyze", json={}, headers=headers)
+    r = client.post("/analyze", json={"language": "English"}, headers=headers)
+    assert r.status_code == 422
+
+def _job_store(shared=None, max_pending=4):
+    return app.JobStore(workers=1, max_pending=max_pending, max_jobs=16, ttl=60, shared=shared)
+
+def test_job_store_runs_and_deduplicates_jobs():
+    store = _job_store()
+    job, created = store.submit("hash", lambda: ({"ok": True}, 200))
+    assert created
+    assert job["done"].wait(5)
+    assert app.job_view(job)["status"] == "done"
+    assert app.job_view(job)["result"] == {"ok": True}
+    again, created = store.submit("hash", lambda: ({"ok": False}, 200))
+    assert again is job and not created
+
+def test_job_store_resubmits_failed_jobs():
+    store = _job_store()
+    job, _ = store.submit("hash", lambda: ({"error": "x"}, 500))
+    assert job["done"].wait(5)
+    assert job["status"] == "failed"
+    retry, created = store.submit("hash", lambda: ({"ok": True}, 200))
+    assert created and retry is not job
+
+def test_job_store_rejects_when_full():
+    store = _job_store(max_pending=1)
+    release = threading.Event()
+    job, _ = store.submit("a", lambda: (release.wait(5), 200))
+    assert store.submit("b", lambda: ({}, 200)) == (None, False)
+    release.set()
+    assert job["done"].wait(5)
+
+def test_job_store_publishes_to_the_shared_store(tmp_path):
+    shared = app.SqliteCache(str(tmp_path / "cache.sqlite3"), ttl=60)
+    job, _ = _job_store(shared).submit("hash", lambda: ({"ok": True}, 200))
+    assert job["done"].wait(5)  # set after the final publish
+    view = _job_store(shared).shared_view(job["id"])
+    assert view["status"] == "done"
+    assert view["result"] == {"ok": True}
+
+def test_job_ids_name_their_worker():
+    job, _ = _job_store().submit("hash", lambda: ({}, 200))
+    assert not app.JobStore.elsewhere(job["id"])
+    assert app.JobStore.elsewhere("00000000." + job["id"].partition(".")[2])
@@ -0,0 +1,80 @@
+import pytest
+
+import triage
+
+matcher = triage.RedFlagMatcher()
+
+@pytest.mark.parametrize("text, category", [
+    ("no fever and crushing chest pain", "cardiac"),
+    ("I have no energy and I want to kill myself", "mental_health"),
+    ("history of asthma, now I cant breathe", "breathing"),
+    ("I dont know why, my face is drooping", "stroke"),
+    ("history of suicidal thoughts", "mental_health"),
+    ("history of choking, I cant breathe", "breathing"),
+    ("I'm not sure, but I think I'm having a heart attack", "cardiac"),
+])
+def test_flags_emergencies_outside_a_negation(text, category):
+    block = matcher.triage(text)
+    assert block is not None
+    assert category in {f["category"] for f in block["red_flags"]}
+
+@pytest.mark.parametrize("text", [
+    "no chest pain, no shortness of breath, just a runny nose",
+    "denies suicidal thoughts; sleeping poorly",
+    "history of anaphylaxis to peanuts, today only a mild rash",
+    "denies any slurred speech",
+    "chest pain radiating: ruled out",
+])
+def test_negated_mentions_do_not_flag(text):
+    assert matcher.triage(text) is None
+
+@pytest.mark.parametrize("text", [
+    "Black tarry stool: not observed",
+    "Vomiting blood: none",
+    "the choking went away",
+    "I am not breathing well",
+])
+def test_post_negations_and_near_misses(text):
+    assert matcher.triage(text) is None
+
+lab_matcher = triage.RedFlagMatcher(triage.LAB_RED_FLAGS)
+
+@pytest.mark.parametrize("text", [
+    "Carboxyhemoglobin (Carbon Monoxide) 1.1 % 0.0-2.3",
+    "Lead Poisoning Screen: 2 ug/dL",
+    "Suicide risk screening: negative",
+    "No critical values.",
+    "Critical values: none",
+])
+def test_lab_text_is_not_screened_with_symptom_phrases(text):
+    assert lab_matcher.triage(text) is None
+
+def test_lab_critical_value_flags():
+    block = lab_matcher.triage("Potassium 6.9 mmol/L HH\nComment: Critical value called to Dr Smith")
+    assert [f["category"] for f in block["red_flags"]] == ["critical_result"]
+
+@pytest.mark.parametrize("text", [
+    "I hurt myself lifting boxes",
+    "I think I have food poisoning",
+    "heavy bleeding during my period",
+    "my fingers were turning blue in the cold",
+    "I was choking on water briefly but fine now",
+    "My dad had heart attack symptoms last year",
+    "I had crushing chest pain years ago",
+])
+def test_vague_past_or_someone_elses_mentions_do_not_flag(text):
+    assert matcher.triage(text) is None
+
+@pytest.mark.parametrize("text, category", [
+    ("I want to hurt myself", "mental_health"),
+    ("my lips are turning blue", "breathing"),
+    ("she is choking and cant breathe", "breathing"),
+    ("the bleeding wont stop", "bleeding"),
+    ("my dad is having a heart attack", "cardiac"),
+    ("my mom has slurred speech", "stroke"),
+    ("my dad had suicidal thoughts last year", "mental_health"),
+    ("I swallowed poison", "poisoning"),
+])
+def test_qualified_phrases_still_flag(text, category):
+    block = matcher.triage(text)
+    assert block is not None and category in {f["category"] for f in block["red_flags"]}
@@ -0,0 +1,22 @@
+import base64
+
+import pytest
+
+import app
+
+HEADERS = {"Authorization": f"Bearer {app.API_AUTH_TOKEN}"}
+
+def test_decode_accepts_line_broken_base64():
+    data = base64.b64encode(b"%PDF-1.4 " * 20).decode()
+    assert app.decode_base64_upload(data[:30] + "\n" + data[30:], "PDF") == b"%PDF-1.4 " * 20
+
+@pytest.mark.parametrize("value", ["not base64!!", "abc", "%%%"])
+def test_malformed_pdf_base64_is_an_upload_error(value):
+    with pytest.raises(app.UploadError) as e:
+        app.pdf_base64_to_text(value)
+    assert e.value.status == 400
+
+def test_lab_report_with_malformed_pdf_base64_is_400():
+    r = app.app.test_client().post("/analyze-lab-report", json={"pdf_base64": "not base64!!"}, headers=HEADERS)
+    assert r.status_code == 400
+    assert r.get_json() == {"error": "Invalid PDF data: expected base64"}
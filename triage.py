@@ -0,0 +1,254 @@
+# triage.py
+# Deterministic red-flag screen that runs before the LLM. A word-level
+# Aho-Corasick automaton finds every curated emergency phrase in one pass over
+# the input; NegEx-style cues ("no", "denies", "ruled out", ...) drop
+# mentions that are negated or historical. Pure Python, no app imports.
+import re
+
+EMERGENCY = "Emergency"
+CALL_EMERGENCY = "Call your local emergency number (such as 911) now or go to the nearest emergency department."
+
+# category -> (phrases, immediate_action); phrases are matched on whole words after
+# normalisation ("can't" -> "cant"), so list the spellings people actually type
+RED_FLAGS = {
+    "cardiac": (
+        ("crushing chest pain", "crushing chest pressure", "crushing pain in my chest", "chest pain radiating",
+         "chest pain spreading", "pain radiating to my left arm", "pain radiating to my jaw", "pain spreading to my arm",
+         "pain spreading to my jaw", "chest pain and shortness of breath", "chest pain with sweating",
+         "elephant sitting on my chest", "having a heart attack", "heart attack symptoms", "cardiac arrest"),
+        f"These may be signs of a heart attack. {CALL_EMERGENCY} Do not drive yourself.",
+    ),
+    "stroke": (
+        ("face drooping", "facial droop", "face is drooping", "drooping face", "droopy face", "one side of my face",
+         "slurred speech", "speech is slurred", "cant speak", "cannot speak", "trouble speaking", "sudden weakness",
+         "sudden numbness", "weakness on one side", "numbness on one side", "cant lift my arm", "cannot lift my arm",
+         "having a stroke", "stroke symptoms", "sudden vision loss", "sudden loss of vision", "sudden confusion"),
+        f"These may be signs of a stroke; note the time symptoms started. {CALL_EMERGENCY}",
+    ),
+    "breathing": (
+        ("cant breathe", "cannot breathe", "can not breathe", "unable to breathe", "struggling to breathe",
+         "hard to breathe", "gasping for air", "gasping for breath", "is choking", "im choking", "am choking",
+         "still choking", "choking and cant breathe", "lips turning blue", "lips are turning blue", "lips are blue",
+         "blue lips", "face turning blue", "is turning blue", "stopped breathing", "is not breathing", "isnt breathing", "was not breathing", "wasnt breathing",
+         "not breathing at all", "severe shortness of breath"),
+        f"Severe trouble breathing is an emergency. {CALL_EMERGENCY}",
+    ),
+    "anaphylaxis": (
+        ("throat closing", "throat is closing", "throat closing up", "throat swelling", "tongue swelling",
+         "swollen tongue", "swelling of my tongue", "lips swelling", "anaphylaxis", "anaphylactic",
+         "severe allergic reaction"),
+        f"This may be a severe allergic reaction. Use an epinephrine auto-injector if one is prescribed. {CALL_EMERGENCY}",
+    ),
+    "bleeding": (
+        ("vomiting blood", "throwing up blood", "coughing up blood", "blood in vomit", "bleeding wont stop",
+         "bleeding will not stop", "bleeding that wont stop", "uncontrolled bleeding", "cant stop the bleeding",
+         "cannot stop the bleeding", "black tarry stool", "black tarry stools"),
+        f"Heavy or internal bleeding needs urgent care. Apply firm pressure to any wound. {CALL_EMERGENCY}",
+    ),
+    "neurological": (
+        ("worst headache of my life", "worst headache ever", "thunderclap headache", "having a seizure",
+         "seizure lasting", "seizing", "unconscious", "unresponsive", "passed out", "wont wake up",
+         "will not wake up", "stiff neck and fever", "fever and stiff neck"),
+        f"These can be signs of a serious brain or nervous system problem. {CALL_EMERGENCY}",
+    ),
+    "mental_health": (
+        ("suicide", "suicidal", "kill myself", "killing myself", "end my life", "ending my life", "want to die",
+         "self harm", "want to hurt myself", "going to hurt myself", "thinking of hurting myself",
+         "thoughts of hurting myself", "urge to hurt myself", "overdose", "overdosed", "took too many pills"),
+        "You deserve support right now. If you might act on these thoughts, call your local emergency number. "
+        "In the US you can call or text 988 (Suicide & Crisis Lifeline) any time.",
+    ),
+    "poisoning": (
+        ("swallowed bleach", "drank bleach", "swallowed poison", "poisoning", "carbon monoxide"),
+        f"Possible poisoning. {CALL_EMERGENCY} In the US, Poison Control is 1-800-222-1222.",
+    ),
+}
+
+# mentions that contain a red-flag phrase but are not emergencies ("food poisoning")
+EXCLUDED_PHRASES = ("food poisoning",)
+
+# Lab reports are screened with their own list: analyte names ("Carboxyhemoglobin
+# (Carbon Monoxide)", "Suicide risk screening") would trip the symptom phrases, but
+# a result the lab itself marks critical warrants the same fast path
+LAB_RED_FLAGS = {
+    "critical_result": (
+        ("critical value", "critical values", "critical result", "critical results", "panic value", "panic values",
+         "critical high", "critical low", "critically high", "critically low"),
+        "The lab marked a result on this report as critical. Contact the doctor who ordered the test right away. "
+        f"If you can't reach them or you feel unwell: {CALL_EMERGENCY}",
+    ),
+}
+
+# NegEx-style cues. Pre-cues negate a phrase that follows within NEGATION_WINDOW
+# tokens of the same clause; post-cues negate one that precedes them, across a
+# colon ("Black tarry stool: not observed") but not past the end of the clause.
+NEGATION_WINDOW = 3
+PRE_NEGATIONS = {
+    ("no",), ("not",), ("never",), ("without",), ("denies",), ("denied",), ("deny",), ("nor",),
+    ("negative", "for"), ("free", "of"), ("absence", "of"), ("ruled", "out"), ("rule", "out"),
+    ("dont",), ("doesnt",), ("didnt",), ("isnt",), ("wasnt",), ("havent",), ("hasnt",), ("hadnt",),
+}
+# "history of asthma" is past, but "history of ... cant breathe" and a history of
+# suicidal thoughts still need a flag: these only negate past-tense phrases outside
+# HISTORY_EXEMPT
+HISTORY_CUES = {("history", "of"), ("hx", "of")}
+HISTORY_EXEMPT = {"mental_health"}
+PRESENT_TENSE = {"am", "is", "are", "has", "have", "cant", "cannot", "can", "unable", "having", "wont", "will", "not",
+                 "struggling", "gasping", "turning", "seizing", "want", "took", "swallowed", "drank"}
+# someone else, in the past ("my dad had heart attack symptoms"): a relative negates a
+# phrase when a past-tense verb sits between them; past-time post-cues negate what precedes
+# ("chest pain years ago"). Both follow the HISTORY_EXEMPT and present-tense rules above.
+RELATIVES = {
+    ("dad",), ("father",), ("mom",), ("mum",), ("mother",), ("brother",), ("sister",), ("grandfather",),
+    ("grandmother",), ("grandpa",), ("grandma",), ("uncle",), ("aunt",), ("cousin",), ("family", "member"),
+}
+PAST_TENSE = {"had", "was", "were", "died", "used", "suffered"}
+PAST_TIME = {
+    ("last", "year"), ("last", "month"), ("years", "ago"), ("months", "ago"), ("a", "year", "ago"),
+    ("in", "the", "past"), ("as", "a", "child"), ("when", "i", "was"),
+}
+POST_NEGATIONS = {
+    ("denied",), ("ruled", "out"), ("resolved",), ("negative",), ("absent",), ("unlikely",), ("none",), ("nil",),
+    ("not", "observed"), ("not", "seen"), ("not", "detected"), ("not", "present"), ("not", "noted"), ("not", "reported"),
+    ("went", "away"), ("has", "stopped"), ("subsided",),
+}
+# negation words that don't negate what follows ("no relief from chest pain")
+PSEUDO_NEGATIONS = {
+    ("no", "relief"), ("no", "better"), ("no", "improvement"), ("no", "change"), ("no", "doubt"),
+    ("not", "only"), ("not", "sure"), ("not", "improving"), ("not", "better"), ("not", "just"),
+    ("not", "getting", "better"), ("not", "stopping"), ("without", "relief"), ("dont", "know"), ("dont", "think"),
+}
+# a clause ends at punctuation (commas included), "and", a contrasting conjunction
+# or a shift to the present: "no fever and crushing chest pain", "asthma, now I cant breathe"
+TERMINATORS = {
+    ".", "and", "but", "however", "although", "though", "except", "yet", "now", "currently", "today", "tonight",
+    "then", "so", "because", "while", "which", "who",
+}
+
+_TOKEN = re.compile(r"[a-z0-9]+|[.,;:!?\n]")
+_APOSTROPHES = re.compile(r"['’`]")
+
+def tokenize(text):
+    """Lower-cased word tokens; a colon stays ':' and other punctuation becomes a '.' token."""
+    tokens = _TOKEN.findall(_APOSTROPHES.sub("", text.lower()))
+    return [t if t[0].isalnum() or t == ":" else "." for t in tokens]
+
+class PhraseAutomaton:
+    """Aho-Corasick over word tokens: one pass reports every occurrence of every
+    phrase, overlapping ones included, in time linear in the input."""
+
+    def __init__(self, phrases):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]  # state -> [(phrase length, payload)]
+        for words, payload in phrases:
+            state = 0
+            for word in words:
+                nxt = self.goto[state].get(word)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[state][word] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                state = nxt
+            self.out[state].append((len(words), payload))
+        self.vocabulary = frozenset(w for edges in self.goto for w in edges)
+        queue = list(self.goto[0].values())
+        while queue:
+            state = queue.pop(0)
+            for word, nxt in self.goto[state].items():
+                queue.append(nxt)
+                f = self.fail[state]
+                while f and word not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(word, 0)
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+
+    def finditer(self, tokens):
+        """Yield (start, end, payload) token spans."""
+        goto, fail, out, vocabulary = self.goto, self.fail, self.out, self.vocabulary
+        state = 0
+        for i, token in enumerate(tokens):
+            if token not in vocabulary:
+                state = 0
+                continue
+            while state and token not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(token, 0)
+            for length, payload in out[state]:
+                yield i - length + 1, i + 1, payload
+
+class RedFlagMatcher:
+    def __init__(self, red_flags=RED_FLAGS):
+        self.actions = {category: action for category, (_, action) in red_flags.items()}
+        self.order = list(red_flags)
+        phrases = [(tuple(tokenize(p)), (category, p)) for category, (phrases, _) in red_flags.items() for p in phrases]
+        self.phrases = PhraseAutomaton(phrases + [(tuple(tokenize(p)), (None, p)) for p in EXCLUDED_PHRASES])
+        cues = [(c, ("pre", c)) for c in PRE_NEGATIONS] + [(c, ("post", c)) for c in POST_NEGATIONS]
+        cues += [(c, ("history", c)) for c in HISTORY_CUES] + [(c, ("pseudo", c)) for c in PSEUDO_NEGATIONS]
+        cues += [(c, ("relative", c)) for c in RELATIVES] + [(c, ("past", c)) for c in PAST_TIME]
+        self.cues = PhraseAutomaton(cues)
+
+    @staticmethod
+    def _negated(start, end, category, cues, tokens):
+        pre, history, relative, post, past_time = cues
+        past = category not in HISTORY_EXEMPT and not PRESENT_TENSE.intersection(tokens[start:end])
+        for cue_end in range(start, max(0, start - NEGATION_WINDOW) - 1, -1):
+            if cue_end in pre:
+                return True
+            between = tokens[cue_end:start]
+            if past and not PRESENT_TENSE.intersection(between):
+                if cue_end in history or (cue_end in relative and PAST_TENSE.intersection(between)):
+                    return True
+            if cue_end > 0 and tokens[cue_end - 1] in TERMINATORS:
+                break
+        for cue_start in range(end, min(len(tokens), end + NEGATION_WINDOW)):
+            if cue_start in post or (past and cue_start in past_time):
+                return True
+            if tokens[cue_start] in TERMINATORS:
+                break
+        return False
+
+    def scan(self, text):
+        """Every red-flag mention: [{"category", "phrase", "negated"}] in input order."""
+        tokens = tokenize(text or "")
+        pre, history, relative, post, past_time, pseudo = set(), set(), set(), set(), set(), set()
+        cue_spans = []
+        for start, end, (kind, _) in self.cues.finditer(tokens):
+            cue_spans.append((start, end, kind))
+            if kind == "pseudo":
+                pseudo.add(start)
+        for start, end, kind in cue_spans:
+            if kind == "pre" and start not in pseudo:
+                pre.add(end)  # negates phrases starting at or after `end`
+            elif kind == "history":
+                history.add(end)
+            elif kind == "relative":
+                relative.add(end)
+            elif kind == "post":
+                post.add(start)
+            elif kind == "past":
+                past_time.add(start)
+        found = list(self.phrases.finditer(tokens))
+        excluded = [(start, end) for start, end, (category, _) in found if category is None]
+        matches, seen = [], set()
+        for start, end, (category, phrase) in found:
+            if category is None or (start, end) in seen or any(s <= start and end <= e for s, e in excluded):
+                continue
+            seen.add((start, end))
+            negated = self._negated(start, end, category, (pre, history, relative, post, past_time), tokens)
+            matches.append({"category": category, "phrase": phrase, "negated": negated})
+        return matches
+
+    def triage(self, text):
+        """Emergency urgency/immediate_action block for the non-negated red flags, or None."""
+        flags = [m for m in self.scan(text) if not m["negated"]]
+        if not flags:
+            return None
+        categories = sorted({m["category"] for m in flags}, key=self.order.index)
+        return {
+            "urgency": EMERGENCY,
+            "immediate_action": " ".join(self.actions[c] for c in categories),
+            "red_flags": [{"category": m["category"], "phrase": m["phrase"]} for m in flags],
+        }